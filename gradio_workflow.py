@@ -10,10 +10,11 @@ os.environ.pop('ALL_PROXY', None)
 os.environ['NO_PROXY'] = '*'
 import json
 import time
+import asyncio
 import random
 import requests
 import shutil
-from collections import Counter, deque # 导入 deque
+from collections import Counter, deque, OrderedDict # 导入 deque
 from PIL import Image, ImageSequence, ImageOps
 import re
 import io # 导入 io 用于更精确的文件处理
@@ -23,11 +24,27 @@ import numpy as np
 import torch
 import threading
 from threading import Lock, Event # 导入 Lock 和 Event
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, wait as wait_futures, FIRST_COMPLETED
 import websocket # 添加 websocket 导入
 import atexit # For NVML cleanup
-from .kelnel_ui.system_monitor import update_floating_monitors_stream, custom_css as monitor_css, cleanup_nvml # 系统监控模块
-from .kelnel_ui.k_Preview import ComfyUIPreviewer # <--- 导入 ComfyUIPreviewer
+from .kelnel_ui.system_monitor import update_floating_monitors_stream, custom_css as monitor_css, cleanup_nvml, MONITOR_RENDER_JS, MONITOR_CONTAINER_HTML # 系统监控模块
+from .kelnel_ui.backend_pool import ComfyUIBackendPool # <--- ComfyUI 后端池 (多实例分发，每个后端自带预览器和任务追踪器)
+from .kelnel_ui.remote_transport import RemoteTransport, StaleInputError # <--- 远程后端的输入上传/输出下载
+from .kelnel_ui.workflow_cache import workflow_cache # <--- 编译后的工作流缓存 (按路径 + mtime)
+from .kelnel_ui.input_store import InputStore # <--- 按内容哈希保存输入文件
+from .kelnel_ui.tensor_store import input_tensor_store # <--- 进程内输入张量缓存 (GradioInputImage 直接取用)
+from .kelnel_ui.comfy_job_tracker import JOB_SUCCESS # <--- 基于 /ws 事件的任务完成追踪
+from .kelnel_ui.result_registry import result_registry # <--- 进程内结果登记表 (输出节点直接交付结果)
+from .kelnel_ui.cancel_token import CancelToken # <--- 每个排队任务的协作式取消令牌
+from .kelnel_ui.state_notifier import StateNotifier # <--- 跨线程状态变化通知 (唤醒 async 队列循环)
+from .kelnel_ui.result_store import session_results # <--- 按会话划分、带版本号的结果区 (图库 + 视频)，版本不变时不重复推送
+from .kelnel_ui.fair_queue import FairTaskQueue, JOB_CLASSES, JOB_CLASS_LABELS, classify_job # <--- 按优先级类别和用户分组、加权轮询出队的等待队列
+from .kelnel_ui.job_store import JobStore, record_to_task # <--- SQLite 持久化的任务记录 (重启后恢复未完成的任务)
+from .kelnel_ui.retry_policy import BackendUnavailableError # <--- 提交失败时由调度器重新分配后端 (退避和断路器在每个后端上)
+from .kelnel_ui.health_monitor import HEALTH_PROBE_INTERVAL # <--- 后端健康监视器 (backend_pool.health_monitor)
+from .kelnel_ui.http_client import comfy_http # <--- 共享的连接池 HTTP 客户端 (keep-alive、端点超时、请求统计)
+from .kelnel_ui.log_tailer import LogTailer # <--- 单个日志拉取线程 + 环形缓冲区，按游标取增量
+from .kelnel_ui.result_manifest import read_result_manifest # <--- 进程外输出节点的结果 manifest v2 (原子写入，逐张追加)
 from .kelnel_ui.css_html_js import HACKER_CSS, get_sponsor_html # <--- 从 css_html_js.py 导入
 from .kelnel_ui.ui_def import ( # <--- 从 ui_def.py 导入
     calculate_aspect_ratio,
@@ -43,13 +60,20 @@ from .kelnel_ui.ui_def import ( # <--- 从 ui_def.py 导入
 from .kelnel_ui.ui_def import (
     load_plugin_settings, 
     save_plugin_settings, 
-    DEFAULT_MAX_DYNAMIC_COMPONENTS # 需要这个作为 MAX_DYNAMIC_COMPONENTS 的备用值
+    DEFAULT_MAX_DYNAMIC_COMPONENTS, # 需要这个作为 MAX_DYNAMIC_COMPONENTS 的备用值
+    MAX_PIPELINE_DEPTH,
+    get_pipeline_depth,
+    get_scheduler_user_weights,
+    get_comfyui_backend_addresses,
+    get_comfyui_transport_mode,
+    get_workflow_prune_settings
 )
 
 # --- 初始化最大动态组件数量 (从 kelnel_ui.ui_def 导入的函数加载) ---
 plugin_settings_on_load = load_plugin_settings() 
 MAX_DYNAMIC_COMPONENTS = plugin_settings_on_load.get("max_dynamic_components", DEFAULT_MAX_DYNAMIC_COMPONENTS)
 print(f"插件启动：最大动态组件数量从配置加载为: {MAX_DYNAMIC_COMPONENTS} (通过 kelnel_ui.ui_def)")
+PRUNE_WORKFLOW, PRUNE_KEEP_CLASS_TYPES = get_workflow_prune_settings(plugin_settings_on_load) # 提交前的工作流剪枝
 # --- 初始化最大动态组件数量结束 ---
 
 # Register NVML cleanup function to be called on exit
@@ -73,67 +97,88 @@ from datetime import datetime
 from math import gcd
 import uuid
 import fnmatch
-from .kelnel_ui.gradio_cancel_test import cancel_comfyui_task_action # <--- 导入中断函数
+from .kelnel_ui.gradio_cancel_test import cancel_comfyui_task_action, delete_comfyui_queued_prompts # <--- 导入中断/删除队列函数
 from .kelnel_ui.api_json_manage import define_api_json_management_ui # <--- 导入 API JSON 管理 UI 定义函数
 
 # --- 全局状态变量 ---
-task_queue = deque()
+task_queue = FairTaskQueue() # 按任务类别和用户分组的等待队列 (优先级 + 加权轮询出队)，受 queue_lock 保护
+for _user, _weight in get_scheduler_user_weights(plugin_settings_on_load).items():
+    task_queue.set_weight(_user, _weight)
 queue_lock = Lock()
-accumulated_image_results = [] # 明确用于图片
-last_video_result = None # 用于存储最新的视频路径
-results_lock = Lock()
-processing_event = Event() # False: 空闲, True: 正在处理
-executor = ThreadPoolExecutor(max_workers=1) # 单线程执行生成任务
-last_used_seed = -1 # 用于递增/递减模式
-seed_lock = Lock() # 用于保护 last_used_seed
-interrupt_requested_event = Event() # 新增：用于用户请求中断当前任务的信号
-
-# --- ComfyUI 实时预览器实例 ---
-# 使用一个独特的 client_id_suffix 以避免与 k_Preview.py 的独立测试冲突
-comfyui_previewer = ComfyUIPreviewer(client_id_suffix="gradio_workflow_integration", min_yield_interval=0.1)
+processing_event = Event() # False: 空闲, True: 流水线中有任务 (由 _fill_pipeline_locked 维护)
+# --- ComfyUI 后端池 ---
+# 配置项 comfyui_backends 中的每个地址对应一个 ComfyUI 实例 (例如每张 GPU 一个进程)，任务按最少在途数分发。
+# 每个后端自带实时预览器和任务追踪器 (订阅 /ws，按 prompt_id 匹配完成/错误/中断事件)。
+backend_pool = ComfyUIBackendPool(get_comfyui_backend_addresses(plugin_settings_on_load), min_yield_interval=0.1,
+                                  transport_mode=get_comfyui_transport_mode(plugin_settings_on_load))
+print(f"ComfyUI 后端池: {[(b.address, b.transport) for b in backend_pool.backends]}")
+executor = ThreadPoolExecutor(max_workers=1) # 单线程准备并提交任务，保证提交顺序
+result_executor = ThreadPoolExecutor(max_workers=MAX_PIPELINE_DEPTH * len(backend_pool.backends)) # 等待已提交任务的结果
+pipeline_jobs = deque() # 已从 task_queue 取出、正在提交或已提交到 ComfyUI 的任务 (队首为当前执行的任务)，受 queue_lock 保护
+session_seeds = {} # 会话 -> 上次使用的种子 (用于递增/递减模式)，各标签页的种子序列互不干扰
+seed_lock = Lock() # 用于保护 session_seeds
+backend_last_finish = {} # 后端 -> 上一个任务结束的时间，用于计算任务的实际执行耗时，受 queue_lock 保护
+refill_timer = None # 所有健康的后端断路器都打开时，等待试探时间后补位的定时器，受 queue_lock 保护
+# 任务记录持久化到插件目录下的 SQLite，ComfyUI 重启或崩溃后恢复未完成的任务
+JOB_DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "job_queue.sqlite3")
+MAX_RECOVERY_ATTEMPTS = 3 # 同一任务在执行中遇到进程退出的最多次数，超过后不再恢复 (可能正是它导致了崩溃)
+RECOVERY_WAIT_SECONDS = 120 # 启动后等待后端可用再恢复任务的最长时间
+job_store = JobStore(JOB_DB_PATH)
+job_store.prune_finished()
+# 队列/结果状态变化时通知各会话的 run_queued_tasks 协程: 入队、任务结束、清空队列、取消、输出节点交付 (单张) 结果
+queue_state = StateNotifier()
+result_registry.add_listener(queue_state.notify)
+backend_pool.health_monitor.add_listener(queue_state.notify) # 后端就绪状态变化时刷新各会话的状态栏
+STATE_REFRESH_INTERVAL = 1.0 # 没有任何通知时的兜底刷新间隔 (秒)，例如进程外输出节点逐张写入的 manifest
+# 先显示后落盘时输出节点交付的是内存中的 uint8 数组；每个数组只编码一次为 JPEG 预览文件，图库之后只推送路径
+PREVIEW_JPEG_QUALITY = 85
+MAX_PREVIEW_FILES = 512
+preview_files = OrderedDict() # (execution_id, 批次序号) -> (id(数组), 预览文件路径)
+preview_files_lock = Lock()
 # --- 全局状态变量结束 ---
 
-# --- 日志轮询全局变量和函数 ---
-COMFYUI_LOG_URL = "http://127.0.0.1:8188/internal/logs/raw"
-all_logs_text = ""
-
-def fetch_and_format_logs():
-    global all_logs_text
-
-    try:
-        response = requests.get(COMFYUI_LOG_URL, timeout=5)
-        response.raise_for_status()
-        data = response.json()
-        log_entries = data.get("entries", [])
-
-        # 移除多余空行并合并日志内容
-        formatted_logs = "\n".join(filter(None, [entry.get('m', '').strip() for entry in log_entries]))
-        all_logs_text = formatted_logs
-
-        return all_logs_text
-
-    except requests.exceptions.RequestException as e:
-        error_message = f"无法连接到 ComfyUI 服务器: {e}"
-        return all_logs_text + "\n" + error_message if all_logs_text else error_message
-    except json.JSONDecodeError:
-        error_message = "无法解析服务器响应 (非 JSON)"
-        return all_logs_text + "\n" + error_message if all_logs_text else error_message
-    except Exception as e:
-        error_message = f"发生未知错误: {e}"
-        return all_logs_text + "\n" + error_message if all_logs_text else error_message
-
-# --- 日志轮询全局变量和函数结束 ---
+# --- 日志增量推送 ---
+# 服务端只有一个 LogTailer 线程拉取日志；各标签页用自己的游标 (gr.State) 取新增的行，浏览器端追加到日志框
+COMFYUI_LOG_PATH = "/internal/logs/raw" # 日志来自当前队首任务所在的后端 (backend_pool.active_backend)
+LOG_CLIENT_INTERVAL = 0.5 # 浏览器端取增量日志的间隔 (秒)
+MAX_CLIENT_LOG_LINES = 2000 # 浏览器端日志框保留的行数
+log_tailer = LogTailer(backend_pool, COMFYUI_LOG_PATH)
+
+# 把增量日志追加到日志框 (reset 时替换)，超过行数上限时丢弃最早的行；原来在底部时保持滚动到底部
+APPEND_LOG_JS = f"""
+(delta) => {{
+    if (!delta) return;
+    const area = document.querySelector('#comfy_log_display textarea');
+    if (!area) return;
+    const atBottom = area.scrollHeight - area.scrollTop - area.clientHeight < 20;
+    let text = delta.reset || !area.value ? delta.text : area.value + '\\n' + delta.text;
+    const lines = text.split('\\n');
+    if (lines.length > {MAX_CLIENT_LOG_LINES}) text = lines.slice(-{MAX_CLIENT_LOG_LINES}).join('\\n');
+    area.value = text;
+    if (atBottom || delta.reset) area.scrollTop = area.scrollHeight;
+}}
+"""
+
+def poll_log_delta(cursor):
+    """返回 (增量, 新游标)。增量为 {"cursor", "reset", "text"}，没有新日志时不更新 (不向浏览器发送内容)。"""
+    new_cursor, lines, reset = log_tailer.lines_since(cursor)
+    if not lines and not reset:
+        return gr.update(), cursor
+    return {"cursor": new_cursor, "reset": reset, "text": "\n".join(lines)}, new_cursor
+
+# --- 日志增量推送结束 ---
 
 # --- ComfyUI 节点徽章设置 ---
 # 尝试两种可能的 API 路径
-COMFYUI_API_NODE_BADGE = "http://127.0.0.1:8188/settings/Comfy.NodeBadge.NodeIdBadgeMode"
-# COMFYUI_API_NODE_BADGE = "http://127.0.0.1:8188/api/settings/Comfy.NodeBadge.NodeIdBadgeMode" # 备用路径
+COMFYUI_API_NODE_BADGE_PATH = "/settings/Comfy.NodeBadge.NodeIdBadgeMode"
+# COMFYUI_API_NODE_BADGE_PATH = "/api/settings/Comfy.NodeBadge.NodeIdBadgeMode" # 备用路径
 
 def update_node_badge_mode(mode):
-    """发送 POST 请求更新 NodeIdBadgeMode"""
+    """发送 POST 请求更新主后端的 NodeIdBadgeMode"""
+    COMFYUI_API_NODE_BADGE = f"{backend_pool.primary.base_url}{COMFYUI_API_NODE_BADGE_PATH}"
     try:
         # 直接尝试 JSON 格式
-        response = requests.post(
+        response = comfy_http.post(
             COMFYUI_API_NODE_BADGE,
             json=mode,  # 使用 json 参数自动设置 Content-Type 为 application/json
         )
@@ -156,13 +201,11 @@ def update_node_badge_mode(mode):
 # --- ComfyUI 节点徽章设置结束 ---
 
 # --- 重启和中断函数 ---
-COMFYUI_DEFAULT_URL_FOR_WORKFLOW = "http://127.0.0.1:8188" # 定义 ComfyUI URL 常量
-
 def reboot_manager():
     try:
-        # 发送重启请求，改为 GET 方法
-        reboot_url = f"{COMFYUI_DEFAULT_URL_FOR_WORKFLOW}/api/manager/reboot" # 使用常量
-        response = requests.get(reboot_url)  # 改为 GET 请求
+        # 发送重启请求，改为 GET 方法 (重启主后端，即加载本插件的 ComfyUI)
+        reboot_url = f"{backend_pool.primary.base_url}/api/manager/reboot"
+        response = comfy_http.get(reboot_url)  # 改为 GET 请求
         if response.status_code == 200:
             return "重启请求已发送。请稍后检查 ComfyUI 状态。"
         else:
@@ -170,9 +213,31 @@ def reboot_manager():
     except Exception as e:
         return f"发生错误: {str(e)}"
 
-def trigger_comfyui_interrupt():
-    """包装函数，用于从 Gradio 调用中断功能，使用预定义的 URL"""
-    return cancel_comfyui_task_action(COMFYUI_DEFAULT_URL_FOR_WORKFLOW)
+def trigger_comfyui_interrupt(backend=None, prompt_id=None):
+    """包装函数，用于从 Gradio 调用中断功能。中断发送到拥有该任务的后端，未指定时发送到当前展示的后端。"""
+    backend = backend or backend_pool.active_backend
+    return cancel_comfyui_task_action(backend.base_url, prompt_id=prompt_id)
+
+def withdraw_comfyui_prompts(backend_prompt_pairs):
+    """撤回已提交到各后端的 prompt: 正在执行的发送中断，仍在排队的通过 /queue 删除。返回状态信息列表。"""
+    prompts_by_backend = {}
+    for backend, prompt_id in backend_prompt_pairs:
+        if backend is not None and prompt_id:
+            prompts_by_backend.setdefault(backend, []).append(prompt_id)
+    status_messages = []
+    for backend, prompt_ids in prompts_by_backend.items():
+        queued_ids = []
+        for prompt_id in prompt_ids:
+            if backend.tracker.is_running(prompt_id):
+                status_messages.append(trigger_comfyui_interrupt(backend, prompt_id))
+            else:
+                queued_ids.append(prompt_id)
+                if not backend.tracker.is_connected():
+                    # 无 /ws 事件时无法判断是否已开始执行: 同时发送带 prompt_id 的中断 (只影响正在执行的该 prompt)
+                    status_messages.append(trigger_comfyui_interrupt(backend, prompt_id))
+        if queued_ids:
+            status_messages.append(delete_comfyui_queued_prompts(backend.base_url, queued_ids))
+    return status_messages
 
 # --- 重启和中断函数结束 ---
 # handle_interrupt_click 函数将被移除，因为中断按钮被移除，其逻辑将整合到新的 clear_queue 中
@@ -192,19 +257,10 @@ def find_key_by_class_type(prompt, class_type):
     return None
 
 def check_seed_node(json_file):
-    if not json_file or not os.path.exists(os.path.join(OUTPUT_DIR, json_file)):
-        print(f"JSON 文件无效或不存在: {json_file}")
-        return gr.update(visible=False)
-    json_path = os.path.join(OUTPUT_DIR, json_file)
-    try:
-        with open(json_path, "r", encoding="utf-8") as file_json:
-            prompt = json.load(file_json)
-        # 使用新的函数和真实类名
-        seed_key = find_key_by_class_type(prompt, "Hua_gradio_Seed")
-        return gr.update(visible=seed_key is not None)
-    except (FileNotFoundError, json.JSONDecodeError) as e:
-        print(f"读取或解析 JSON 文件时出错 ({json_file}): {e}")
+    compiled_workflow = workflow_cache.get(json_file, OUTPUT_DIR)
+    if compiled_workflow is None:
         return gr.update(visible=False)
+    return gr.update(visible=compiled_workflow.first("Hua_gradio_Seed") is not None)
 
 current_dir = os.path.dirname(os.path.abspath(__file__))
 print("当前hua插件文件的目录为：", current_dir)
@@ -242,6 +298,17 @@ class GradioTextOk:
 INPUT_DIR = folder_paths.get_input_directory()
 OUTPUT_DIR = folder_paths.get_output_directory()
 TEMP_DIR = folder_paths.get_temp_directory()
+# 输入图像/视频按内容哈希保存到 input 目录，同一内容文件名不变，ComfyUI 的执行缓存得以复用
+input_store = InputStore(INPUT_DIR)
+# 远程后端 (无共享文件系统) 的输出下载到本地缓存目录，Gradio 从这里展示结果
+remote_transport = RemoteTransport(os.path.join(OUTPUT_DIR, "gradio_remote_cache"))
+
+def _forget_uploads_on_recovery(backend, ready):
+    """远程后端从不可用恢复 (可能已重启、input 目录已清理) 时清除它的上传记录，输入会重新上传。"""
+    if ready and backend.is_remote:
+        remote_transport.forget_backend(backend)
+
+backend_pool.health_monitor.add_listener(_forget_uploads_on_recovery)
 
 # --- Load Resolution Presets from File ---
 # resolution_files and resolution_prefixes are defined here
@@ -263,45 +330,78 @@ if len(resolution_presets) < 10: # Print some examples if loading failed or file
 # --- End Load Resolution Presets ---
 
 
-def start_queue(prompt_workflow):
-    p = {"prompt": prompt_workflow}
+SUBMIT_MAX_WAIT_SECONDS = 600 # 提交持续失败时单个任务最多重试多久 (ComfyUI 重启并加载模型可能需要几分钟)
+
+def _prompt_exists_on_backend(base_url, prompt_id):
+    """prompt 是否已被该后端接收 (在队列中或已有历史记录)。查询失败时抛出 RequestException。"""
+    response = comfy_http.get(f"{base_url}/history/{prompt_id}")
+    response.raise_for_status()
+    if response.json():
+        return True
+    response = comfy_http.get(f"{base_url}/queue")
+    response.raise_for_status()
+    queue = response.json()
+    return any(len(item) > 1 and item[1] == prompt_id
+               for item in queue.get("queue_running", []) + queue.get("queue_pending", []))
+
+def start_queue(prompt_workflow, client_id=None, backend=None, prompt_id=None, maybe_sent=False):
+    """
+    提交 prompt 到 ComfyUI 后端 (默认主后端)，只发送一次，不在这里等待或重试。
+    成功返回 prompt_id；工作流被拒绝 (400) 时返回 None。client_id 用于让 ComfyUI 把该任务的执行事件推送到对应的 /ws 连接。
+
+    后端的断路器打开或处于退避时间内，或请求失败 (网络错误、超时、5xx) 时抛出 BackendUnavailableError，
+    由调度器把任务放回队列并分配给就绪的后端。失败记录在后端的断路器上 (抖动指数退避，连续失败后打开)，
+    退避期间该后端不参与分配，提交线程不会为某个后端睡眠。
+    prompt_id 由调用方生成并随请求发送，同一任务的每次提交使用同一个 prompt_id；maybe_sent 为 True
+    (上次向该后端的请求结果不明) 时先查询后端是否已收到该 prompt_id 再决定是否重发，同一任务不会在该后端被提交两次。
+    """
+    backend = backend or backend_pool.primary
+    prompt_id = prompt_id or str(uuid.uuid4())
+    if not backend.breaker.begin_request(): # half_open 时只有一个提交方得到试探名额
+        raise BackendUnavailableError(f"后端 {backend.name} 暂停提交 (断路器: {backend.breaker.state}，"
+                                      f"{backend.breaker.seconds_until_retry():.1f} 秒后允许重试)", maybe_sent=maybe_sent)
+    p = {"prompt": prompt_workflow, "prompt_id": prompt_id}
+    if client_id:
+        p["client_id"] = client_id
     data = json.dumps(p).encode('utf-8')
-    URL = "http://127.0.0.1:8188/prompt"
-    max_retries = 5
-    retry_delay = 10
-    request_timeout = 60
+    URL = f"{backend.base_url}/prompt"
 
-    for attempt in range(max_retries):
+    try:
+        if maybe_sent and _prompt_exists_on_backend(backend.base_url, prompt_id):
+            print(f"prompt {prompt_id} 已被后端接收 (上次请求的响应丢失)，不再重复提交。")
+            backend.breaker.record_success()
+            return prompt_id
+        response = comfy_http.post(URL, data=data) # /prompt 的超时见 http_client.ENDPOINT_TIMEOUTS
+        if response.status_code == 400: # Bad Request (例如 invalid prompt)
+            try:
+                error_body = response.json()
+                print(f"ComfyUI 返回的错误: {error_body.get('error')}")
+                if error_body.get('node_errors'):
+                    print(f"节点错误: {json.dumps(error_body.get('node_errors'), ensure_ascii=False)}")
+            except ValueError:
+                pass
+            backend.breaker.record_success() # 后端在线，只是这个工作流无效
+            if backend.is_remote:
+                stale_inputs = remote_transport.forget_missing_inputs(backend, response.text)
+                if stale_inputs:
+                    raise StaleInputError(f"后端 {backend.name} 上已不存在输入文件 {stale_inputs}")
+            print("发生 400 Bad Request 错误，通常表示 prompt 无效。停止重试。")
+            return None
+        response.raise_for_status() # 5xx 等其他 HTTP 错误交给调度器重试
+        backend.breaker.record_success()
         try:
-            # 简化服务器检查，直接尝试 POST
-            response = requests.post(URL, data=data, timeout=request_timeout)
-            response.raise_for_status() # 如果是 4xx 或 5xx 会抛出 HTTPError
-            print(f"请求成功 (尝试 {attempt + 1}/{max_retries})")
-            return True # 返回成功状态
-        except requests.exceptions.HTTPError as http_err: # 特别处理 HTTP 错误
-            status_code = http_err.response.status_code
-            print(f"请求失败 (尝试 {attempt + 1}/{max_retries}, HTTP 状态码: {status_code}): {str(http_err)}")
-            if status_code == 400: # Bad Request (例如 invalid prompt)
-                print("发生 400 Bad Request 错误，通常表示 prompt 无效。停止重试。")
-                return False # 立刻返回失败，不重试
-            # 对于其他 HTTP 错误 (例如 5xx)，继续重试逻辑
-            if attempt < max_retries - 1:
-                print(f"{retry_delay}秒后重试...")
-                time.sleep(retry_delay)
-            else:
-                print("达到最大重试次数 (HTTPError)，放弃请求。")
-                return False
-        except requests.exceptions.RequestException as e: # 其他网络错误 (超时, 连接错误等)
-            error_type = type(e).__name__
-            print(f"请求失败 (尝试 {attempt + 1}/{max_retries}, 错误类型: {error_type}): {str(e)}")
-            if attempt < max_retries - 1:
-                print(f"{retry_delay}秒后重试...")
-                time.sleep(retry_delay)
-            else:
-                print("达到最大重试次数 (RequestException)，放弃请求。")
-                print("可能原因: 服务器未运行、网络问题。") # 保留此通用原因
-                return False # 返回失败状态
-    return False # 确保函数在所有路径都有返回值
+            returned_id = response.json().get("prompt_id") or prompt_id
+        except ValueError as e: # 响应不是 JSON，但请求已被接受
+            print(f"无法解析 /prompt 响应: {e}")
+            returned_id = prompt_id
+        print(f"请求成功, prompt_id: {returned_id}")
+        return returned_id
+    except requests.exceptions.RequestException as e: # 网络错误、超时或 HTTP 错误
+        backend.breaker.record_failure()
+        print(f"请求失败 (错误类型: {type(e).__name__}, 断路器: {backend.breaker.state}): {str(e)}")
+        # 只有连接超时能确定请求未发出；其他情况下一次提交前先查询后端是否已收到
+        raise BackendUnavailableError(f"向后端 {backend.name} 提交失败: {type(e).__name__}",
+                                      maybe_sent=maybe_sent or not isinstance(e, requests.exceptions.ConnectTimeout)) from e
 
 def get_json_files():
     try:
@@ -365,8 +465,8 @@ unet_list = get_model_list("unet") # 假设 UNet 模型在 'unet' 目录
 
 # get_output_images is now imported from ui_def
 
-# 修改 generate_image 函数以接受动态组件列表
-def generate_image(
+# 修改 submit_generation 函数以接受动态组件列表
+def submit_generation(
     inputimage1, input_video, 
     dynamic_positive_prompts_values: list, # 列表，包含所有 positive_prompt_texts 的值
     prompt_text_negative, 
@@ -376,10 +476,14 @@ def generate_image(
     hua_checkpoint, hua_unet, 
     dynamic_float_nodes_values: list,     # 列表，包含所有 float_inputs 的值
     dynamic_int_nodes_values: list,       # 列表，包含所有 int_inputs 的值
-    seed_mode, fixed_seed
+    seed_mode, fixed_seed,
+    backend=None,                         # 目标 ComfyUI 后端，默认主后端
+    session_id=None,                      # 提交任务的会话，递增/递减种子按会话计算
+    execution_id=None,                    # 同时作为 prompt_id；同一任务重新提交时沿用，保证幂等
+    maybe_sent=False                      # 上次向该后端的提交结果不明，先查询是否已收到
 ):
-    global last_used_seed # 声明使用全局变量
-    execution_id = str(uuid.uuid4())
+    backend = backend or backend_pool.primary
+    execution_id = execution_id or str(uuid.uuid4())
     print(f"[{execution_id}] 开始生成任务 (种子模式: {seed_mode})...")
     output_type = None # 'image' or 'video'
 
@@ -387,58 +491,46 @@ def generate_image(
         print(f"[{execution_id}] 错误: 未选择工作流 JSON 文件。")
         return None, None # 返回 (None, None) 表示失败
 
-    json_path = os.path.join(OUTPUT_DIR, json_file)
-    if not os.path.exists(json_path):
-        print(f"[{execution_id}] 错误: 工作流 JSON 文件不存在: {json_path}")
-        return None, None
-
-    try:
-        with open(json_path, "r", encoding="utf-8") as file_json:
-            prompt = json.load(file_json)
-    except (FileNotFoundError, json.JSONDecodeError) as e:
-        print(f"[{execution_id}] 读取或解析 JSON 文件时出错 ({json_path}): {e}")
+    # 工作流按 (路径, mtime) 缓存: 只在文件变化时重新解析，每个任务只做一次结构性复制再打补丁
+    compiled_workflow = workflow_cache.get(json_file, OUTPUT_DIR)
+    if compiled_workflow is None:
+        print(f"[{execution_id}] 错误: 无法加载工作流 JSON 文件: {json_file}")
         return None, None
-
-    # --- 更新 Prompt ---
-    # 首先获取工作流中实际存在的动态节点的定义
-    # 注意：get_workflow_defaults_and_visibility 现在返回更详细的动态组件信息
-    # 我们需要从 prompt (原始JSON) 中直接查找节点ID，或者依赖 get_workflow_defaults_and_visibility 返回的ID
-    # 为简化，这里假设 get_workflow_defaults_and_visibility 返回的 dynamic_components 包含节点ID
-    # 并且 dynamic_*_values 列表中的顺序与 get_workflow_defaults_and_visibility 找到的节点顺序一致
-
-    workflow_info = get_workflow_defaults_and_visibility(json_file, OUTPUT_DIR, resolution_prefixes, resolution_presets, MAX_DYNAMIC_COMPONENTS)
-    
-    # --- 单例节点查找 ---
-    image_input_key = find_key_by_class_type(prompt, "GradioInputImage")
-    video_input_key = find_key_by_class_type(prompt, "VHS_LoadVideo")
-    seed_key = find_key_by_class_type(prompt, "Hua_gradio_Seed")
-    text_bad_key = find_key_by_class_type(prompt, "GradioTextBad")
-    fenbianlv_key = find_key_by_class_type(prompt, "Hua_gradio_resolution")
-    checkpoint_key = find_key_by_class_type(prompt, "Hua_CheckpointLoaderSimple")
-    unet_key = find_key_by_class_type(prompt, "Hua_UNETLoader") # 确保类名正确
-    hua_output_key = find_key_by_class_type(prompt, "Hua_Output")
-    hua_video_output_key = find_key_by_class_type(prompt, "Hua_Video_Output")
+    kept_node_ids = compiled_workflow.kept_node_ids(PRUNE_KEEP_CLASS_TYPES) if PRUNE_WORKFLOW else None
+    prompt = compiled_workflow.copy_prompt(kept_node_ids)
+    if kept_node_ids is not None and len(prompt) < len(compiled_workflow.prompt):
+        print(f"[{execution_id}] 工作流剪枝: 保留 {len(prompt)}/{len(compiled_workflow.prompt)} 个节点 (只保留输出节点的上游)")
+
+    # --- 单例节点查找 (预先计算的 class_type 索引，只在剪枝后保留的节点中查找) ---
+    image_input_key = compiled_workflow.first("GradioInputImage", within=prompt)
+    video_input_key = compiled_workflow.first("VHS_LoadVideo", within=prompt)
+    seed_key = compiled_workflow.first("Hua_gradio_Seed", within=prompt)
+    hua_output_key = compiled_workflow.first("Hua_Output", within=prompt)
+    hua_video_output_key = compiled_workflow.first("Hua_Video_Output", within=prompt)
     
+    # 远程后端: 图像和视频输入并发上传 (队列中的任务已是 input_store 句柄)，下面分别等待结果
+    pending_uploads = {}
+    if backend.is_remote:
+        for input_kind, node_key, handle in (("image", image_input_key, inputimage1), ("video", video_input_key, input_video)):
+            if node_key and isinstance(handle, str) and os.path.exists(input_store.path_of(handle)):
+                pending_uploads[input_kind] = remote_transport.upload_input_async(backend, input_store.path_of(handle), os.path.splitext(handle)[1])
+
     inputfilename = None # 初始化
     if image_input_key:
         if inputimage1 is not None:
             try:
-                # 确保 inputimage1 是 PIL Image 对象
-                if isinstance(inputimage1, np.ndarray):
-                    img = Image.fromarray(inputimage1)
-                elif isinstance(inputimage1, Image.Image):
-                    img = inputimage1
+                # 队列中保存的是 input_store 句柄 (input 目录下的文件名)；直接传入 PIL/numpy/路径的调用方在这里转换
+                if not (isinstance(inputimage1, str) and os.path.exists(input_store.path_of(inputimage1))):
+                    inputimage1 = input_store.put(inputimage1)
+                if backend.is_remote:
+                    # 远程后端: 经 /upload/image 上传，文件名同样取内容哈希
+                    upload = pending_uploads.get("image") or remote_transport.upload_input_async(backend, input_store.path_of(inputimage1), os.path.splitext(inputimage1)[1])
+                    inputfilename = upload.result()
+                    print(f"[{execution_id}] 输入图像已上传到 {backend.name}: {inputfilename}")
                 else:
-                    print(f"[{execution_id}] 警告: 未知的输入图像类型: {type(inputimage1)}。尝试跳过图像输入。")
-                    img = None
-
-                if img:
-                    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                    inputfilename = f"gradio_input_{timestamp}_{random.randint(100, 999)}.png"
-                    save_path = os.path.join(INPUT_DIR, inputfilename)
-                    img.save(save_path)
-                    prompt[image_input_key]["inputs"]["image"] = inputfilename
-                    print(f"[{execution_id}] 输入图像已保存到: {save_path}")
+                    inputfilename = inputimage1
+                    print(f"[{execution_id}] 使用输入图像: {input_store.path_of(inputfilename)}")
+                prompt[image_input_key]["inputs"]["image"] = inputfilename
             except Exception as e:
                 print(f"[{execution_id}] 保存输入图像时出错: {e}")
                 # 不设置图像输入，让工作流使用默认值（如果存在）
@@ -456,17 +548,19 @@ def generate_image(
     # --- 处理视频输入 ---
     inputvideofilename = None
     if video_input_key:
-        if input_video is not None and os.path.exists(input_video):
+        if input_video is not None and not os.path.exists(input_store.path_of(input_video)) and os.path.exists(input_video):
+            input_video = input_store.put(input_video) # 直接传入路径的调用方
+        if input_video is not None and os.path.exists(input_store.path_of(input_video)):
             try:
-                # Gradio 返回的是临时文件路径，需要复制到 ComfyUI 的 input 目录
-                timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                # 保留原始扩展名
-                original_ext = os.path.splitext(input_video)[1]
-                inputvideofilename = f"gradio_input_{timestamp}_{random.randint(100, 999)}{original_ext}"
-                dest_path = os.path.join(INPUT_DIR, inputvideofilename)
-                shutil.copy2(input_video, dest_path) # 使用 copy2 保留元数据
+                if backend.is_remote:
+                    # 远程后端: 流式上传到该后端的 input 目录，文件名取内容哈希
+                    upload = pending_uploads.get("video") or remote_transport.upload_input_async(backend, input_store.path_of(input_video), os.path.splitext(input_video)[1])
+                    inputvideofilename = upload.result()
+                    print(f"[{execution_id}] 输入视频已上传到 {backend.name}: {inputvideofilename}")
+                else:
+                    inputvideofilename = input_video
+                    print(f"[{execution_id}] 使用输入视频: {input_store.path_of(inputvideofilename)}")
                 prompt[video_input_key]["inputs"]["video"] = inputvideofilename
-                print(f"[{execution_id}] 输入视频已复制到: {dest_path}")
             except Exception as e:
                 print(f"[{execution_id}] 复制输入视频时出错: {e}")
                 # 清除节点输入，让其使用默认值（如果存在）
@@ -480,7 +574,8 @@ def generate_image(
                  # prompt[video_input_key]["inputs"]["video"] = None
 
     if seed_key:
-        with seed_lock: # 保护对 last_used_seed 的访问
+        with seed_lock: # 保护对 session_seeds 的访问
+            last_used_seed = session_seeds.get(session_id, -1)
             current_seed = 0
             if seed_mode == "随机":
                 current_seed = random.randint(0, 0xffffffff)
@@ -510,87 +605,23 @@ def generate_image(
                 current_seed = random.randint(0, 0xffffffff)
                 last_used_seed = current_seed
                 print(f"[{execution_id}] 未知种子模式 '{seed_mode}'. 回退到随机种子: {current_seed}")
+            session_seeds[session_id] = last_used_seed
 
             prompt[seed_key]["inputs"]["seed"] = current_seed
     
-    # 更新动态正向提示词
-    actual_positive_prompt_nodes = workflow_info["dynamic_components"]["GradioTextOk"]
-    for i, node_info in enumerate(actual_positive_prompt_nodes):
-        if i < len(dynamic_positive_prompts_values):
-            node_id_to_update = node_info["id"]
-            if node_id_to_update in prompt:
-                prompt[node_id_to_update]["inputs"]["string"] = dynamic_positive_prompts_values[i]
-                print(f"[{execution_id}] 更新正向提示节点 {node_id_to_update} (UI组件 {i+1}) 为: '{dynamic_positive_prompts_values[i]}'")
-            else:
-                print(f"[{execution_id}] 警告: 未在prompt中找到正向提示节点ID {node_id_to_update}")
-        else:
-            # 通常不应发生，因为 dynamic_positive_prompts_values 应该与可见组件数量匹配
-            print(f"[{execution_id}] 警告: 正向提示值列表长度不足以覆盖节点 {node_info['id']}")
-
-
-    if text_bad_key: prompt[text_bad_key]["inputs"]["string"] = prompt_text_negative
-
-    if fenbianlv_key:
-        try:
-            width_val = int(hua_width)
-            height_val = int(hua_height)
-            prompt[fenbianlv_key]["inputs"]["custom_width"] = width_val
-            prompt[fenbianlv_key]["inputs"]["custom_height"] = height_val
-            print(f"[{execution_id}] 设置分辨率: {width_val}x{height_val}")
-            # 添加调试信息
-            print(f"[{execution_id}] 分辨率节点ID: {fenbianlv_key}")
-            print(f"[{execution_id}] 分辨率节点输入: {prompt[fenbianlv_key]['inputs']}")
-        except (ValueError, TypeError, KeyError) as e:
-             print(f"[{execution_id}] 更新分辨率时出错: {e}. 使用默认值或跳过。")
-             # 打印当前prompt结构帮助调试
-             print(f"[{execution_id}] 当前prompt结构: {json.dumps(prompt, indent=2, ensure_ascii=False)}")
-
-    # 更新动态Lora模型选择
-    actual_lora_nodes = workflow_info["dynamic_components"]["Hua_LoraLoaderModelOnly"]
-    for i, node_info in enumerate(actual_lora_nodes):
-        if i < len(dynamic_loras_values):
-            node_id_to_update = node_info["id"]
-            lora_name_from_ui = dynamic_loras_values[i]
-            if node_id_to_update in prompt and lora_name_from_ui != "None":
-                prompt[node_id_to_update]["inputs"]["lora_name"] = lora_name_from_ui
-                print(f"[{execution_id}] 更新Lora节点 {node_id_to_update} (UI组件 {i+1}) 为: '{lora_name_from_ui}'")
-            elif lora_name_from_ui == "None":
-                 print(f"[{execution_id}] Lora节点 {node_id_to_update} (UI组件 {i+1}) 选择为 'None'，不更新。")
-            else:
-                print(f"[{execution_id}] 警告: 未在prompt中找到Lora节点ID {node_id_to_update}")
-
-    if checkpoint_key and hua_checkpoint != "None": prompt[checkpoint_key]["inputs"]["ckpt_name"] = hua_checkpoint
-    if unet_key and hua_unet != "None": prompt[unet_key]["inputs"]["unet_name"] = hua_unet
-
-    # 更新动态Int节点输入
-    actual_int_nodes = workflow_info["dynamic_components"]["HuaIntNode"]
-    for i, node_info in enumerate(actual_int_nodes):
-        if i < len(dynamic_int_nodes_values):
-            node_id_to_update = node_info["id"]
-            int_value_from_ui = dynamic_int_nodes_values[i]
-            if node_id_to_update in prompt and int_value_from_ui is not None:
-                try:
-                    prompt[node_id_to_update]["inputs"]["int_value"] = int(int_value_from_ui)
-                    print(f"[{execution_id}] 更新Int节点 {node_id_to_update} (UI组件 {i+1}) 为: {int(int_value_from_ui)}")
-                except (ValueError, TypeError, KeyError) as e:
-                    print(f"[{execution_id}] 更新Int节点 {node_id_to_update} 时出错: {e}. 使用默认值或跳过。")
-            else:
-                 print(f"[{execution_id}] 警告: 未在prompt中找到Int节点ID {node_id_to_update} 或值为None")
-    
-    # 更新动态Float节点输入
-    actual_float_nodes = workflow_info["dynamic_components"]["HuaFloatNode"]
-    for i, node_info in enumerate(actual_float_nodes):
-        if i < len(dynamic_float_nodes_values):
-            node_id_to_update = node_info["id"]
-            float_value_from_ui = dynamic_float_nodes_values[i]
-            if node_id_to_update in prompt and float_value_from_ui is not None:
-                try:
-                    prompt[node_id_to_update]["inputs"]["float_value"] = float(float_value_from_ui)
-                    print(f"[{execution_id}] 更新Float节点 {node_id_to_update} (UI组件 {i+1}) 为: {float(float_value_from_ui)}")
-                except (ValueError, TypeError, KeyError) as e:
-                    print(f"[{execution_id}] 更新Float节点 {node_id_to_update} 时出错: {e}. 使用默认值或跳过。")
-            else:
-                print(f"[{execution_id}] 警告: 未在prompt中找到Float节点ID {node_id_to_update} 或值为None")
+    # 按预先计算的 setters 写入提示词、分辨率、模型、Lora、Int/Float 等 UI 参数
+    applied_count = compiled_workflow.apply_ui_values(prompt, {
+        "dynamic_positive_prompts_values": dynamic_positive_prompts_values,
+        "prompt_text_negative": prompt_text_negative,
+        "hua_width": hua_width,
+        "hua_height": hua_height,
+        "dynamic_loras_values": dynamic_loras_values,
+        "hua_checkpoint": hua_checkpoint,
+        "hua_unet": hua_unet,
+        "dynamic_int_nodes_values": dynamic_int_nodes_values,
+        "dynamic_float_nodes_values": dynamic_float_nodes_values,
+    }, log_prefix=f"[{execution_id}]")
+    print(f"[{execution_id}] 已将 {applied_count} 个 UI 参数写入工作流 {json_file}")
 
     # --- 设置输出节点的 unique_id ---
     if hua_output_key:
@@ -606,141 +637,656 @@ def generate_image(
         return None, None # 如果必须有输出节点才能工作，则返回失败
 
     # --- 发送请求并等待结果 ---
+    # 提交前先登记，输出节点执行时即可把结果直接交付到本进程
+    result_registry.expect(execution_id)
     try:
-        print(f"[{execution_id}] 调用 start_queue 发送请求...")
-        success = start_queue(prompt) # 发送请求到 ComfyUI
-        if not success:
-             print(f"[{execution_id}] 请求发送失败 (start_queue returned False). ComfyUI后端拒绝了任务或发生错误。")
+        print(f"[{execution_id}] 调用 start_queue 发送请求到后端 {backend.name}...")
+        # execution_id 同时作为 prompt_id (客户端生成的幂等键)，重试时不会重复提交
+        prompt_id = start_queue(prompt, client_id=backend.tracker.client_id, backend=backend,
+                                prompt_id=execution_id, maybe_sent=maybe_sent) # 发送请求到 ComfyUI
+        if not prompt_id:
+             print(f"[{execution_id}] 请求发送失败 (start_queue returned None). ComfyUI后端拒绝了任务或发生错误。")
+             backend.last_error = f"{datetime.now().strftime('%H:%M:%S')} 提交失败"
+             result_registry.discard(execution_id)
              return "COMFYUI_REJECTED", None # 特殊返回值表示后端拒绝
-        print(f"[{execution_id}] 请求已发送，开始等待结果...")
+        backend.last_error = None
+        print(f"[{execution_id}] 请求已发送到 {backend.name} (prompt_id: {prompt_id})，开始等待结果...")
+    except BackendUnavailableError as e:
+        print(f"[{execution_id}] {e}，任务将重新排队。")
+        backend.last_error = f"{datetime.now().strftime('%H:%M:%S')} 不可用"
+        result_registry.discard(execution_id)
+        raise # 由调度器放回队列，再分配给就绪的后端
+    except StaleInputError as e:
+        print(f"[{execution_id}] {e}，将重新上传输入后再提交。")
+        result_registry.discard(execution_id)
+        raise
     except Exception as e:
         print(f"[{execution_id}] 调用 start_queue 时发生意外错误: {e}")
+        result_registry.discard(execution_id)
+        return None, None
+
+    return {"execution_id": execution_id, "prompt_id": prompt_id, "output_type": output_type, "backend": backend,
+            "output_node_id": hua_output_key or hua_video_output_key}
+
+def _read_result_file(execution_id, temp_file_path):
+    """读取输出节点写入的 manifest 并删除该文件。文件不存在或批次尚未完成 (complete 为 False) 时返回 None。
+    manifest 是原子写入的，不会读到写了一半的 JSON。"""
+    try:
+        output_paths_data = read_result_manifest(temp_file_path)
+    except (OSError, ValueError) as e:
+        log_message(f"[{execution_id}] 读取或解析临时文件 JSON 失败: {e}")
+        return None
+    if output_paths_data is None or not output_paths_data.get("complete"):
+        return None
+    log_message(f"[{execution_id}] Read manifest v{output_paths_data.get('version')}: {len(output_paths_data.get('generated_files') or [])} 个文件")
+    try:
+        os.remove(temp_file_path)
+        log_message(f"[{execution_id}] 已删除临时文件。")
+    except OSError as e:
+        log_message(f"[{execution_id}] 删除临时文件失败: {e}")
+    return output_paths_data
+
+def _partial_results(execution_id):
+    """队首任务已交付的单张结果: 同进程时来自 result_registry，进程外的输出节点则读取未完成的 manifest。"""
+    partials = result_registry.partial_files(execution_id)
+    if partials:
+        return [item if isinstance(item, str) else _preview_file(execution_id, index, item) for index, item in enumerate(partials)]
+    try:
+        manifest = read_result_manifest(os.path.join(TEMP_DIR, f"{execution_id}.json"))
+    except (OSError, ValueError):
+        return []
+    return list((manifest or {}).get("generated_files") or [])
+
+def _preview_file(execution_id, index, pixels):
+    """把内存中的单张结果编码为 JPEG 预览文件并缓存路径，同一个数组只编码一次 (Gradio 对数组每次推送都要重新编码 PNG)。"""
+    key = (execution_id, index)
+    with preview_files_lock:
+        cached = preview_files.get(key)
+    if cached is not None and cached[0] == id(pixels):
+        return cached[1]
+    path = os.path.join(TEMP_DIR, f"gradio_preview_{execution_id}_{index:05}.jpg")
+    Image.fromarray(pixels).save(path, format="JPEG", quality=PREVIEW_JPEG_QUALITY)
+    with preview_files_lock:
+        preview_files[key] = (id(pixels), path)
+        preview_files.move_to_end(key)
+        while len(preview_files) > MAX_PREVIEW_FILES:
+            preview_files.popitem(last=False)
+    return path
+
+def _result_updates(shown, snapshot, extra_images=()):
+    """结果区的增量推送: 结果仓库版本和附加的单张结果都与上次发送的相同时返回空字典。
+    shown 为上次发送的 (version, extra_images) 或 None，返回 (更新字典, 新的 shown)。"""
+    extra_images = list(extra_images)
+    if shown is not None and shown[0] == snapshot.version and _same_gallery(shown[1], extra_images):
+        return {}, shown
+    updates = {output_gallery: gr.update(value=snapshot.images + extra_images), output_video: gr.update(value=snapshot.video)}
+    return updates, (snapshot.version, extra_images)
+
+def _same_gallery(shown, current):
+    """图库内容是否未变化: 内存中的数组已换成预览文件路径，按字符串比较。"""
+    return shown is not None and len(shown) == len(current) and \
+        all(old is new or (isinstance(old, str) and old == new) for old, new in zip(shown, current))
+
+def _collect_output_paths(execution_id, output_paths_data, output_type):
+    """校验输出节点回传的数据，返回 (determined_output_type, valid_paths)，失败返回 (None, None)。"""
+    log_message(f"[{execution_id}] Parsed JSON data type: {type(output_paths_data)}")
+
+    # --- 检查错误结构 ---
+    if isinstance(output_paths_data, dict) and "error" in output_paths_data:
+        error_message = output_paths_data.get("error", "Unknown error from node.")
+        generated_files = output_paths_data.get("generated_files", [])
+        log_message(f"[{execution_id}] 错误: 节点返回错误: {error_message}. 文件列表 (可能不完整): {generated_files}")
+        return None, None
+
+    # --- 提取路径列表 ---
+    if isinstance(output_paths_data, dict) and "generated_files" in output_paths_data:
+        output_paths = output_paths_data["generated_files"]
+        log_message(f"[{execution_id}] Extracted 'generated_files': {output_paths} (Count: {len(output_paths)})")
+    elif isinstance(output_paths_data, list): # 处理旧格式以防万一
+        output_paths = output_paths_data
+        log_message(f"[{execution_id}] Parsed JSON directly as list: {output_paths} (Count: {len(output_paths)})")
+    else:
+        log_message(f"[{execution_id}] 错误: 无法识别的 JSON 结构。")
+        return None, None
+
+    # --- 详细验证路径 ---
+    log_message(f"[{execution_id}] Starting path validation for {len(output_paths)} paths...")
+    valid_paths = []
+    invalid_paths = []
+    for i, p in enumerate(output_paths):
+        abs_p = os.path.abspath(p)
+        exists = os.path.exists(abs_p)
+        log_message(f"[{execution_id}] Validating path {i+1}/{len(output_paths)}: '{p}' -> Absolute: '{abs_p}' -> Exists: {exists}")
+        if exists:
+            valid_paths.append(abs_p)
+        else:
+            invalid_paths.append(p)
+
+    log_message(f"[{execution_id}] Validation complete. Valid: {len(valid_paths)}, Invalid: {len(invalid_paths)}")
+
+    if not valid_paths:
+        log_message(f"[{execution_id}] 错误: 未找到有效的输出文件路径。Invalid paths were: {invalid_paths}")
         return None, None
 
-    # --- 精确文件获取逻辑 ---
+    first_valid_path = valid_paths[0]
+    if first_valid_path.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.webp', '.bmp')):
+        determined_output_type = 'image'
+    elif first_valid_path.lower().endswith(('.mp4', '.webm', '.avi', '.mov', '.mkv')):
+        determined_output_type = 'video'
+    else:
+        log_message(f"[{execution_id}] 警告: 未知的文件类型: {first_valid_path}。默认为图片。")
+        determined_output_type = 'image'
+
+    if output_type and determined_output_type != output_type:
+         log_message(f"[{execution_id}] 警告: 工作流输出节点类型 ({output_type}) 与实际文件类型 ({determined_output_type}) 不匹配。")
+
+    log_message(f"[{execution_id}] 任务成功完成，返回类型 '{determined_output_type}' 和 {len(valid_paths)} 个有效路径。")
+    return determined_output_type, valid_paths
+
+def _fetch_remote_result(execution_id, backend, prompt_id, output_node_id, history_item=None):
+    """远程后端: 从 /history 读取输出节点的文件并下载到本地缓存。失败或尚无记录时返回 None。"""
+    try:
+        return remote_transport.fetch_outputs(backend, prompt_id, node_id=output_node_id, history_item=history_item)
+    except Exception as e:
+        log_message(f"[{execution_id}] 从远程后端 {backend.name} 获取输出失败: {e}")
+        return None
+
+def wait_for_prompt_result(execution_id, prompt_id, output_type, cancel_token=None, backend=None, output_node_id=None):
+    """等待 prompt 执行结束并取回输出路径。cancel_token 被取消时立即返回 USER_INTERRUPTED。
+    同进程时输出节点通过 result_registry 直接交付结果；完成/错误/中断由该任务所在后端的追踪器通过 /ws 事件即时通知。
+    临时文件 (TEMP_DIR/<execution_id>.json) 仅作为进程外输出节点 (其他本机后端) 或 WebSocket 不可用时的回退。
+    远程后端没有共享文件系统，输出通过 /history + /view 下载 (见 remote_transport)。"""
     temp_file_path = os.path.join(TEMP_DIR, f"{execution_id}.json")
-    # 增加日志，打印 TEMP_DIR 的实际路径
-    log_message(f"[{execution_id}] TEMP_DIR is: {TEMP_DIR}")
-    log_message(f"[{execution_id}] 开始等待临时文件: {temp_file_path}")
+    log_message(f"[{execution_id}] 等待 prompt {prompt_id} 完成，回退结果文件: {temp_file_path}")
 
+    backend = backend or backend_pool.primary
+    job_tracker = backend.tracker
+    last_history_poll = 0 # 远程后端 WebSocket 断开时轮询 /history 的时间
+    result_future = result_registry.expect(execution_id)
+    job_future = job_tracker.watch(prompt_id)
     start_time = time.time()
-    wait_timeout = 1000 # 保持原来的超时
+    wait_timeout = 1000 # 保持原来的超时，仅在既收不到事件也等不到结果时生效
     check_interval = 1
     files_in_temp_dir_logged = False # 标志位，确保只记录一次目录内容
+    wakeup_futures = [result_future, job_future] + ([cancel_token.future] if cancel_token is not None else [])
 
-    while time.time() - start_time < wait_timeout:
-        if os.path.exists(temp_file_path):
-            log_message(f"[{execution_id}] 检测到临时文件 (耗时: {time.time() - start_time:.1f}秒)")
-            try:
-                log_message(f"[{execution_id}] Waiting briefly before reading {temp_file_path}...") # 使用 log_message
-                time.sleep(1.0) # 增加等待时间到 1 秒
-
-                with open(temp_file_path, 'r', encoding='utf-8') as f:
-                    content = f.read()
-                    if not content:
-                        log_message(f"[{execution_id}] 警告: 临时文件为空。") # 使用 log_message
-                        time.sleep(check_interval)
-                        continue
-                    log_message(f"[{execution_id}] Read content: '{content[:200]}...'") # 使用 log_message
-
-                output_paths_data = json.loads(content)
-                log_message(f"[{execution_id}] Parsed JSON data type: {type(output_paths_data)}") # 使用 log_message
-
-                # --- 检查错误结构 ---
-                if isinstance(output_paths_data, dict) and "error" in output_paths_data:
-                    error_message = output_paths_data.get("error", "Unknown error from node.")
-                    generated_files = output_paths_data.get("generated_files", [])
-                    log_message(f"[{execution_id}] 错误: 节点返回错误: {error_message}. 文件列表 (可能不完整): {generated_files}") # 使用 log_message
-                    try:
-                        os.remove(temp_file_path)
-                        log_message(f"[{execution_id}] 已删除包含错误的临时文件。") # 使用 log_message
-                    except OSError as e:
-                        log_message(f"[{execution_id}] 删除包含错误的临时文件失败: {e}") # 使用 log_message
-                    return None, None # 返回失败
-
-                # --- 提取路径列表 ---
-                output_paths = []
-                if isinstance(output_paths_data, dict) and "generated_files" in output_paths_data:
-                    output_paths = output_paths_data["generated_files"]
-                    log_message(f"[{execution_id}] Extracted 'generated_files': {output_paths} (Count: {len(output_paths)})") # 使用 log_message
-                elif isinstance(output_paths_data, list): # 处理旧格式以防万一
-                     output_paths = output_paths_data
-                     log_message(f"[{execution_id}] Parsed JSON directly as list: {output_paths} (Count: {len(output_paths)})") # 使用 log_message
+    try:
+        while time.time() - start_time < wait_timeout:
+            wait_futures(wakeup_futures, timeout=check_interval, return_when=FIRST_COMPLETED)
+
+            if cancel_token is not None and cancel_token.is_cancelled() and not result_future.done():
+                log_message(f"[{execution_id}] 任务已被取消，停止等待 prompt {prompt_id}。")
+                return "USER_INTERRUPTED", None
+
+            # 1. 输出节点已在本进程内交付结果
+            if result_future.done():
+                log_message(f"[{execution_id}] 输出节点已直接交付结果 (耗时: {time.time() - start_time:.1f}秒)")
+                return _collect_output_paths(execution_id, result_future.result(), output_type)
+
+            # 2. ComfyUI 报告 prompt 结束
+            if job_future.done():
+                outcome = job_future.result()
+                log_message(f"[{execution_id}] ComfyUI 报告 prompt {prompt_id} 结束: {outcome['status']} (耗时: {time.time() - start_time:.1f}秒)")
+                if outcome["status"] == JOB_SUCCESS and not backend.is_remote and result_registry.partial_files(execution_id):
+                    # 输出节点以 "先显示后落盘" 模式交付了内存预览，文件仍在后台写入，继续等待最终结果
+                    wait_futures([f for f in wakeup_futures if f is not job_future], timeout=check_interval, return_when=FIRST_COMPLETED)
+                    continue
+                if outcome["status"] != JOB_SUCCESS:
+                    log_message(f"[{execution_id}] 错误: 任务未成功 ({outcome['status']}) 节点 {outcome.get('node_id')} ({outcome.get('node_type')}): {outcome.get('message')}")
+                    if not backend.is_remote and os.path.exists(temp_file_path):
+                        try:
+                            os.remove(temp_file_path) # 清理可能残留的部分结果 (未完成的 manifest)
+                        except OSError as e:
+                            log_message(f"[{execution_id}] 删除临时文件失败: {e}")
+                    return None, None
+                if backend.is_remote:
+                    output_paths_data = _fetch_remote_result(execution_id, backend, prompt_id, output_node_id)
                 else:
-                    log_message(f"[{execution_id}] 错误: 无法识别的 JSON 结构。") # 使用 log_message
-                    try: os.remove(temp_file_path)
-                    except OSError: pass
-                    return None, None # 无法识别的结构
-
-                # --- 详细验证路径 ---
-                log_message(f"[{execution_id}] Starting path validation for {len(output_paths)} paths...") # 使用 log_message
-                valid_paths = []
-                invalid_paths = []
-                for i, p in enumerate(output_paths):
-                    abs_p = os.path.abspath(p)
-                    exists = os.path.exists(abs_p)
-                    log_message(f"[{execution_id}] Validating path {i+1}/{len(output_paths)}: '{p}' -> Absolute: '{abs_p}' -> Exists: {exists}") # 使用 log_message
-                    if exists:
-                        valid_paths.append(abs_p)
-                    else:
-                        invalid_paths.append(p)
-
-                log_message(f"[{execution_id}] Validation complete. Valid: {len(valid_paths)}, Invalid: {len(invalid_paths)}") # 使用 log_message
+                    # 进程外的输出节点在执行结束前已写好临时文件
+                    output_paths_data = _read_result_file(execution_id, temp_file_path)
+                if output_paths_data is None:
+                    log_message(f"[{execution_id}] 错误: 任务已完成，但输出节点没有交付结果。")
+                    return None, None
+                return _collect_output_paths(execution_id, output_paths_data, output_type)
 
+            # 3. 回退: WebSocket 未连接时无法获知完成事件。远程后端轮询 /history，本机后端沿用临时文件轮询
+            if backend.is_remote:
+                if not job_tracker.is_connected() and time.time() - last_history_poll > 2:
+                    last_history_poll = time.time()
+                    try:
+                        history_item = remote_transport.get_history(backend, prompt_id)
+                    except Exception as e:
+                        history_item = None
+                        log_message(f"[{execution_id}] 轮询远程后端 {backend.name} 的 /history 失败: {e}")
+                    if history_item:
+                        log_message(f"[{execution_id}] WebSocket 未连接，/history 中已有 prompt {prompt_id} 的记录 (耗时: {time.time() - start_time:.1f}秒)")
+                        output_paths_data = _fetch_remote_result(execution_id, backend, prompt_id, output_node_id, history_item=history_item)
+                        if output_paths_data is None:
+                            return None, None
+                        return _collect_output_paths(execution_id, output_paths_data, output_type)
+                continue
+            if not job_tracker.is_connected() and os.path.exists(temp_file_path):
+                log_message(f"[{execution_id}] WebSocket 未连接，检测到临时文件 (耗时: {time.time() - start_time:.1f}秒)")
+                output_paths_data = _read_result_file(execution_id, temp_file_path)
+                if output_paths_data is not None:
+                    return _collect_output_paths(execution_id, output_paths_data, output_type)
+
+            # 如果等待超过 N 秒仍未完成，记录一下 TEMP_DIR 的内容，帮助调试
+            if not files_in_temp_dir_logged and not job_tracker.is_connected() and (time.time() - start_time) > 5:
                 try:
-                    os.remove(temp_file_path)
-                    log_message(f"[{execution_id}] 已删除临时文件。") # 使用 log_message
-                except OSError as e:
-                    log_message(f"[{execution_id}] 删除临时文件失败: {e}") # 使用 log_message
+                    temp_dir_contents = os.listdir(TEMP_DIR)
+                    log_message(f"[{execution_id}] 等待超过5秒，TEMP_DIR ('{TEMP_DIR}') 内容: {temp_dir_contents}")
+                except Exception as e_dir:
+                    log_message(f"[{execution_id}] 无法列出 TEMP_DIR 内容: {e_dir}")
+                files_in_temp_dir_logged = True # 避免重复记录
+    finally:
+        result_registry.discard(execution_id)
+        job_tracker.forget(prompt_id)
 
-                if not valid_paths:
-                    log_message(f"[{execution_id}] 错误: 未找到有效的输出文件路径。Invalid paths were: {invalid_paths}") # 使用 log_message
-                    return None, None
+    # 超时处理
+    log_message(f"[{execution_id}] 等待 prompt {prompt_id} 超时 ({wait_timeout}秒)。")
+    return None, None # 超时，返回 None
 
-                first_valid_path = valid_paths[0]
-                if first_valid_path.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.webp', '.bmp')):
-                    determined_output_type = 'image'
-                elif first_valid_path.lower().endswith(('.mp4', '.webm', '.avi', '.mov', '.mkv')):
-                    determined_output_type = 'video'
-                else:
-                    log_message(f"[{execution_id}] 警告: 未知的文件类型: {first_valid_path}。默认为图片。") # 使用 log_message
-                    determined_output_type = 'image'
+# fuck and get_workflow_defaults_and_visibility are now imported from ui_def.
+# The helper find_key_by_class_type_internal was moved to ui_def.py as it's used by them.
 
-                if output_type and determined_output_type != output_type:
-                     log_message(f"[{execution_id}] 警告: 工作流输出节点类型 ({output_type}) 与实际文件类型 ({determined_output_type}) 不匹配。") # 使用 log_message
+# --- 流水线提交辅助函数 ---
+# 队首任务在 ComfyUI 中执行的同时，后续任务已在单线程 executor 中完成准备 (读 JSON、保存输入、修改节点) 并 POST，
+# 使 ComfyUI 自己的队列中始终有 pipeline_depth 个 prompt，GPU 不会在两个任务之间空等。
+# 流水线由任务完成回调驱动 (_finish_job)，不依赖某个会话的生成器，因此一个会话的批量任务不会阻塞其他会话。
+# 任务字典 (task_queue.new_job 创建): job_id, owner (公平调度的用户), session (结果归属的会话), task, batch,
+# cancel_token, state (queued / submitted / running / done / failed / cancelled / rejected), prompt_id, backend, execution_id, future, outcome
+FINISHED_JOB_STATES = ("done", "failed", "cancelled", "rejected")
+
+def _session_of(request):
+    """会话标识: Gradio 的 session_hash (每个浏览器标签页一个)。没有请求上下文时归入共享会话。"""
+    return getattr(request, "session_hash", None) or "shared"
+
+def _owner_of(request):
+    """公平调度按用户计算: 启用登录时为用户名 (同一用户的多个标签页共享配额)，否则为会话。"""
+    return getattr(request, "username", None) or _session_of(request)
+
+def _pipeline_depth():
+    return get_pipeline_depth() * len(backend_pool.backends) # 每个后端各保持 pipeline_depth 个任务
+
+def _count_waiting_tasks_locked(predicate=None):
+    """等待中的任务数 = Gradio 队列 + 已预提交但尚未轮到执行的任务 (可按 predicate 过滤)。调用方需持有 queue_lock。"""
+    prefetched = [job for job in list(pipeline_jobs)[1:] if not job["cancel_token"].is_cancelled()]
+    return task_queue.count(predicate) + sum(1 for job in prefetched if predicate is None or predicate(job))
+
+def _format_wait(seconds):
+    if seconds < 60:
+        return f"约 {int(seconds)} 秒"
+    if seconds < 3600:
+        return f"约 {seconds / 60:.0f} 分钟"
+    return f"约 {seconds / 3600:.1f} 小时"
+
+def _queue_forecast_locked():
+    """
+    按预计执行顺序 (流水线 + 等待队列) 计算每个任务的 (位置, 预计开始前的等待秒数)，
+    以及此时加入的新任务按类别的预计等待。耗时按各类任务的平均值估计，由所有后端并行分担。调用方需持有 queue_lock。
+    """
+    parallel = max(1, len(backend_pool.backends))
+    now = time.time()
+    running = [job for job in pipeline_jobs if not job["cancel_token"].is_cancelled()]
+    queued = task_queue.dispatch_order()
+    forecast = {}
+    backlog = 0.0 # 排在前面的任务预计的总执行时间
+    for position, job in enumerate(running + queued, start=1):
+        forecast[job["job_id"]] = (position, backlog / parallel)
+        estimate = task_queue.estimate_seconds(job["job_class"])
+        if position <= parallel and job.get("dispatched_at"): # 正在执行的任务只计剩余时间
+            estimate = max(0.0, estimate - (now - max(job["dispatched_at"], backend_last_finish.get(job.get("backend"), 0))))
+        backlog += estimate
+        job["_estimate"] = estimate
+    running_backlog = sum(job["_estimate"] for job in running)
+    class_waits = {}
+    for rank, job_class in enumerate(JOB_CLASSES):
+        # 新任务排在同类及更高优先级的等待任务之后 (同类内的轮询可能让它更早开始，这里取保守值)
+        ahead = [job for job in queued if JOB_CLASSES.index(job["job_class"]) <= rank]
+        class_waits[job_class] = (len(ahead), (running_backlog + sum(job["_estimate"] for job in ahead)) / parallel)
+    return forecast, class_waits
+
+def _queue_status_text_locked(session_id, note=""):
+    """会话视角的队列状态: 全部等待数、本会话的等待数、本会话下一个任务的位置和预计等待。调用方需持有 queue_lock。"""
+    mine = lambda job: job["session"] == session_id
+    head_job = pipeline_jobs[0] if pipeline_jobs else None
+    running_text = "是" if processing_event.is_set() else "否"
+    if head_job is not None and mine(head_job):
+        running_text += " (你的任务)"
+    status_text = f"队列中: {_count_waiting_tasks_locked()} (你的: {_count_waiting_tasks_locked(mine)}) | 处理中: {running_text}{note}"
+    if not backend_pool.health_monitor.any_ready():
+        status_text += " | ⏸ 后端未就绪，任务暂停派发"
+    my_waiting = [job for job in list(pipeline_jobs)[1:] + task_queue.dispatch_order()
+                  if mine(job) and not job["cancel_token"].is_cancelled()]
+    if my_waiting:
+        forecast, _ = _queue_forecast_locked()
+        position, wait_seconds = forecast[my_waiting[0]["job_id"]]
+        status_text += f" | 你的下一个任务: 第 {position} 位，预计 {_format_wait(wait_seconds)}后开始"
+    return status_text
+
+def _submit_unless_cancelled(job_entry):
+    if job_entry["cancel_token"].is_cancelled():
+        return "USER_INTERRUPTED", None
+    # 上次提交结果不明的后端仍就绪时优先选择它，先查询是否已收到，避免同一 prompt 在两个后端各执行一次
+    unconfirmed_backend = job_entry.get("unconfirmed_backend")
+    backend = backend_pool.acquire(prefer=unconfirmed_backend) # 最少在途任务的就绪后端，名额在 _await_pipelined_task 结束时释放
+    if backend is None:
+        # 派发后后端变为不可用 (例如 ComfyUI 开始重启): 不在提交线程中等待，由 _finish_job 把任务放回等待队列
+        log_message(f"[QUEUE_DEBUG] No ready backend, returning job {job_entry['job_id']} to the queue.")
+        return "BACKEND_UNAVAILABLE", None
+    job_entry["backend"] = backend
+    submit_id = job_entry.setdefault("submit_id", str(uuid.uuid4())) # 同一任务的每次提交使用同一个 prompt_id
+    return submit_generation(*job_entry["task"], backend=backend, session_id=job_entry["session"],
+                             execution_id=submit_id, maybe_sent=backend is unconfirmed_backend)
+
+def _await_pipelined_task(job_entry, submit_future):
+    """流水线中单个任务的后半段: 等待提交完成，再等待 ComfyUI 执行结果。"""
+    try:
+        try:
+            submitted = submit_future.result()
+        except BackendUnavailableError as e:
+            # 提交失败: 记录可能已收到该 prompt 的后端，放回队列后重新分配 (退避由该后端的断路器负责)
+            job_entry["unconfirmed_backend"] = job_entry.get("backend") if e.maybe_sent else None
+            job_entry.setdefault("unavailable_since", time.time())
+            return "BACKEND_UNAVAILABLE", None
+        except StaleInputError as e:
+            # 远程后端上的输入文件已不存在: 上传记录已清除，放回队列重新准备一次 (会重新上传)，再次失败则视为被拒绝
+            if job_entry.get("inputs_reuploaded"):
+                log_message(f"[QUEUE_DEBUG] Job {job_entry['job_id']} rejected again after re-uploading inputs: {e}")
+                return "COMFYUI_REJECTED", None
+            job_entry["inputs_reuploaded"] = True
+            return "BACKEND_UNAVAILABLE", None
+        except Exception as e:
+            log_message(f"[QUEUE_DEBUG] Exception while submitting task: {e}")
+            return None, None
+        if not isinstance(submitted, dict):
+            return submitted # 提交失败或已取消
+        job_entry["prompt_id"] = submitted["prompt_id"]
+        job_entry["execution_id"] = submitted["execution_id"]
+        job_store.set_state(job_entry["job_id"], None, prompt_id=submitted["prompt_id"], backend=submitted["backend"].address)
+        if task_queue:
+            _refill_pipeline() # 提交成功可能结束了断路器的试探 (half_open -> closed)，立即派发等待中的任务
+        if job_entry["cancel_token"].is_cancelled():
+            # 提交过程中被取消: 从该后端的 ComfyUI 队列中撤回
+            withdraw_comfyui_prompts([(submitted["backend"], submitted["prompt_id"])])
+            result_registry.discard(submitted["execution_id"])
+            return "USER_INTERRUPTED", None
+        return wait_for_prompt_result(submitted["execution_id"], submitted["prompt_id"], submitted["output_type"],
+                                      cancel_token=job_entry["cancel_token"], backend=submitted["backend"],
+                                      output_node_id=submitted["output_node_id"])
+    finally:
+        backend_pool.release(job_entry.get("backend"))
 
-                log_message(f"[{execution_id}] 任务成功完成，返回类型 '{determined_output_type}' 和 {len(valid_paths)} 个有效路径。") # 使用 log_message
-                return determined_output_type, valid_paths
+def _run_pipelined_job(job_entry, submit_future):
+    """result_executor 中的任务主体: 等待结果，然后在同一线程中交付结果并补足流水线。"""
+    try:
+        outcome = _await_pipelined_task(job_entry, submit_future)
+    except Exception as e:
+        log_message(f"[QUEUE_DEBUG] Exception while waiting for task {job_entry['job_id']}: {e}")
+        outcome = None, None
+    _finish_job(job_entry, outcome)
+    return outcome
+
+def _deliver_job_result(job_entry, output_type, new_paths):
+    """成功的结果写入任务所属会话的结果区。"""
+    store = session_results.get(job_entry["session"])
+    if output_type == 'video':
+        store.set_video(new_paths[0]) # 视频只显示最新的一个，同时清除旧图片
+    elif output_type == 'image' and not job_entry["batch"]:
+        store.replace_images(new_paths) # 单任务模式: 替换 (同时清除旧视频)
+    else:
+        if output_type != 'image': # 未知类型 (理论上不应发生，因为 submit_generation 控制了 output_type)
+            log_message(f"[QUEUE_DEBUG] Unknown or unexpected output type '{output_type}'. Treating as image.")
+        store.extend_images(new_paths) # 批量任务模式: 累加到当前批次
+
+def _finish_job(job_entry, outcome):
+    """任务结束 (成功、失败、取消或被后端拒绝): 交付结果、移出流水线、补位，并通知各会话刷新。"""
+    output_type, new_paths = outcome if isinstance(outcome, tuple) else (None, None)
+    if output_type == "BACKEND_UNAVAILABLE" and not job_entry["cancel_token"].is_cancelled():
+        if time.time() - job_entry.get("unavailable_since", time.time()) < SUBMIT_MAX_WAIT_SECONDS:
+            _requeue_job(job_entry)
+            return
+        log_message(f"[QUEUE_DEBUG] Job {job_entry['job_id']} could not be submitted within {SUBMIT_MAX_WAIT_SECONDS}s, giving up.")
+    if job_entry["cancel_token"].is_cancelled() and not new_paths:
+        output_type = "USER_INTERRUPTED"
+    if output_type == "USER_INTERRUPTED":
+        state = "cancelled"
+    elif output_type == "COMFYUI_REJECTED":
+        state = "rejected"
+    elif new_paths:
+        state = "done"
+        _deliver_job_result(job_entry, output_type, new_paths)
+    else:
+        state = "failed"
+    log_message(f"[QUEUE_DEBUG] Job {job_entry['job_id']} finished: {state} (type: {output_type}, paths: {len(new_paths or [])})")
 
-            except json.JSONDecodeError as e:
-                log_message(f"[{execution_id}] 读取或解析临时文件 JSON 失败: {e}. 文件内容: '{content[:100]}...'") # 使用 log_message
-                time.sleep(check_interval * 2)
-            except Exception as e:
-                log_message(f"[{execution_id}] 处理临时文件时发生未知错误: {e}") # 使用 log_message
-                try: os.remove(temp_file_path)
-                except OSError: pass
-                return None, None
+    pipeline_depth = _pipeline_depth()
+    with queue_lock:
+        job_entry["outcome"] = (output_type, new_paths)
+        job_entry["state"] = state
+        if state == "done":
+            job_store.set_state(job_entry["job_id"], state, outputs=[str(path) for path in new_paths])
+        else:
+            job_store.set_state(job_entry["job_id"], state, error=output_type)
+        backend = job_entry.get("backend")
+        if backend is not None:
+            # 执行耗时从进入流水线或同一后端上一个任务结束 (两者较晚者) 算起，排除在 ComfyUI 队列中等待的时间
+            finished_at = time.time()
+            if state in ("done", "failed") and job_entry.get("dispatched_at"):
+                started_at = max(job_entry["dispatched_at"], backend_last_finish.get(backend, 0))
+                task_queue.record_duration(job_entry["job_class"], finished_at - started_at)
+            backend_last_finish[backend] = finished_at
+        if job_entry in pipeline_jobs:
+            pipeline_jobs.remove(job_entry)
+        _fill_pipeline_locked(pipeline_depth)
+        if pipeline_jobs:
+            backend_pool.set_active(pipeline_jobs[0].get("backend")) # 预览和日志跟随队首任务所在的后端
+    queue_state.notify()
+
+def _requeue_job(job_entry):
+    """
+    任务未能提交 (没有就绪的后端或提交失败): 移出流水线并放回等待队列的最前面，不算作结束。
+    之后由 _fill_pipeline_locked 分配给就绪的后端 (提交失败的后端在退避期间不参与分配)。
+    """
+    pipeline_depth = _pipeline_depth()
+    with queue_lock:
+        if job_entry in pipeline_jobs:
+            pipeline_jobs.remove(job_entry)
+        job_entry["state"] = "queued"
+        job_entry["backend"] = None
+        job_entry.pop("dispatched_at", None)
+        task_queue.appendleft(job_entry)
+        job_store.set_state(job_entry["job_id"], "queued")
+        _fill_pipeline_locked(pipeline_depth)
+        if pipeline_jobs:
+            backend_pool.set_active(pipeline_jobs[0].get("backend"))
+    log_message(f"[QUEUE_DEBUG] Job {job_entry['job_id']} returned to the queue (backend unavailable).")
+    queue_state.notify()
+
+def _refill_pipeline():
+    global refill_timer
+    pipeline_depth = _pipeline_depth()
+    with queue_lock:
+        refill_timer = None
+        _fill_pipeline_locked(pipeline_depth)
+    queue_state.notify()
+
+def _schedule_refill_locked():
+    """后端健康但断路器打开时，健康状态不会变化，按断路器允许试探的时间安排一次补位。调用方需持有 queue_lock。"""
+    global refill_timer
+    delay = backend_pool.seconds_until_ready()
+    if delay is None or refill_timer is not None:
+        return # 没有健康的后端: 由 _on_backend_health_change 补位
+    refill_timer = threading.Timer(delay + 0.05, _refill_pipeline)
+    refill_timer.daemon = True
+    refill_timer.start()
+
+def _on_backend_health_change(backend, ready):
+    """健康监视器的监听器: 后端恢复就绪时派发暂停期间留在队列中的任务。"""
+    if ready:
+        _refill_pipeline()
+
+def _fill_pipeline_locked(pipeline_depth):
+    """
+    按加权轮询从 task_queue 取出任务补足流水线，并更新 processing_event。调用方需持有 queue_lock。
+    没有就绪的后端时不取出任务 (留在 task_queue 中，可以照常取消)，由 _on_backend_health_change 在后端恢复时补位，
+    或在断路器允许试探时由 _schedule_refill_locked 安排的定时器补位。
+    """
+    while len(pipeline_jobs) < pipeline_depth and task_queue:
+        if not backend_pool.has_ready():
+            _schedule_refill_locked()
+            break
+        job_entry = task_queue.popleft()
+        job_entry["state"] = "submitted"
+        job_entry["dispatched_at"] = time.time()
+        job_store.set_state(job_entry["job_id"], "submitted")
+        submit_future = executor.submit(_submit_unless_cancelled, job_entry)
+        job_entry["future"] = result_executor.submit(_run_pipelined_job, job_entry, submit_future)
+        pipeline_jobs.append(job_entry)
+        log_message(f"[QUEUE_DEBUG] Job {job_entry['job_id']} (owner {job_entry['owner']}) moved into pipeline. In flight: {len(pipeline_jobs)}/{pipeline_depth}, Gradio queue remaining: {len(task_queue)}")
+    if pipeline_jobs:
+        processing_event.set()
+        head_job = pipeline_jobs[0]
+        if head_job["state"] == "submitted":
+            head_job["state"] = "running" # 队首任务视为正在执行
+            job_store.set_state(head_job["job_id"], "running")
+    else:
+        processing_event.clear()
 
-        # 如果等待超过 N 秒仍未找到文件，记录一下 TEMP_DIR 的内容，帮助调试
-        if not files_in_temp_dir_logged and (time.time() - start_time) > 5: # 例如等待5秒后
-            try:
-                temp_dir_contents = os.listdir(TEMP_DIR)
-                log_message(f"[{execution_id}] 等待超过5秒，TEMP_DIR ('{TEMP_DIR}') 内容: {temp_dir_contents}")
-            except Exception as e_dir:
-                log_message(f"[{execution_id}] 无法列出 TEMP_DIR 内容: {e_dir}")
-            files_in_temp_dir_logged = True # 避免重复记录
+backend_pool.health_monitor.add_listener(_on_backend_health_change)
+
+def _cancel_jobs_locked(predicate, include_head=False, reason="queue cleared"):
+    """
+    取消满足 predicate 的等待任务和已预提交任务 (include_head 时也包括流水线队首)。
+    流水线中的任务由取消令牌结束，随后由 _finish_job 移出。
+    返回 (取消的任务数, 需要撤回的 (backend, prompt_id) 列表)。调用方需持有 queue_lock。
+    """
+    removed = task_queue.clear(predicate)
+    for job_entry in removed:
+        job_entry["state"] = "cancelled"
+    job_store.set_state([job_entry["job_id"] for job_entry in removed], "cancelled")
+    cancelled_count = len(removed)
+    backend_prompt_pairs = []
+    for index, job_entry in enumerate(list(pipeline_jobs)):
+        if (index == 0 and not include_head) or not predicate(job_entry):
+            continue
+        if job_entry["cancel_token"].cancel(reason):
+            cancelled_count += 1
+            if job_entry.get("prompt_id"):
+                backend_prompt_pairs.append((job_entry.get("backend"), job_entry["prompt_id"]))
+    return cancelled_count, backend_prompt_pairs
+
+def _find_job_locked(job_id):
+    """按 job_id 查找流水线或等待队列中的任务。调用方需持有 queue_lock。"""
+    for job_entry in list(pipeline_jobs) + task_queue.dispatch_order():
+        if job_entry["job_id"] == job_id:
+            return job_entry
+    return None
 
-        time.sleep(check_interval)
+def _workflow_has_ksampler(json_file):
+    """工作流中有 KSampler 类节点时，执行期间切换到实时预览页。"""
+    if not json_file or not isinstance(json_file, str):
+        return False
+    compiled_workflow = workflow_cache.get(json_file, OUTPUT_DIR)
+    VALID_KSAMPLER_CLASS_TYPES = ["KSampler", "KSamplerAdvanced", "KSamplerSelect"]
+    return compiled_workflow is not None and compiled_workflow.has_any(VALID_KSAMPLER_CLASS_TYPES)
 
-    # 超时处理
-    log_message(f"[{execution_id}] 等待临时文件超时 ({wait_timeout}秒)。TEMP_DIR ('{TEMP_DIR}') 最终内容可能已在上面记录。") # 使用 log_message
-    return None, None # 超时，返回 None
+def _store_task_inputs(inputimage1, input_video):
+    """输入文件按内容哈希保存一次，返回句柄 (input 目录下的文件名)。涉及哈希和复制文件，在线程中执行。"""
+    try:
+        inputimage1 = input_store.put(inputimage1)
+        if inputimage1 and any(not b.is_remote for b in backend_pool.backends):
+            # 本进程的 ComfyUI 会执行该任务时，在后台预解码为张量，GradioInputImage 不必再解码文件
+            input_tensor_store.prefetch(inputimage1, input_store.path_of(inputimage1))
+    except Exception as e:
+        log_message(f"[QUEUE_DEBUG] 保存输入图像失败: {e}")
+        inputimage1 = None
+    try:
+        input_video = input_store.put(input_video) if input_video and os.path.exists(input_video) else None
+    except Exception as e:
+        log_message(f"[QUEUE_DEBUG] 保存输入视频失败: {e}")
+        input_video = None
+    return inputimage1, input_video
+
+def recover_persisted_jobs():
+    """
+    恢复上次进程退出 (重启 ComfyUI、OOM 崩溃等) 时未完成的任务，按原来的入队顺序重新排队。
+    已提交到 ComfyUI 的 prompt 随进程一起丢失，重新提交；输入文件已不存在或多次恢复仍未完成的任务标记为失败。
+    恢复的任务原来的浏览器会话已不存在，结果只保存在输出目录 ("预览所有输出图片")。
+    """
+    recovered = []
+    for record in job_store.load_unfinished():
+        attempts = record["attempts"] + (0 if record["state"] == "queued" else 1)
+        missing_inputs = [handle for handle in record["input_hashes"] if handle and not os.path.exists(input_store.path_of(handle))]
+        if missing_inputs or attempts > MAX_RECOVERY_ATTEMPTS:
+            error = f"输入文件已不存在: {missing_inputs}" if missing_inputs else f"进程退出时任务未完成，已达到最大恢复次数 ({MAX_RECOVERY_ATTEMPTS})"
+            log_message(f"[JOB_RECOVERY] 任务 {record['job_id']} 不再恢复: {error}")
+            job_store.set_state(record["job_id"], "failed", error=error, attempts=attempts)
+            continue
+        job = task_queue.new_job(record["owner"], record["session"], record_to_task(record["params"]), record["job_class"],
+                                 job_id=record["job_id"], batch=bool(record["batch"]), user_label=record["user_label"],
+                                 cancel_token=CancelToken(), state="queued", prompt_id=None, recovered=True)
+        job_store.set_state(job["job_id"], "queued", attempts=attempts)
+        recovered.append(job)
+    if not recovered:
+        return 0
+    pipeline_depth = _pipeline_depth()
+    with queue_lock:
+        for job in recovered:
+            task_queue.append(job)
+        _fill_pipeline_locked(pipeline_depth)
+    queue_state.notify()
+    log_message(f"[JOB_RECOVERY] 已恢复 {len(recovered)} 个未完成的任务。")
+    return len(recovered)
+
+def _recover_jobs_when_ready():
+    """启动时在后台等待任一后端就绪 (ComfyUI 自身可能还在加载)，然后恢复任务。"""
+    backend_pool.health_monitor.wait_until_ready(timeout=RECOVERY_WAIT_SECONDS)
+    try:
+        recover_persisted_jobs()
+    except Exception as e:
+        log_message(f"[JOB_RECOVERY] 恢复任务失败: {e}")
 
-# fuck and get_workflow_defaults_and_visibility are now imported from ui_def.
-# The helper find_key_by_class_type_internal was moved to ui_def.py as it's used by them.
+# 各结束状态在会话状态栏中的提示
+JOB_STATE_NOTES = {"done": " (完成)", "failed": " (失败)", "cancelled": " (已中断)", "rejected": " (后端拒绝了任务)"}
+
+# 以下两个函数需要持有 queue_lock，并会读取设置文件、manifest 和工作流缓存，由 run_queued_tasks 通过 asyncio.to_thread 调用，不阻塞事件循环
+def _enqueue_session_jobs(session_id, jobs):
+    """把会话的新任务加入公平队列并补足流水线，返回会话的状态栏文字。"""
+    pipeline_depth = _pipeline_depth()
+    with queue_lock:
+        for job in jobs:
+            task_queue.append(job)
+        _fill_pipeline_locked(pipeline_depth) # 空闲时立即开始执行，否则按轮询顺序等待
+        return _queue_status_text_locked(session_id)
+
+def _session_progress(session_id, my_jobs, finished_ids, note, announced_job):
+    """
+    会话的任务进度: (本会话的队首任务或 None, 新结束的任务, 未结束的任务数, 队首任务已交付的单张结果,
+    状态提示, 状态栏文字, 是否切换到实时预览页)。
+    """
+    with queue_lock:
+        head_job = pipeline_jobs[0] if pipeline_jobs else None
+        newly_finished = [job for job in my_jobs if job["state"] in FINISHED_JOB_STATES and job["job_id"] not in finished_ids]
+        pending_count = sum(1 for job in my_jobs if job["state"] not in FINISHED_JOB_STATES)
+    for job in newly_finished:
+        note = JOB_STATE_NOTES[job["state"]]
+    my_head = head_job if head_job is not None and head_job["session"] == session_id else None
+    # 本会话的任务成为队首时，工作流中有 KSampler 类节点则切换到实时预览页 (json_file 位于任务元组的索引 4)
+    show_preview = my_head is not None and my_head is not announced_job and _workflow_has_ksampler(my_head["task"][4])
+    partial_images = _partial_results(my_head["execution_id"]) if my_head is not None and my_head.get("execution_id") else []
+    with queue_lock:
+        status_text = _queue_status_text_locked(session_id, note)
+    return my_head, newly_finished, pending_count, partial_images, note, status_text, show_preview
+
+def _session_status_text(session_id, note=""):
+    with queue_lock:
+        return _queue_status_text_locked(session_id, note)
 
 # --- 队列处理函数 (更新签名以包含动态组件列表) ---
-def run_queued_tasks(
+# async 生成器: 把本会话的任务加入公平队列，然后只跟踪本会话的任务，在状态真正变化时 yield
+async def run_queued_tasks(
     inputimage1, input_video, 
     # Capture all dynamic positive prompts using *args or by naming them if MAX_DYNAMIC_COMPONENTS is fixed
     # Assuming run_button.click inputs are: input_image, input_video, *positive_prompt_texts, prompt_negative, ...
@@ -776,28 +1322,26 @@ def run_queued_tasks(
     dynamic_float_1, dynamic_float_2, dynamic_float_3, dynamic_float_4, dynamic_float_5, # From *float_inputs
     dynamic_int_1, dynamic_int_2, dynamic_int_3, dynamic_int_4, dynamic_int_5,         # From *int_inputs
     seed_mode, fixed_seed, 
-    queue_count=1, progress=gr.Progress(track_tqdm=True)
+    queue_count=1, job_class="auto", progress=gr.Progress(track_tqdm=True), request: gr.Request = None
 ):
-    global accumulated_image_results, last_video_result, executor
-
     # Reconstruct lists for dynamic components
     dynamic_positive_prompts_values = [dynamic_prompt_1, dynamic_prompt_2, dynamic_prompt_3, dynamic_prompt_4, dynamic_prompt_5]
     dynamic_loras_values = [dynamic_lora_1, dynamic_lora_2, dynamic_lora_3, dynamic_lora_4, dynamic_lora_5]
     dynamic_float_nodes_values = [dynamic_float_1, dynamic_float_2, dynamic_float_3, dynamic_float_4, dynamic_float_5]
     dynamic_int_nodes_values = [dynamic_int_1, dynamic_int_2, dynamic_int_3, dynamic_int_4, dynamic_int_5]
 
-    current_batch_image_results = []
+    session_id, owner = _session_of(request), _owner_of(request)
+    store = session_results.get(session_id) # 本会话的结果区，其他标签页的结果不会出现在这里
 
     # 1. 将新任务加入队列
     if queue_count > 1:
-        with results_lock:
-            accumulated_image_results = []
-            current_batch_image_results = []
-            last_video_result = None # 批量任务开始时清除旧视频
+        store.start_batch() # 批量任务开始时清除旧图片和视频
     elif queue_count == 1:
-         # 单任务模式，清除旧视频结果，图片结果将在成功后直接替换
-         with results_lock:
-             last_video_result = None
+        # 单任务模式，清除旧视频结果，图片结果将在成功后直接替换
+        store.clear_video()
+
+    # 输入文件按内容哈希保存一次，任务元组中只保存句柄 (input 目录下的文件名)，排队多份也不复制图像
+    inputimage1, input_video = await asyncio.to_thread(_store_task_inputs, inputimage1, input_video)
 
     # 将所有参数打包到 task_params_tuple for generate_image
     task_params_tuple = (
@@ -812,248 +1356,75 @@ def run_queued_tasks(
         dynamic_int_nodes_values,        # Pass the list
         seed_mode, fixed_seed
     )
-    log_message(f"[QUEUE_DEBUG] 接收到新任务请求 (种子模式: {seed_mode})。当前队列长度 (加锁前): {len(task_queue)}")
-    with queue_lock:
-        for _ in range(max(1, int(queue_count))):
-            task_queue.append(task_params_tuple) 
-        current_queue_size = len(task_queue)
-        log_message(f"[QUEUE_DEBUG] 已添加 {queue_count} 个任务到队列。当前队列长度 (加锁后): {current_queue_size}")
-    log_message(f"[QUEUE_DEBUG] 任务添加完成，释放锁。")
-
-    # 初始状态更新：显示当前累积结果和队列信息
-    # Default to results tab initially
+    job_class = classify_job(job_class, queue_count) # 交互 / 批量 / 后台，决定出队优先级
+    my_jobs = [task_queue.new_job(owner, session_id, task_params_tuple, job_class, batch=queue_count > 1,
+                                  user_label=getattr(request, "username", None),
+                                  cancel_token=CancelToken(), state="queued", prompt_id=None)
+               for _ in range(max(1, int(queue_count)))]
+    job_store.add_jobs(my_jobs) # 先持久化再入队 (写入在后台线程中按顺序执行，不阻塞事件循环)
+    shown_status = await asyncio.to_thread(_enqueue_session_jobs, session_id, my_jobs)
+    log_message(f"[QUEUE_DEBUG] 会话 {session_id} (用户 {owner}) 添加了 {len(my_jobs)} 个{JOB_CLASS_LABELS[job_class]}任务 (种子模式: {seed_mode})。{shown_status}")
+    queue_state.notify() # 其他会话需要刷新队列长度
+
+    # 初始状态更新：显示本会话的结果和队列信息
     initial_updates = {
-        queue_status_display: gr.update(value=f"队列中: {current_queue_size} | 处理中: {'是' if processing_event.is_set() else '否'}"),
+        queue_status_display: gr.update(value=shown_status),
         main_output_tabs_component: gr.Tabs(selected="tab_generate_result") # Default to results tab
     }
-    with results_lock:
-        initial_updates[output_gallery] = gr.update(value=accumulated_image_results[:])
-        initial_updates[output_video] = gr.update(value=last_video_result)
-
-    log_message(f"[QUEUE_DEBUG] 准备 yield 初始状态更新。队列: {current_queue_size}, 处理中: {processing_event.is_set()}")
+    result_updates, shown_results = _result_updates(None, store.snapshot()) # shown_results: 本会话上次发送的结果版本
+    initial_updates.update(result_updates)
     yield initial_updates
-    log_message(f"[QUEUE_DEBUG] 已 yield 初始状态更新。")
-
-    # 2. 检查是否已有进程在处理队列
-    log_message(f"[QUEUE_DEBUG] 检查处理状态: processing_event.is_set() = {processing_event.is_set()}")
-    if processing_event.is_set():
-        log_message("[QUEUE_DEBUG] 已有任务在处理队列，新任务已排队。函数返回。")
-        return
-
-    # 3. 开始处理队列
-    log_message(f"[QUEUE_DEBUG] 没有任务在处理，准备设置 processing_event 为 True。")
-    processing_event.set()
-    log_message(f"[QUEUE_DEBUG] processing_event 已设置为 True。开始处理循环。")
-
-    def process_task(task_params):
-        try:
-            output_type, new_paths = generate_image(*task_params)
-            return output_type, new_paths
-        except Exception as e:
-            log_message(f"[QUEUE_DEBUG] Exception in process_task: {e}")
-            return None, None
 
+    announced_job = None # 已为其切换预览页的队首任务
+    finished_ids = set()
+    note = ""
+    seen_version = -1 # 首轮立即刷新
     try:
-        log_message("[QUEUE_DEBUG] Entering main processing loop (while True).")
+        # 等待本会话的任务全部结束: 由任务完成、入队、取消和结果交付的通知唤醒，没有通知时每 STATE_REFRESH_INTERVAL 秒兜底刷新一次
         while True:
-            task_to_run = None
-            current_queue_size = 0
-            log_message("[QUEUE_DEBUG] Checking queue for tasks (acquiring lock)...")
-            with queue_lock:
-                if task_queue:
-                    task_to_run = task_queue.popleft()
-                    current_queue_size = len(task_queue)
-                    log_message(f"[QUEUE_DEBUG] Task popped from queue. Remaining: {current_queue_size}")
-                else:
-                    log_message("[QUEUE_DEBUG] Queue is empty. Breaking loop.")
-                    break
-            log_message("[QUEUE_DEBUG] Queue lock released.")
-
-            if not task_to_run:
-                 log_message("[QUEUE_DEBUG] Warning: No task found after lock release, but loop didn't break?")
-                 continue
-
-            # 更新状态：显示正在处理和队列大小
-            with results_lock:
-                current_images_copy = accumulated_image_results[:]
-                current_video = last_video_result
-            log_message(f"[QUEUE_DEBUG] Preparing to yield 'Processing' status. Queue: {current_queue_size}")
-            yield {
-                queue_status_display: gr.update(value=f"队列中: {current_queue_size} | 处理中: 是"),
-                output_gallery: gr.update(value=current_images_copy),
-                output_video: gr.update(value=current_video)
-            }
-            log_message(f"[QUEUE_DEBUG] Yielded 'Processing' status.")
-
-            if task_to_run:
-                log_message(f"[QUEUE_DEBUG] Starting execution for popped task. Remaining queue: {current_queue_size}")
-                
-                # --- KSampler Check and Tab Switch ---
-                # task_to_run is the tuple: (inputimage1, input_video, dynamic_positive_prompts_values, 
-                #                           prompt_text_negative, json_file, hua_width, hua_height, 
-                #                           dynamic_loras_values, ...)
-                # json_file is at index 4 of task_to_run (0-indexed)
-                current_task_json_file = task_to_run[4] 
-                should_switch_to_preview = False
-                if current_task_json_file and isinstance(current_task_json_file, str): # Ensure it's a string before using
-                    json_path_for_check = os.path.join(OUTPUT_DIR, current_task_json_file)
-                    if os.path.exists(json_path_for_check):
-                        try:
-                            with open(json_path_for_check, "r", encoding="utf-8") as f_check:
-                                workflow_prompt = json.load(f_check)
-                            VALID_KSAMPLER_CLASS_TYPES = ["KSampler", "KSamplerAdvanced", "KSamplerSelect"]
-                            for node_id, node_data in workflow_prompt.items():
-                                class_type = node_data.get("class_type")
-                                if isinstance(node_data, dict) and class_type in VALID_KSAMPLER_CLASS_TYPES:
-                                    should_switch_to_preview = True
-                                    log_message(f"[QUEUE_DEBUG] KSampler-like node (type: {class_type}) found in {current_task_json_file}. Will switch to preview tab.")
-                                    break
-                        except Exception as e_json_check:
-                            log_message(f"[QUEUE_DEBUG] Error checking for KSampler in {current_task_json_file}: {e_json_check}")
-                
-                if should_switch_to_preview:
-                    yield { main_output_tabs_component: gr.Tabs(selected="tab_k_sampler_preview") }
-                # --- End KSampler Check ---
-
-                progress(0, desc=f"处理任务 (队列剩余 {current_queue_size})")
-                log_message(f"[QUEUE_DEBUG] Progress set to 0. Desc: Processing task (Queue remaining {current_queue_size})")
-                
-                # 提交任务到线程池
-                future = executor.submit(process_task, task_to_run)
-                log_message(f"[QUEUE_DEBUG] Task submitted to thread pool")
-
-                task_interrupted_by_user = False
-                # 等待任务完成，但每0.1秒检查一次，并检查中断信号
-                while not future.done():
-                    if interrupt_requested_event.is_set():
-                        log_message("[QUEUE_DEBUG] User interrupt detected while waiting for future.")
-                        task_interrupted_by_user = True
-                        break
-                    time.sleep(0.1)
-                    # 在等待期间，也需要从 results_lock 中获取最新的累积结果
-                    with results_lock:
-                        current_images_while_waiting = accumulated_image_results[:]
-                        current_video_while_waiting = last_video_result
-                    yield {
-                        queue_status_display: gr.update(value=f"队列中: {current_queue_size} | 处理中: 是 (运行中)"),
-                        output_gallery: gr.update(value=current_images_while_waiting),
-                        output_video: gr.update(value=current_video_while_waiting)
-                    }
-                
-                if task_interrupted_by_user:
-                    log_message("[QUEUE_DEBUG] Task was interrupted by user. Setting result to USER_INTERRUPTED.")
-                    output_type, new_paths = "USER_INTERRUPTED", None
-                    interrupt_requested_event.clear() # 清除标志
-
-                    # --- 新增：尝试重置 executor ---
-                    # global executor # 已在函数顶部声明
-                    log_message("[QUEUE_DEBUG] Attempting to shutdown and recreate executor due to user interrupt.")
-                    executor.shutdown(wait=False) 
-                    executor = ThreadPoolExecutor(max_workers=1)
-                    log_message("[QUEUE_DEBUG] Executor shutdown and recreated.")
-                    # --- 新增结束 ---
-                else:
-                    try:
-                        output_type, new_paths = future.result()
-                        log_message(f"[QUEUE_DEBUG] Future completed. Type: {output_type}, Paths: {'Yes' if new_paths else 'No'}")
-                    except Exception as e:
-                        log_message(f"[QUEUE_DEBUG] Exception when getting future result: {e}")
-                        output_type, new_paths = None, None # 任务执行出错
-                
-                progress(1) # 任务完成（无论成功与否，或被中断）
-                log_message(f"[QUEUE_DEBUG] Progress set to 1.")
-
-                if output_type == "USER_INTERRUPTED":
-                    log_message("[QUEUE_DEBUG] Task was interrupted by user. Updating UI.")
-                    # current_queue_size 已经是最新的（在 task_to_run = task_queue.popleft() 之后）
-                    with results_lock:
-                        current_images_copy = accumulated_image_results[:]
-                        current_video = last_video_result
-                    yield {
-                        queue_status_display: gr.update(value=f"队列中: {current_queue_size} | 处理中: 否 (已中断)"),
-                        output_gallery: gr.update(value=current_images_copy),
-                        output_video: gr.update(value=current_video),
-                    }
-                    log_message(f"[QUEUE_DEBUG] Yielded USER_INTERRUPTED update. Queue: {current_queue_size}")
-                    # 让循环继续，以便 finally 块可以正确清理 processing_event
-                    # 如果这是最后一个任务，循环会在下一次迭代时自然结束
-
-                elif output_type == "COMFYUI_REJECTED":
-                    log_message("[QUEUE_DEBUG] Task rejected by ComfyUI backend or critical error in start_queue. Clearing remaining Gradio queue.")
-                    with queue_lock:
-                        task_queue.clear() # 清空Gradio队列中所有剩余任务
-                        current_queue_size = len(task_queue) # 应为0
-                    with results_lock:
-                        current_images_copy = accumulated_image_results[:]
-                        current_video = last_video_result
-                    log_message(f"[QUEUE_DEBUG] Preparing to yield COMFYUI_REJECTED update. Queue: {current_queue_size}")
-                    yield {
-                         queue_status_display: gr.update(value=f"队列中: {current_queue_size} | 处理中: 是 (后端错误，队列已清空)"),
-                         output_gallery: gr.update(value=current_images_copy),
-                         output_video: gr.update(value=current_video),
-                    }
-                    log_message(f"[QUEUE_DEBUG] Yielded COMFYUI_REJECTED update. Loop will now check empty queue and exit to finally.")
-                
-                elif new_paths: # 任务成功且有结果 (output_type 不是 COMFYUI_REJECTED or USER_INTERRUPTED)
-                    log_message(f"[QUEUE_DEBUG] Task successful, got {len(new_paths)} new paths of type '{output_type}'.")
-                    update_dict = {}
-                    with results_lock:
-                        if output_type == 'image':
-                            if queue_count == 1: # 单任务模式
-                                accumulated_image_results = new_paths # 替换
-                            else: # 批量任务模式
-                                current_batch_image_results.extend(new_paths) # 累加到当前批次
-                                accumulated_image_results = current_batch_image_results[:] # 更新全局累积结果
-                            last_video_result = None # 清除旧视频（如果是图片任务）
-                            update_dict[output_gallery] = gr.update(value=accumulated_image_results[:], visible=True)
-                            update_dict[output_video] = gr.update(value=None, visible=False) # 隐藏视频输出
-                        elif output_type == 'video':
-                            last_video_result = new_paths[0] if new_paths else None # 视频只显示最新的一个
-                            accumulated_image_results = [] # 清除旧图片（如果是视频任务）
-                            update_dict[output_gallery] = gr.update(value=[], visible=False) # 隐藏图片输出
-                            update_dict[output_video] = gr.update(value=last_video_result, visible=True) # 显示视频输出
-                        else: # 未知类型 (理论上不应发生，因为 generate_image 控制了 output_type)
-                             log_message(f"[QUEUE_DEBUG] Unknown or unexpected output type '{output_type}'. Treating as image.")
-                             # 默认为图片处理或保持原样
-                             accumulated_image_results.extend(new_paths) # 尝试添加
-                             update_dict[output_gallery] = gr.update(value=accumulated_image_results[:])
-                             update_dict[output_video] = gr.update(value=last_video_result)
-
-                        log_message(f"[QUEUE_DEBUG] Updated results (lock acquired). Images: {len(accumulated_image_results)}, Video: {last_video_result is not None}")
-
-                    update_dict[queue_status_display] = gr.update(value=f"队列中: {current_queue_size} | 处理中: 是 (完成)")
-                    log_message(f"[QUEUE_DEBUG] Preparing to yield success update. Queue: {current_queue_size}")
-                    yield update_dict
-                    log_message(f"[QUEUE_DEBUG] Yielded success update.")
-                else: # 任务失败 (output_type is None, or new_paths is None/empty but not COMFYUI_REJECTED)
-                    log_message("[QUEUE_DEBUG] Task failed or returned no paths (general failure, not COMFYUI_REJECTED).")
-                    with results_lock:
-                        current_images_copy = accumulated_image_results[:]
-                        current_video = last_video_result
-                    log_message(f"[QUEUE_DEBUG] Preparing to yield general failure update. Queue: {current_queue_size}")
-                    yield {
-                         queue_status_display: gr.update(value=f"队列中: {current_queue_size} | 处理中: 是 (失败)"),
-                         output_gallery: gr.update(value=current_images_copy),
-                         output_video: gr.update(value=current_video),
-                    }
-                    log_message(f"[QUEUE_DEBUG] Yielded general failure update.")
-
+            my_head, newly_finished, pending_count, partial_images, note, status_text, show_preview = await asyncio.to_thread(
+                _session_progress, session_id, my_jobs, set(finished_ids), note, announced_job)
+            updates = {}
+            for job in newly_finished:
+                finished_ids.add(job["job_id"])
+                if job["state"] == "done":
+                    is_video = job["outcome"][0] == 'video'
+                    updates[output_gallery] = gr.update(visible=not is_video)
+                    updates[output_video] = gr.update(visible=is_video)
+            if not pending_count:
+                break
+
+            # 本会话的任务成为队首时切换到实时预览页
+            if my_head is not None and announced_job is not my_head:
+                announced_job = my_head
+                if show_preview:
+                    log_message(f"[QUEUE_DEBUG] KSampler-like node found in {my_head['task'][4]}. Will switch to preview tab.")
+                    updates[main_output_tabs_component] = gr.Tabs(selected="tab_k_sampler_preview")
+
+            # 输出节点已交付的单张结果 (批量输出时逐张出现；"先显示后落盘" 时先为内存中的数组，写完后换成文件路径)
+            result_updates, shown_results = _result_updates(shown_results, store.snapshot(), partial_images)
+            for component, update in result_updates.items():
+                updates[component] = {**updates[component], **update} if component in updates else update
+            if status_text != shown_status:
+                shown_status = status_text
+                updates[queue_status_display] = gr.update(value=status_text)
+            if updates:
+                yield updates
+            progress(len(finished_ids) / len(my_jobs), desc=f"处理任务 (你的队列剩余 {pending_count})")
+
+            seen_version = await queue_state.wait_for_change(seen_version, timeout=STATE_REFRESH_INTERVAL)
     finally:
-        log_message(f"[QUEUE_DEBUG] Entering finally block. Clearing processing_event (was {processing_event.is_set()}).")
-        processing_event.clear()
-        log_message(f"[QUEUE_DEBUG] processing_event cleared (is now {processing_event.is_set()}).")
-        with queue_lock: current_queue_size = len(task_queue)
-        with results_lock:
-            final_images = accumulated_image_results[:]
-            final_video = last_video_result
-        log_message(f"[QUEUE_DEBUG] Preparing to yield final status update. Queue: {current_queue_size}, Processing: No. Switching to results tab.")
+        status_text = await asyncio.to_thread(_session_status_text, session_id, note)
+        snapshot = store.snapshot()
+        result_updates, shown_results = _result_updates(shown_results, snapshot)
+        if snapshot.paged_out:
+            status_text += f" | 图库仅保留最近 {len(snapshot.images)} 张"
+        log_message(f"[QUEUE_DEBUG] 会话 {session_id} 的任务已全部结束。{status_text}")
         yield {
-            queue_status_display: gr.update(value=f"队列中: {current_queue_size} | 处理中: 否"),
-            output_gallery: gr.update(value=final_images),
-            output_video: gr.update(value=final_video),
+            queue_status_display: gr.update(value=status_text),
+            **result_updates,
             main_output_tabs_component: gr.Tabs(selected="tab_generate_result") # Switch back to results tab
         }
-        log_message("[QUEUE_DEBUG] Yielded final status update. Exiting run_queued_tasks.")
 
 # --- 赞助码处理函数 ---
 def show_sponsor_code():
@@ -1062,80 +1433,116 @@ def show_sponsor_code():
     return gr.update(value=sponsor_info, visible=True)
 
 # --- 清除函数 ---
-def clear_queue():
-    global task_queue, queue_lock, interrupt_requested_event, processing_event
-    
+def clear_queue(request: gr.Request = None):
+    """
+    只作用于当前会话的任务:
+    本会话有等待中的任务 (Gradio 队列或已预提交) 时清除它们，不中断正在执行的任务；
+    否则中断本会话正在执行的任务。其他会话的任务不受影响。
+    """
+    session_id = _session_of(request)
+    mine = lambda job: job["session"] == session_id
     action_log_messages = [] # 用于 gr.Info()
 
     with queue_lock:
-        is_currently_processing_a_task_in_comfyui = processing_event.is_set()
-        num_tasks_waiting_in_gradio_queue = len(task_queue)
-
-        log_message(f"[CLEAR_QUEUE] Entry. Gradio pending queue size: {num_tasks_waiting_in_gradio_queue}, ComfyUI processing active: {is_currently_processing_a_task_in_comfyui}")
-
-        if is_currently_processing_a_task_in_comfyui and num_tasks_waiting_in_gradio_queue == 0:
-            # 情况1: ComfyUI 正在处理一个任务 (该任务已从Gradio队列取出，在executor中运行), 
-            # 且 Gradio 的等待队列为空。这是“仅剩当前任务”的情况，需要中断它。
-            log_message("[CLEAR_QUEUE] Action: Interrupting the single, currently running ComfyUI task.")
-            
-            # 发送 HTTP 中断请求到 ComfyUI
-            interrupt_comfyui_status_message = trigger_comfyui_interrupt() 
-            action_log_messages.append(f"尝试中断 ComfyUI 当前任务: {interrupt_comfyui_status_message}")
-            log_message(f"[CLEAR_QUEUE] ComfyUI interrupt triggered via HTTP: {interrupt_comfyui_status_message}")
-
-            # 设置 Gradio 内部的中断标志。
-            # run_queued_tasks 中的循环会检测到这个事件，并为正在运行的 future 对象进行相应处理。
-            interrupt_requested_event.set()
-            log_message("[CLEAR_QUEUE] Gradio internal interrupt_requested_event was SET.")
-            
-            # task_queue 此时应为空，无需 clear。
-            
-        elif num_tasks_waiting_in_gradio_queue > 0:
-            # 情况2: Gradio 的等待队列中有任务。清除这些等待中的任务。
-            # 不中断可能正在 ComfyUI 中运行的任务。
-            cleared_count = num_tasks_waiting_in_gradio_queue
-            task_queue.clear() # 清空 Gradio 的等待队列
-            log_message(f"[CLEAR_QUEUE] Action: Cleared {cleared_count} task(s) from Gradio's queue. Any ComfyUI task currently processing was NOT interrupted by this action.")
-            action_log_messages.append(f"已清除 Gradio 队列中的 {cleared_count} 个等待任务。")
-            
-            # 如果之前有一个外部中断请求的标志 (例如，通过已被移除的独立中断按钮设置的，理论上不太可能发生)
-            # 并且我们这次 *没有* 尝试中断 ComfyUI，那么清除那个旧的标志是安全的。
-            if interrupt_requested_event.is_set():
-                interrupt_requested_event.clear()
-                log_message("[CLEAR_QUEUE] Cleared a pre-existing interrupt_requested_event because we are only clearing the Gradio queue this time.")
+        num_waiting = _count_waiting_tasks_locked(mine)
+        running_jobs = [job for job in pipeline_jobs if mine(job) and not job["cancel_token"].is_cancelled()]
+        log_message(f"[CLEAR_QUEUE] Session {session_id}: waiting {num_waiting}, in pipeline {len(running_jobs)}")
+        if num_waiting > 0:
+            cleared_count, prompts_to_withdraw = _cancel_jobs_locked(mine)
+            action_log_messages.append(f"已清除你的 {cleared_count} 个等待任务。")
+        elif running_jobs:
+            # 取消令牌让等待线程立即退出并释放后端名额；中断请求 (或 /queue 删除) 在锁外发往拥有该任务的后端
+            _, prompts_to_withdraw = _cancel_jobs_locked(mine, include_head=True, reason="user interrupt")
+            action_log_messages.append("已请求中断你正在执行的任务。")
         else:
-            # 情况3: ComfyUI 没有在处理任务，Gradio 的等待队列也为空。没什么可做的。
-            log_message("[CLEAR_QUEUE] Action: No tasks currently processing in ComfyUI and Gradio queue is empty. Nothing to clear or interrupt.")
-            action_log_messages.append("队列已为空，无任务处理中。")
+            prompts_to_withdraw = []
+            action_log_messages.append("你没有排队或执行中的任务。")
+
+    queue_state.notify() # 唤醒各会话的等待循环，使中断/清空立即生效
+    # HTTP 请求放在锁外，避免阻塞队列处理线程
+    if prompts_to_withdraw:
+        withdraw_status_messages = withdraw_comfyui_prompts(prompts_to_withdraw)
+        log_message(f"[CLEAR_QUEUE] Withdrew prompts from ComfyUI backends: {withdraw_status_messages}")
 
     # 通过 gr.Info() 显示操作摘要给用户
     if action_log_messages:
         gr.Info(" ".join(action_log_messages))
 
-    # 更新队列状态的UI显示
-    with queue_lock: # 重新获取锁以获得最新的队列大小 (如果清除了，应该是0)
-        current_gradio_queue_size_for_display = len(task_queue) 
-    
-    # processing_event 的状态由 run_queued_tasks 的主循环和 finally 块管理。
-    # 如果我们通过此函数中断了一个任务，run_queued_tasks 的 finally 块最终会清除 processing_event。
-    # 如果我们只清除了等待队列，processing_event 对于正在运行任务的状态会保持，直到它自然完成或被其他方式中断。
-    current_processing_status_for_display = processing_event.is_set()
-    
-    log_message(f"[CLEAR_QUEUE] Exit. Gradio queue size for display: {current_gradio_queue_size_for_display}, ComfyUI processing status for display: {current_processing_status_for_display}")
-    
-    return gr.update(value=f"队列中: {current_gradio_queue_size_for_display} | 处理中: {'是' if current_processing_status_for_display else '否'}")
-
-def clear_history():
-    global accumulated_image_results, last_video_result
-    with results_lock:
-        accumulated_image_results.clear()
-        last_video_result = None
-    log_message("图像和视频历史已清除。")
-    with queue_lock: current_queue_size = len(task_queue)
+    with queue_lock:
+        return gr.update(value=_queue_status_text_locked(session_id))
+
+def cancel_job(job_id, request: gr.Request = None):
+    """按任务 ID 取消本会话的一个任务: 等待中的直接移出队列，已提交的撤回或中断。"""
+    session_id = _session_of(request)
+    job_id = (job_id or "").strip()
+    prompts_to_withdraw = []
+    with queue_lock:
+        job_entry = _find_job_locked(job_id) if job_id else None
+        if job_entry is None:
+            message = f"未找到等待或执行中的任务 '{job_id}'。"
+        elif job_entry["session"] != session_id:
+            message = "只能取消自己会话中的任务。"
+        elif task_queue.remove(job_id) is not None:
+            job_entry["state"] = "cancelled"
+            job_store.set_state(job_id, "cancelled")
+            message = f"已从队列中移除任务 {job_id}。"
+        elif job_entry["cancel_token"].cancel("user cancelled job"):
+            if job_entry.get("prompt_id"):
+                prompts_to_withdraw.append((job_entry.get("backend"), job_entry["prompt_id"]))
+            message = f"已请求取消任务 {job_id}。"
+        else:
+            message = f"任务 {job_id} 已在取消中。"
+    log_message(f"[CANCEL_JOB] Session {session_id}: {message}")
+    queue_state.notify()
+    if prompts_to_withdraw:
+        withdraw_comfyui_prompts(prompts_to_withdraw)
+    gr.Info(message)
+    with queue_lock:
+        status_text = _queue_status_text_locked(session_id)
+    return gr.update(value=status_text), gr.update(value=describe_queue(request))
+
+def describe_queue(request: gr.Request = None):
+    """
+    队列查看: 按预计执行顺序列出流水线和等待队列中的全部任务 (含类别和预计开始时间)，
+    以及新任务按类别的预计等待。其他会话的任务只显示用户名 (未登录时匿名)。
+    """
+    session_id = _session_of(request)
+    with queue_lock:
+        head_job = pipeline_jobs[0] if pipeline_jobs else None
+        jobs = [job for job in pipeline_jobs if not job["cancel_token"].is_cancelled()] + task_queue.dispatch_order()
+        weights = {job["owner"]: task_queue.weight_of(job["owner"]) for job in jobs}
+        forecast, class_waits = _queue_forecast_locked()
+    summary = " | ".join(f"{JOB_CLASS_LABELS[job_class]}: 前面 {ahead} 个，{_format_wait(wait_seconds)}"
+                         for job_class, (ahead, wait_seconds) in class_waits.items())
+    summary = f"新任务预计等待 — {summary}"
+    if not jobs:
+        return f"队列为空。\n\n{summary}"
+    rows = [summary, "", "| # | 任务 ID | 用户 | 类别 | 工作流 | 状态 | 预计开始 |", "|---|---|---|---|---|---|---|"]
+    for position, job in enumerate(jobs, start=1):
+        user = "你" if job["session"] == session_id else (job.get("user_label") or "其他用户")
+        if weights[job["owner"]] > 1:
+            user += f" (权重 {weights[job['owner']]})"
+        if job is head_job:
+            status = "执行中"
+        elif job["state"] in ("submitted", "running"):
+            status = "已提交"
+        else:
+            status = "等待中"
+        start_text = "-" if job is head_job else _format_wait(forecast[job["job_id"]][1]) + "后"
+        rows.append(f"| {position} | `{job['job_id']}` | {user} | {JOB_CLASS_LABELS[job['job_class']]} | "
+                    f"{os.path.basename(str(job['task'][4] or ''))} | {status} | {start_text} |")
+    return "\n".join(rows)
+
+def clear_history(request: gr.Request = None):
+    session_id = _session_of(request)
+    session_results.get(session_id).clear()
+    log_message(f"会话 {session_id} 的图像和视频历史已清除。")
+    with queue_lock:
+        status_text = _queue_status_text_locked(session_id)
     return {
         output_gallery: gr.update(value=[]), # 清空但不隐藏
         output_video: gr.update(value=None), # 清空但不隐藏
-        queue_status_display: gr.update(value=f"队列中: {current_queue_size} | 处理中: {'是' if processing_event.is_set() else '否'}")
+        queue_status_display: gr.update(value=status_text)
     }
 
 
@@ -1161,14 +1568,18 @@ with gr.Blocks() as demo:
                            max_lines=20,
                            autoscroll=True,
                            interactive=False,
+                           elem_id="comfy_log_display", # APPEND_LOG_JS 通过该 id 追加增量日志
                            elem_classes="log-display-container"
                        )
+                       log_cursor = gr.State(None) # 本标签页已显示到的日志序号
+                       log_delta = gr.JSON(visible=False) # 最近一次的增量日志，由浏览器端追加到日志框
                        # 系统监控 HTML 输出组件
-                       floating_monitor_html_output = gr.HTML(elem_classes="floating-monitor-outer-wrapper")
+                       floating_monitor_html_output = gr.HTML(MONITOR_CONTAINER_HTML, elem_classes="floating-monitor-outer-wrapper")
+                       monitor_delta = gr.JSON(visible=False) # 监控数值的增量，由浏览器端原地更新监控条
                 
                image_accordion = gr.Accordion("上传图像 (折叠,有gradio传入图像节点才会显示上传)", visible=True, open=True)
                with image_accordion:
-                   input_image = gr.Image(type="pil", label="上传图像", height=256, width=256)
+                   input_image = gr.Image(type="filepath", label="上传图像", height=256, width=256) # 传文件路径，按原始字节计算内容哈希
     
                # --- 添加视频上传组件 ---
                video_accordion = gr.Accordion("上传视频 (折叠,有gradio传入视频节点才会显示上传)", visible=False, open=True) # 初始隐藏
@@ -1251,11 +1662,13 @@ with gr.Blocks() as demo:
                # --- 添加队列控制按钮 ---
                with gr.Row():
                    queue_status_display = gr.Markdown("队列中: 0 | 处理中: 否") # 移到按钮上方
+               with gr.Row():
+                   backend_health_display = gr.Markdown(f"后端: {backend_pool.status_line()}") # 后端健康状态 (定时刷新)
     
                with gr.Row():
                    with gr.Row():
                        run_button = gr.Button("🚀 开始跑图 (加入队列)", variant="primary",elem_id="align-center")
-                       clear_queue_button = gr.Button("🧹 清除队列",elem_id="align-center")
+                       clear_queue_button = gr.Button("🧹 清除我的队列",elem_id="align-center")
                        
     
                    with gr.Row():
@@ -1264,6 +1677,19 @@ with gr.Blocks() as demo:
                        sponsor_button = gr.Button("💖 赞助作者")
                    with gr.Row():
                        queue_count = gr.Number(label="队列数量", value=1, minimum=1, step=1, precision=0)
+                       job_class_dropdown = gr.Dropdown(
+                           label="任务类别",
+                           choices=[("自动 (单个=交互，多个=批量)", "auto"), ("交互", "interactive"), ("批量", "batch"), ("后台 (最低优先级)", "background")],
+                           value="auto",
+                           info="高优先级任务插到低优先级任务前面，不会打断正在执行的任务"
+                       )
+               # --- 队列查看与按任务 ID 取消 (只能取消自己会话的任务) ---
+               with gr.Accordion("队列详情", open=False):
+                   with gr.Row():
+                       queue_job_id_input = gr.Textbox(label="任务 ID", placeholder="从下方队列列表复制任务 ID", scale=3)
+                       cancel_job_button = gr.Button("❌ 取消任务", scale=1)
+                       inspect_queue_button = gr.Button("📋 刷新队列", scale=1)
+                   queue_table_display = gr.Markdown("")
 
     
     
@@ -1441,6 +1867,111 @@ with gr.Blocks() as demo:
             
             gr.Markdown("---") # 分隔线
 
+            gr.Markdown("### 🚀 流水线深度")
+            gr.Markdown(
+                "同时提交到 ComfyUI 队列中的任务数。大于 1 时，当前任务执行期间下一个任务已完成准备并排队，减少 GPU 在任务之间的空闲。\n"
+                "设为 1 即恢复逐个提交。保存后立即生效: 之后每次补位 (任务入队或结束时) 都按新的深度，已在流水线中的任务不受影响。"
+            )
+            pipeline_depth_input = gr.Number(
+                label=f"流水线深度 (1-{MAX_PIPELINE_DEPTH})",
+                value=get_pipeline_depth(),
+                minimum=1,
+                maximum=MAX_PIPELINE_DEPTH,
+                step=1,
+                precision=0,
+                elem_id="pipeline_depth_setting_input"
+            )
+            save_pipeline_depth_button = gr.Button("保存流水线深度设置")
+            pipeline_depth_save_status = gr.Markdown("", elem_id="pipeline_depth_save_status_md")
+
+            def handle_save_pipeline_depth(new_depth_from_input):
+                try:
+                    new_depth = int(float(new_depth_from_input))
+                    if not (1 <= new_depth <= MAX_PIPELINE_DEPTH):
+                        return gr.update(value=f"<p style='color:red;'>错误：值必须介于 1 和 {MAX_PIPELINE_DEPTH} 之间。</p>")
+                except (TypeError, ValueError):
+                    return gr.update(value="<p style='color:red;'>错误：请输入一个有效的整数。</p>")
+
+                current_settings = load_plugin_settings()
+                current_settings["pipeline_depth"] = new_depth
+                status_message = save_plugin_settings(current_settings)
+                return gr.update(value=f"<p style='color:green;'>{status_message} 已立即生效，下一次补位按新的深度提交。</p>")
+
+            save_pipeline_depth_button.click(
+                fn=handle_save_pipeline_depth,
+                inputs=[pipeline_depth_input],
+                outputs=[pipeline_depth_save_status]
+            )
+
+            gr.Markdown("---") # 分隔线
+
+            gr.Markdown("### 🖥️ ComfyUI 后端")
+            gr.Markdown(
+                "每行一个 ComfyUI 实例地址 (host:port)，例如每张 GPU 启动一个 ComfyUI 进程。任务会分发到在途任务最少的在线后端，"
+                "中断、预览和日志跟随任务所在的后端。第一个地址为主后端 (重启、节点徽章等操作的目标)。\n"
+                "本机后端应共享同一个 ComfyUI 安装目录 (input/output/temp)，其他机器上的后端通过 HTTP 传输文件。**注意：此更改将在下次启动插件 (或重启 ComfyUI) 后生效。**"
+            )
+            comfyui_backends_input = gr.Textbox(
+                label="ComfyUI 后端地址",
+                value="\n".join(get_comfyui_backend_addresses()),
+                lines=3,
+                elem_id="comfyui_backends_setting_input"
+            )
+            comfyui_transport_input = gr.Radio(
+                label="文件传输模式 (auto: 本机地址共享文件系统，其余地址经 /upload/image 上传输入、经 /history + /view 下载输出)",
+                choices=["auto", "local", "remote"],
+                value=get_comfyui_transport_mode(),
+                elem_id="comfyui_transport_setting_input"
+            )
+            with gr.Row():
+                save_backends_button = gr.Button("保存后端设置")
+                refresh_backends_status_button = gr.Button("刷新后端状态")
+            backends_save_status = gr.Markdown("", elem_id="comfyui_backends_save_status_md")
+            backends_status_display = gr.Markdown(backend_pool.describe())
+
+            def handle_save_backends(backends_text, transport_mode):
+                addresses = get_comfyui_backend_addresses({"comfyui_backends": backends_text or ""})
+                current_settings = load_plugin_settings()
+                current_settings["comfyui_backends"] = addresses
+                current_settings["comfyui_transport"] = get_comfyui_transport_mode({"comfyui_transport": transport_mode})
+                status_message = save_plugin_settings(current_settings)
+                return gr.update(value=f"<p style='color:green;'>{status_message} 已保存 {len(addresses)} 个后端，请重启插件或 ComfyUI 以使更改生效。</p>")
+
+            save_backends_button.click(
+                fn=handle_save_backends,
+                inputs=[comfyui_backends_input, comfyui_transport_input],
+                outputs=[backends_save_status]
+            )
+            refresh_backends_status_button.click(fn=lambda: f"{backend_pool.describe()}\n\n{comfy_http.describe()}", inputs=[], outputs=[backends_status_display])
+
+            gr.Markdown("---") # 分隔线
+
+            gr.Markdown("### ✂️ 工作流剪枝")
+            gr.Markdown(
+                "提交前只保留输出节点 (图像/视频输出到 gradio 前端) 的上游节点，另存 JSON、PreviewImage/SaveImage 旁路输出、思维导图等节点不会执行。\n"
+                "需要保留的旁路节点类型 (class_type) 每行填写一个，它们及其上游节点会一并提交。**注意：此更改将在下次启动插件 (或重启 ComfyUI) 后生效。**"
+            )
+            prune_enabled_input = gr.Checkbox(label="启用工作流剪枝", value=PRUNE_WORKFLOW)
+            prune_keep_input = gr.Textbox(label="保留的节点类型 (class_type)", value="\n".join(PRUNE_KEEP_CLASS_TYPES), lines=2)
+            save_prune_button = gr.Button("保存剪枝设置")
+            prune_save_status = gr.Markdown("")
+
+            def handle_save_prune(prune_enabled, keep_text):
+                enabled, keep_class_types = get_workflow_prune_settings({"prune_workflow": prune_enabled, "prune_keep_class_types": keep_text or ""})
+                current_settings = load_plugin_settings()
+                current_settings["prune_workflow"] = enabled
+                current_settings["prune_keep_class_types"] = keep_class_types
+                status_message = save_plugin_settings(current_settings)
+                return gr.update(value=f"<p style='color:green;'>{status_message} 请重启插件或 ComfyUI 以使更改生效。</p>")
+
+            save_prune_button.click(
+                fn=handle_save_prune,
+                inputs=[prune_enabled_input, prune_keep_input],
+                outputs=[prune_save_status]
+            )
+
+            gr.Markdown("---") # 分隔线
+
     with gr.Tab("信息"):
         with gr.Column():
             gr.Markdown("### ℹ️ 插件与开发者信息") # 添加标题
@@ -1523,7 +2054,11 @@ with gr.Blocks() as demo:
 
     # JSON 下拉菜单改变时，更新所有相关组件的可见性、默认值 + 输出区域可见性
     def update_ui_on_json_change(json_file):
-        defaults = get_workflow_defaults_and_visibility(json_file, OUTPUT_DIR, resolution_prefixes, resolution_presets, MAX_DYNAMIC_COMPONENTS)
+        compiled_workflow = workflow_cache.get(json_file, OUTPUT_DIR)
+        if compiled_workflow is not None:
+            defaults = compiled_workflow.defaults
+        else:
+            defaults = get_workflow_defaults_and_visibility(json_file, OUTPUT_DIR, resolution_prefixes, resolution_presets, MAX_DYNAMIC_COMPONENTS)
         
         updates = []
 
@@ -1718,7 +2253,7 @@ with gr.Blocks() as demo:
             *float_inputs, 
             *int_inputs,
             seed_mode_dropdown, fixed_seed_input,
-            queue_count
+            queue_count, job_class_dropdown
         ],
         outputs=[queue_status_display, output_gallery, output_video, main_output_tabs_component]
     )
@@ -1727,6 +2262,8 @@ with gr.Blocks() as demo:
 
     # --- 添加新按钮的点击事件 ---
     clear_queue_button.click(fn=clear_queue, inputs=[], outputs=[queue_status_display])
+    cancel_job_button.click(fn=cancel_job, inputs=[queue_job_id_input], outputs=[queue_status_display, queue_table_display])
+    inspect_queue_button.click(fn=describe_queue, inputs=[], outputs=[queue_table_display])
     clear_history_button.click(fn=clear_history, inputs=[], outputs=[output_gallery, output_video, queue_status_display])
     sponsor_button.click(fn=show_sponsor_code, inputs=[], outputs=[sponsor_display])
 
@@ -1795,35 +2332,40 @@ with gr.Blocks() as demo:
     )
 
     # --- 添加日志轮询 Timer ---
-    # 每 0.1 秒调用 fetch_and_format_logs，并将结果输出到 log_display (加快刷新以改善滚动)
-    log_timer = gr.Timer(0.1, active=True)  # 每 0.1 秒触发一次
-    log_timer.tick(fetch_and_format_logs, inputs=None, outputs=log_display)
+    # 每个标签页只取自己游标之后的新日志，由浏览器端追加，不再每 0.1 秒推送整份日志
+    log_timer = gr.Timer(LOG_CLIENT_INTERVAL, active=True)
+    log_timer.tick(poll_log_delta, inputs=[log_cursor], outputs=[log_delta, log_cursor], show_progress="hidden")
+    log_delta.change(fn=None, inputs=[log_delta], outputs=None, js=APPEND_LOG_JS)
+    # 后端健康状态来自健康监视器的缓存结果，刷新不会发出 HTTP 请求
+    health_timer = gr.Timer(HEALTH_PROBE_INTERVAL)
+    health_timer.tick(fn=lambda: gr.update(value=f"后端: {backend_pool.status_line()}"), inputs=None, outputs=backend_health_display, show_progress="hidden")
 
     # --- 系统监控流加载 ---
-    # outputs 需要指向在 gr.Blocks 内定义的 floating_monitor_html_output 实例
-    # 确保 floating_monitor_html_output 变量在 demo.load 调用时是可访问的
-    # (它是在 with gr.Blocks(...) 上下文中定义的，所以 demo 对象知道它)
-    demo.load(fn=update_floating_monitors_stream, inputs=None, outputs=[floating_monitor_html_output], show_progress="hidden")
+    # 流只输出变化的数值 (JSON)，floating_monitor_html_output 的内容由 MONITOR_RENDER_JS 原地更新，不再每秒替换整段 HTML
+    demo.load(fn=update_floating_monitors_stream, inputs=None, outputs=[monitor_delta], show_progress="hidden")
+    monitor_delta.change(fn=None, inputs=[monitor_delta], outputs=None, js=MONITOR_RENDER_JS)
 
     # --- ComfyUI 实时预览加载 ---
     demo.load(
-        fn=comfyui_previewer.get_update_generator(),
+        fn=backend_pool.get_preview_update_generator(), # 跟随队首任务所在的后端
         inputs=[],
         outputs=[live_preview_image, live_preview_status],
         show_progress="hidden" # 通常预览不需要进度条
     )
     # 启动预览器的工作线程
-    # demo.load(fn=comfyui_previewer.start_worker, inputs=[], outputs=[], show_progress="hidden")
+    # demo.load(fn=backend_pool.start_workers, inputs=[], outputs=[], show_progress="hidden")
     # 直接在 Gradio 线程启动后调用 start_worker 更可靠
     # 或者在 on_load_setup 中调用
 
 
     # --- Gradio 启动代码 ---
 def luanch_gradio(demo_instance): # 接收 demo 实例
-    # 在 Gradio 启动前启动预览器工作线程
-    print("准备启动 ComfyUIPreviewer 工作线程...")
-    comfyui_previewer.start_worker()
-    print("ComfyUIPreviewer 工作线程已请求启动。")
+    # 在 Gradio 启动前启动各后端的预览器和任务追踪器工作线程
+    print("准备启动 ComfyUI 后端池工作线程...")
+    backend_pool.start_workers()
+    log_tailer.start()
+    print("ComfyUI 后端池工作线程已请求启动。")
+    threading.Thread(target=_recover_jobs_when_ready, name="job_recovery", daemon=True).start()
 
     try:
         # 尝试查找可用端口，从 7861 开始
@@ -1870,10 +2412,14 @@ gradio_thread.start()
 
 # 注册 atexit 清理函数，以在程序退出时停止 previewer worker
 def cleanup_previewer_on_exit():
-    print("Gradio 应用正在关闭，尝试停止 ComfyUIPreviewer 工作线程...")
-    if comfyui_previewer:
-        comfyui_previewer.stop_worker()
-    print("ComfyUIPreviewer 工作线程已请求停止。")
+    print("Gradio 应用正在关闭，尝试停止 ComfyUI 后端池工作线程...")
+    if backend_pool:
+        backend_pool.stop_workers()
+        log_tailer.stop()
+    print("ComfyUI 后端池工作线程已请求停止。")
+    remote_transport.shutdown()
+    comfy_http.close()
+    job_store.flush() # 确保最后的状态变化已写入数据库
 
 atexit.register(cleanup_previewer_on_exit)
 
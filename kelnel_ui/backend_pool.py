@@ -0,0 +1,188 @@
+import threading
+import time
+from urllib.parse import urlsplit
+
+from .comfy_job_tracker import ComfyUIJobTracker
+from .k_Preview import ComfyUIPreviewer
+from .remote_transport import TRANSPORT_LOCAL, TRANSPORT_REMOTE
+from .retry_policy import CircuitBreaker
+from .health_monitor import BackendHealth, BackendHealthMonitor
+
+LOOPBACK_HOSTS = ("127.0.0.1", "localhost", "::1")
+
+def resolve_transport(address, transport_mode="auto"):
+    """auto 模式下，本机地址视为共享文件系统，其余地址走远程传输。"""
+    if transport_mode in (TRANSPORT_LOCAL, TRANSPORT_REMOTE):
+        return transport_mode
+    host = urlsplit(f"//{address}").hostname
+    return TRANSPORT_LOCAL if host in LOOPBACK_HOSTS else TRANSPORT_REMOTE
+
+class ComfyUIBackend:
+    """
+    后端池中的一个 ComfyUI 实例 (例如每张 GPU 一个进程)。
+    每个后端有自己的任务追踪器 (/ws 完成事件) 和实时预览器，in_flight 为已分配到该后端、尚未取回结果的任务数。
+    """
+    def __init__(self, address, index=0, min_yield_interval=0.1, transport=TRANSPORT_LOCAL):
+        self.address = address # host:port
+        self.index = index
+        self.name = f"#{index + 1} {address}"
+        self.transport = transport # local: 共享文件系统; remote: 经 HTTP 上传输入、下载输出
+        self.in_flight = 0
+        self.last_error = None
+        self.breaker = CircuitBreaker() # 提交连续失败时暂停向该后端派发任务
+        self.health = BackendHealth() # 健康监视器最近一次探测 /system_stats 和 /queue 的结果
+        self.tracker = ComfyUIJobTracker(server_address=address, client_id_suffix=f"gradio_workflow_queue_{index}")
+        self.previewer = ComfyUIPreviewer(server_address=address, client_id_suffix=f"gradio_workflow_integration_{index}",
+                                          min_yield_interval=min_yield_interval)
+
+    @property
+    def base_url(self):
+        return f"http://{self.address}"
+
+    @property
+    def is_remote(self):
+        return self.transport == TRANSPORT_REMOTE
+
+    def is_healthy(self):
+        """以任务追踪器的 WebSocket 连接状态作为健康状态。"""
+        return self.tracker.is_connected()
+
+    def is_ready(self):
+        """可以派发任务: 健康探测通过，断路器未打开且不在提交失败后的退避时间内。"""
+        return self.health.ready and self.breaker.allows_request()
+
+    def start_workers(self):
+        self.tracker.start_worker()
+        self.previewer.start_worker()
+
+    def stop_workers(self):
+        self.previewer.stop_worker()
+        self.tracker.stop_worker()
+
+class ComfyUIBackendPool:
+    """
+    ComfyUI 后端池: 按最少在途任务数 (least-loaded) 把任务分配到健康的后端。
+    中断、预览和日志通过任务记录的 backend 路由到实际执行该任务的实例。
+    """
+    def __init__(self, addresses, min_yield_interval=0.1, transport_mode="auto"):
+        self.backends = [ComfyUIBackend(address, index, min_yield_interval, resolve_transport(address, transport_mode))
+                         for index, address in enumerate(addresses)]
+        self.lock = threading.Lock()
+        self.active_backend = self.backends[0] # 当前在前端展示预览/日志的后端
+        self.min_yield_interval = min_yield_interval
+        self.health_monitor = BackendHealthMonitor(self.backends)
+        self.health_monitor.add_listener(self._on_health_change)
+
+    @staticmethod
+    def _on_health_change(backend, ready):
+        if ready:
+            backend.breaker.record_success() # 后端恢复后立即允许提交，不必等断路器的试探时间
+
+    @property
+    def primary(self):
+        """主后端 (配置中的第一个)，用于重启、节点徽章等面向单个实例的操作。"""
+        return self.backends[0]
+
+    def has_ready(self):
+        return any(b.is_ready() for b in self.backends)
+
+    def seconds_until_ready(self):
+        """健康但断路器打开 (或退避中) 的后端中最早允许再次提交的秒数；没有健康的后端时返回 None (等待健康监视器通知)。"""
+        waits = [b.breaker.seconds_until_retry() for b in self.backends if b.health.ready]
+        return min(waits) if waits else None
+
+    def acquire(self, prefer=None):
+        """
+        选择在途任务最少的就绪后端 (健康探测通过且断路器未打开) 并占用一个名额。prefer 就绪时优先选择它
+        (上次提交结果不明的后端，先查询是否已收到该 prompt)。
+        没有就绪的后端时返回 None，调用方把任务留在队列中，不向已知不可用的后端提交。
+        """
+        with self.lock:
+            candidates = [b for b in self.backends if b.is_ready()]
+            if not candidates:
+                return None
+            backend = prefer if prefer in candidates else min(candidates, key=lambda b: (b.in_flight, b.index))
+            backend.in_flight += 1
+            return backend
+
+    def release(self, backend):
+        if backend is None:
+            return
+        with self.lock:
+            backend.in_flight = max(0, backend.in_flight - 1)
+
+    def set_active(self, backend):
+        if backend is not None:
+            self.active_backend = backend
+
+    def find_by_address(self, address):
+        for backend in self.backends:
+            if backend.address == address:
+                return backend
+        return None
+
+    def start_workers(self):
+        for backend in self.backends:
+            backend.start_workers()
+        self.health_monitor.start()
+
+    def stop_workers(self):
+        self.health_monitor.stop()
+        for backend in self.backends:
+            backend.stop_workers()
+
+    def status_line(self):
+        """各后端健康状态的单行摘要，用于 Gradio 状态栏。"""
+        if len(self.backends) == 1:
+            return self.backends[0].health.summary()
+        return " ; ".join(f"{b.name}: {b.health.summary()}" for b in self.backends)
+
+    def describe(self):
+        """返回 Markdown 表格，用于设置页展示各后端状态。"""
+        lines = ["| 后端 | 传输 | 状态 | 健康探测 | 在途任务 | 最近错误 |", "| --- | --- | --- | --- | --- | --- |"]
+        with self.lock:
+            for backend in self.backends:
+                status = "🟢 在线" if backend.is_healthy() else f"🔴 {backend.tracker.ws_connection_status}"
+                if backend.breaker.state != backend.breaker.CLOSED:
+                    status += f" (断路器: {backend.breaker.state})"
+                active_mark = " (当前预览)" if backend is self.active_backend else ""
+                lines.append(f"| {backend.name}{active_mark} | {backend.transport} | {status} | {backend.health.summary()} | {backend.in_flight} | {backend.last_error or '-'} |")
+        return "\n".join(lines)
+
+    def get_preview_update_generator(self):
+        """
+        与 ComfyUIPreviewer.get_update_generator 相同的输出 (image, status)，
+        但始终跟随 active_backend，即当前队首任务所在的后端。
+        """
+        def generator():
+            last_yield_time = time.time()
+            while any(b.previewer.active_prompt_info.get("is_worker_globally_active", True) for b in self.backends):
+                backend = self.active_backend
+                previewer = backend.previewer
+                new_image_received_in_this_cycle = previewer.image_update_event.wait(timeout=self.min_yield_interval / 2)
+                if new_image_received_in_this_cycle:
+                    previewer.image_update_event.clear()
+
+                current_time = time.time()
+                if current_time - last_yield_time < self.min_yield_interval:
+                    time.sleep(self.min_yield_interval - (current_time - last_yield_time))
+
+                current_node_value = previewer.active_prompt_info.get("current_executing_node")
+                node_status_display = "空闲" if current_node_value is None else str(current_node_value)
+                status_parts = []
+                if previewer.latest_preview_image:
+                    timestamp_msg = f"最后更新: {time.strftime('%H:%M:%S')}" if new_image_received_in_this_cycle else f"当前显示: {time.strftime('%H:%M:%S')}"
+                    status_parts.append(timestamp_msg)
+                else:
+                    status_parts.append("等待预览...")
+                if len(self.backends) > 1:
+                    status_parts.append(f"后端: {backend.name}")
+                status_parts.append(f"节点: {node_status_display}")
+                status_parts.append(f"连接: {previewer.ws_connection_status}")
+                yield previewer.latest_preview_image, " | ".join(status_parts)
+                last_yield_time = time.time()
+
+            previewer = self.active_backend.previewer
+            yield previewer.latest_preview_image, f"预览已停止. {previewer.ws_connection_status}"
+
+        return generator
@@ -0,0 +1,25 @@
+from concurrent.futures import ThreadPoolExecutor
+import threading
+
+class BoundedWriter:
+    """
+    有界的后台写入线程池。
+    最多允许 max_pending 个未完成的任务 (排队 + 执行中)，超出时 submit() 阻塞调用方 (背压)，
+    避免大批量输出时待编码的图像在内存中无限堆积。
+    """
+    def __init__(self, max_workers, max_pending, thread_name_prefix="bounded_writer"):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=thread_name_prefix)
+        self._slots = threading.BoundedSemaphore(max(max_pending, max_workers))
+
+    def submit(self, fn, *args, **kwargs):
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(fn, *args, **kwargs)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
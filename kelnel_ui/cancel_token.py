@@ -0,0 +1,26 @@
+from concurrent.futures import Future
+import threading
+
+class CancelToken:
+    """
+    协作式取消令牌，每个排队任务一个。
+    future 在取消时完成，可与结果 Future 一起传给 wait(FIRST_COMPLETED)，等待方无需轮询即可立即退出。
+    """
+    def __init__(self):
+        self.future = Future()
+        self._lock = threading.Lock()
+
+    def cancel(self, reason="cancelled"):
+        """请求取消，重复调用无效果。返回 True 表示本次调用触发了取消。"""
+        with self._lock:
+            if self.future.done():
+                return False
+            self.future.set_result(reason)
+            return True
+
+    def is_cancelled(self):
+        return self.future.done()
+
+    @property
+    def reason(self):
+        return self.future.result() if self.future.done() else None
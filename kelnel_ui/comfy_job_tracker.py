@@ -0,0 +1,193 @@
+from websocket import create_connection, WebSocketException, WebSocketTimeoutException, WebSocketConnectionClosedException
+from concurrent.futures import Future
+import json
+import threading
+import time
+
+from .http_client import comfy_http
+
+# Default Configuration (can be overridden during class instantiation)
+DEFAULT_COMFYUI_SERVER_ADDRESS = "127.0.0.1:8188"
+DEFAULT_CLIENT_ID_PREFIX = "gradio_job_tracker_"
+FINISHED_JOB_TTL = 600 # 已结束任务的结果保留时间 (秒)，用于处理 watch() 晚于事件到达的情况
+
+# 任务结束状态
+JOB_SUCCESS = "success"
+JOB_ERROR = "error"
+JOB_INTERRUPTED = "interrupted"
+
+class ComfyUIJobTracker:
+    """
+    订阅 ComfyUI 的 /ws 事件流，按 prompt_id 追踪任务的完成状态。
+
+    通过 /prompt 提交任务时需要带上本追踪器的 client_id，ComfyUI 才会把
+    executing / execution_error / execution_interrupted 等事件发给这个连接。
+    watch(prompt_id) 返回一个 concurrent.futures.Future，任务结束时立即 resolve 为:
+        {"status": "success" | "error" | "interrupted", "message": str, "node_id": ..., "node_type": ...}
+    """
+    def __init__(self, server_address=None, client_id_suffix="main"):
+        self.server_address = server_address or DEFAULT_COMFYUI_SERVER_ADDRESS
+        timestamp = int(time.time() * 1000)
+        self.client_id = f"{DEFAULT_CLIENT_ID_PREFIX}{client_id_suffix}_{timestamp}"
+
+        self.jobs = {} # prompt_id -> Future
+        self.finished_at = {} # prompt_id -> 结束时间，用于清理
+        self.jobs_lock = threading.Lock()
+        self.connected_event = threading.Event()
+        self.running_prompt_id = None # 该后端上正在执行的 prompt (来自 execution_start 事件)
+        self.is_worker_active = False
+        self.worker_thread = None
+        self.ws_connection_status = "未连接"
+
+    # --- 对外接口 ---
+    def watch(self, prompt_id):
+        """返回 prompt_id 对应的 Future。事件可能早于 watch() 到达，因此这里是 get-or-create。"""
+        with self.jobs_lock:
+            future = self.jobs.get(prompt_id)
+            if future is None:
+                future = Future()
+                self.jobs[prompt_id] = future
+            return future
+
+    def forget(self, prompt_id):
+        """调用方拿到结果后释放记录。"""
+        with self.jobs_lock:
+            self.jobs.pop(prompt_id, None)
+            self.finished_at.pop(prompt_id, None)
+
+    def is_connected(self):
+        return self.connected_event.is_set()
+
+    def is_running(self, prompt_id):
+        """prompt 是否正在该后端上执行 (而非仍在排队)。"""
+        return prompt_id is not None and self.running_prompt_id == prompt_id
+
+    # --- 内部实现 ---
+    def _resolve(self, prompt_id, status, message="", node_id=None, node_type=None):
+        if not prompt_id:
+            return
+        outcome = {"status": status, "message": message, "node_id": node_id, "node_type": node_type}
+        with self.jobs_lock:
+            future = self.jobs.get(prompt_id)
+            if future is None:
+                future = Future()
+                self.jobs[prompt_id] = future
+            if future.done():
+                return
+            future.set_result(outcome)
+            if self.running_prompt_id == prompt_id:
+                self.running_prompt_id = None
+            now = time.time()
+            self.finished_at[prompt_id] = now
+            # 清理过期且无人领取的结果
+            expired = [pid for pid, t in self.finished_at.items() if now - t > FINISHED_JOB_TTL]
+            for pid in expired:
+                self.jobs.pop(pid, None)
+                self.finished_at.pop(pid, None)
+        print(f"[{self.client_id}] Prompt {prompt_id} finished: {status} {message}".rstrip())
+
+    def _handle_message(self, message_data):
+        msg_type = message_data.get('type')
+        data = message_data.get('data') or {}
+        prompt_id = data.get('prompt_id')
+
+        if msg_type == 'execution_start':
+            self.running_prompt_id = prompt_id
+        elif msg_type == 'executing':
+            # node 为 None 表示该 prompt 已执行完毕
+            if data.get('node') is None and prompt_id:
+                self._resolve(prompt_id, JOB_SUCCESS)
+        elif msg_type == 'execution_success':
+            self._resolve(prompt_id, JOB_SUCCESS)
+        elif msg_type == 'execution_error':
+            message = f"{data.get('exception_type', '')}: {data.get('exception_message', '')}".strip(": ")
+            self._resolve(prompt_id, JOB_ERROR, message=message or "execution_error",
+                          node_id=data.get('node_id'), node_type=data.get('node_type'))
+        elif msg_type == 'execution_interrupted':
+            self._resolve(prompt_id, JOB_INTERRUPTED, message="execution_interrupted",
+                          node_id=data.get('node_id'), node_type=data.get('node_type'))
+
+    def _reconcile_pending_jobs(self):
+        """WebSocket 重连后，未结束的任务可能在断线期间已完成，通过 /history 补齐状态。"""
+        with self.jobs_lock:
+            pending = [pid for pid, f in self.jobs.items() if not f.done()]
+        for prompt_id in pending:
+            try:
+                response = comfy_http.get(f"http://{self.server_address}/history/{prompt_id}")
+                response.raise_for_status()
+                history_item = response.json().get(prompt_id)
+            except Exception as e:
+                print(f"[{self.client_id}] Failed to reconcile prompt {prompt_id} via /history: {e}")
+                continue
+            if not history_item:
+                continue # 仍在队列中或正在执行
+            status = history_item.get("status") or {}
+            if status.get("status_str") == "error":
+                self._resolve(prompt_id, JOB_ERROR, message="execution_error (from /history)")
+            elif status.get("completed", True):
+                self._resolve(prompt_id, JOB_SUCCESS)
+
+    def _tracker_worker(self):
+        ws_url = f"ws://{self.server_address}/ws?clientId={self.client_id}"
+        ws = None
+
+        print(f"[{self.client_id}] Job tracker thread started.")
+        while self.is_worker_active:
+            try:
+                self.ws_connection_status = f"正在连接到 {ws_url}..."
+                ws = create_connection(ws_url, timeout=10)
+                self.ws_connection_status = "WebSocket 已连接"
+                self.connected_event.set()
+                print(f"[{self.client_id}] WebSocket connection established to {ws_url}.")
+                self._reconcile_pending_jobs()
+
+                while self.is_worker_active:
+                    if not ws.connected:
+                        break
+                    try:
+                        ws.settimeout(1.0)
+                        received_message = ws.recv()
+                    except WebSocketTimeoutException:
+                        continue
+                    except WebSocketConnectionClosedException:
+                        self.ws_connection_status = "WebSocket 连接已关闭"
+                        break
+
+                    if not isinstance(received_message, str):
+                        continue # 二进制消息是预览图，不关心
+                    try:
+                        self._handle_message(json.loads(received_message))
+                    except json.JSONDecodeError:
+                        pass
+
+            except (WebSocketException, ConnectionRefusedError, OSError) as e:
+                self.ws_connection_status = f"WebSocket 连接错误: {e}"
+                print(f"[{self.client_id}] WebSocket connection error: {e}. Retrying in 5 seconds...")
+            except Exception as e:
+                self.ws_connection_status = f"任务追踪线程发生意外错误: {e}"
+                print(f"[{self.client_id}] Unexpected error in job tracker: {e}. Retrying in 5 seconds...")
+            finally:
+                self.connected_event.clear()
+                self.running_prompt_id = None
+                if ws:
+                    ws.close()
+                    ws = None
+                if self.is_worker_active:
+                    time.sleep(5)
+
+        self.ws_connection_status = "任务追踪线程已结束"
+        print(f"[{self.client_id}] Job tracker thread finished.")
+
+    def start_worker(self):
+        if self.worker_thread and self.worker_thread.is_alive():
+            print(f"[{self.client_id}] Job tracker already running.")
+            return
+        self.is_worker_active = True
+        self.worker_thread = threading.Thread(target=self._tracker_worker, daemon=True)
+        self.worker_thread.start()
+
+    def stop_worker(self):
+        self.is_worker_active = False
+        if self.worker_thread and self.worker_thread.is_alive():
+            self.worker_thread.join(timeout=5)
+        self.ws_connection_status = "任务追踪线程已停止"
@@ -0,0 +1,159 @@
+from collections import deque, OrderedDict
+import itertools
+import time
+import uuid
+
+# 任务类别，按优先级从高到低。高优先级任务在下一次出队时插到低优先级任务前面，但不打断正在执行的 prompt
+JOB_CLASSES = ("interactive", "batch", "background")
+JOB_CLASS_LABELS = {"interactive": "交互", "batch": "批量", "background": "后台"}
+DEFAULT_JOB_SECONDS = 30.0 # 还没有某类任务的耗时记录时使用的估计值
+DURATION_SMOOTHING = 0.3 # 耗时指数移动平均的新样本权重
+
+def classify_job(requested_class, queue_count):
+    """requested_class 为 "auto" 或空时: 单个任务为交互类，一次排多个为批量类。"""
+    if requested_class in JOB_CLASSES:
+        return requested_class
+    return "interactive" if queue_count <= 1 else "batch"
+
+class _WeightedRoundRobin:
+    """单个任务类别内按用户分组的 FIFO，加权轮询出队。"""
+    def __init__(self, weight_of):
+        self.weight_of = weight_of
+        self.queues = OrderedDict() # owner -> deque，顺序即轮询顺序 (队首为当前轮到的用户)
+        self.credit = 0 # 当前用户本轮已取出的任务数
+
+    def popleft(self):
+        owner, queue = next(iter(self.queues.items()))
+        job = queue.popleft()
+        self.credit += 1
+        if not queue:
+            del self.queues[owner]
+            self.credit = 0
+        elif self.credit >= self.weight_of(owner):
+            self.queues.move_to_end(owner) # 本轮配额用完，轮到下一个用户
+            self.credit = 0
+        return job
+
+    def drop_if_empty(self, owner):
+        if not self.queues.get(owner):
+            first = next(iter(self.queues), None)
+            self.queues.pop(owner, None)
+            if owner == first:
+                self.credit = 0
+
+    def copy(self):
+        clone = _WeightedRoundRobin(self.weight_of)
+        clone.queues = OrderedDict((owner, deque(queue)) for owner, queue in self.queues.items())
+        clone.credit = self.credit
+        return clone
+
+class FairTaskQueue:
+    """
+    按任务类别和用户分组的等待队列，取代单一的 task_queue deque。
+    出队时先取优先级最高的非空类别 (交互 > 批量 > 后台)，类别内在有任务的用户之间加权轮询:
+    每轮依次为每个用户连续取出 weight 个任务，各用户自己的任务按入队先后执行。
+    因此一次测试出图会排到通宵批量任务前面，某个用户一次排 100 个任务也不会让其他用户一直等待。
+
+    队列项为任务字典 (至少含 job_id / owner / session / job_class)，由调用方决定其余字段。
+    本类不自带锁，与原来的 deque 一样由调用方的 queue_lock 保护。
+    同时记录各类任务的平均耗时，用于估计等待时间。
+    """
+    def __init__(self, default_weight=1):
+        self.default_weight = max(1, int(default_weight))
+        self._weights = {}
+        self._classes = {job_class: _WeightedRoundRobin(self.weight_of) for job_class in JOB_CLASSES}
+        self._durations = {} # job_class -> 平均耗时 (秒)
+        self._seq = itertools.count(1)
+
+    def set_weight(self, owner, weight):
+        """设置用户每轮可连续取出的任务数 (>=1)，weight 为 None 时恢复默认。"""
+        if weight is None:
+            self._weights.pop(owner, None)
+        else:
+            self._weights[owner] = max(1, int(weight))
+
+    def weight_of(self, owner):
+        return self._weights.get(owner, self.default_weight)
+
+    def new_job(self, owner, session, task, job_class="interactive", **fields):
+        """创建任务字典 (job_id 为短 uuid)，不入队。"""
+        job = {"job_id": uuid.uuid4().hex[:8], "seq": next(self._seq), "owner": owner, "session": session,
+               "task": task, "job_class": job_class if job_class in JOB_CLASSES else "interactive",
+               "enqueued_at": time.time()}
+        job.update(fields)
+        return job
+
+    def append(self, job):
+        self._classes[job["job_class"]].queues.setdefault(job["owner"], deque()).append(job)
+        return job
+
+    def appendleft(self, job):
+        """把已出队的任务放回同类别的最前面 (例如没有可用的后端而未能提交)，下一次出队时最先取出。"""
+        round_robin = self._classes[job["job_class"]]
+        if next(iter(round_robin.queues), None) != job["owner"]:
+            round_robin.credit = 0
+        round_robin.queues.setdefault(job["owner"], deque()).appendleft(job)
+        round_robin.queues.move_to_end(job["owner"], last=False)
+        return job
+
+    def popleft(self):
+        """取出优先级最高的类别中按加权轮询轮到的任务，队列为空时返回 None。"""
+        for job_class in JOB_CLASSES:
+            if self._classes[job_class].queues:
+                return self._classes[job_class].popleft()
+        return None
+
+    def remove(self, job_id):
+        """按 job_id 删除等待中的任务，返回该任务或 None。"""
+        for round_robin in self._classes.values():
+            for owner, queue in list(round_robin.queues.items()):
+                for job in queue:
+                    if job["job_id"] == job_id:
+                        queue.remove(job)
+                        round_robin.drop_if_empty(owner)
+                        return job
+        return None
+
+    def clear(self, predicate=None):
+        """删除所有 (或满足 predicate 的) 等待任务，返回被删除的任务列表。"""
+        removed = []
+        for round_robin in self._classes.values():
+            for owner, queue in list(round_robin.queues.items()):
+                kept = deque()
+                for job in queue:
+                    (removed if predicate is None or predicate(job) else kept).append(job)
+                round_robin.queues[owner] = kept
+                round_robin.drop_if_empty(owner)
+        return removed
+
+    def dispatch_order(self):
+        """按当前优先级和轮询状态预测的出队顺序 (不修改队列)，用于队列查看和位置显示。"""
+        order = []
+        for job_class in JOB_CLASSES:
+            round_robin = self._classes[job_class].copy()
+            while round_robin.queues:
+                order.append(round_robin.popleft())
+        return order
+
+    def count(self, predicate=None):
+        return sum(1 for round_robin in self._classes.values() for queue in round_robin.queues.values()
+                   for job in queue if predicate is None or predicate(job))
+
+    def record_duration(self, job_class, seconds):
+        """记录一个任务的实际执行耗时 (指数移动平均)。"""
+        previous = self._durations.get(job_class)
+        self._durations[job_class] = seconds if previous is None else previous + DURATION_SMOOTHING * (seconds - previous)
+
+    def estimate_seconds(self, job_class):
+        """某类任务的预计耗时: 该类的平均值，没有记录时用其他类的平均值，再退回 DEFAULT_JOB_SECONDS。"""
+        if job_class in self._durations:
+            return self._durations[job_class]
+        if self._durations:
+            return sum(self._durations.values()) / len(self._durations)
+        return DEFAULT_JOB_SECONDS
+
+    def __len__(self):
+        return self.count()
+
+    def __bool__(self):
+        return any(round_robin.queues for round_robin in self._classes.values())
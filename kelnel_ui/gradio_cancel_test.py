@@ -1,16 +1,18 @@
-import requests # 用于发送 HTTP 请求
+import requests # 异常类型
+from .http_client import comfy_http # 共享的连接池客户端
 
 # ComfyUI 服务器的默认地址
 # DEFAULT_COMFYUI_URL = "http://127.0.0.1:8188" # 保留注释或移除，因为它在当前函数中未直接使用
 
-def cancel_comfyui_task_action(comfyui_url_base):
-    """向 ComfyUI 发送中断请求"""
+def cancel_comfyui_task_action(comfyui_url_base, prompt_id=None):
+    """向 ComfyUI 发送中断请求。给出 prompt_id 时，支持的 ComfyUI 版本只中断该 prompt (旧版本忽略此参数)。"""
     interrupt_url = f"{comfyui_url_base}/interrupt"
     status_message = ""
     try:
         # 使用 print 记录日志，因为此模块可能没有配置 log_message
         print(f"Attempting to send interrupt request to: {interrupt_url}")
-        response = requests.post(interrupt_url, timeout=5) # 设置超时
+        payload = {"prompt_id": prompt_id} if prompt_id else None
+        response = comfy_http.post(interrupt_url, json=payload) # 超时由 http_client 按端点设置
         if response.status_code == 200:
             status_message = f"成功发送中断请求到 {interrupt_url}。"
             print(status_message)
@@ -28,6 +30,28 @@ def cancel_comfyui_task_action(comfyui_url_base):
         print(status_message)
     return status_message
 
+def delete_comfyui_queued_prompts(comfyui_url_base, prompt_ids):
+    """从 ComfyUI 的等待队列中删除尚未开始执行的 prompt (POST /queue {"delete": [...]})"""
+    prompt_ids = [pid for pid in prompt_ids if pid]
+    if not prompt_ids:
+        return "没有需要删除的 prompt。"
+    queue_url = f"{comfyui_url_base}/queue"
+    try:
+        print(f"Attempting to delete {len(prompt_ids)} queued prompt(s) via: {queue_url}")
+        response = comfy_http.post(queue_url, json={"delete": prompt_ids})
+        if response.status_code == 200:
+            status_message = f"已从 ComfyUI 队列删除 {len(prompt_ids)} 个等待中的 prompt。"
+        else:
+            status_message = f"删除队列中的 prompt 失败。服务器返回状态码: {response.status_code}。响应: {response.text}"
+    except requests.exceptions.ConnectionError:
+        status_message = f"连接 ComfyUI 服务器 ({comfyui_url_base}) 失败。请确保 ComfyUI 正在运行并且地址正确。"
+    except requests.exceptions.Timeout:
+        status_message = f"删除队列中的 prompt 请求 ({queue_url}) 超时。"
+    except Exception as e:
+        status_message = f"删除队列中的 prompt 时发生错误: {str(e)}"
+    print(status_message)
+    return status_message
+
 # 原 Gradio 界面和 if __name__ == "__main__": 部分已被移除，
 # 因为 gradio_workflow.py 只导入和使用 cancel_comfyui_task_action 函数。
 # 如果需要独立测试此文件，可以将之前的 Gradio Blocks 代码恢复。
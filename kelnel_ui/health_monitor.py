@@ -0,0 +1,136 @@
+from concurrent.futures import Future, wait as wait_futures, FIRST_COMPLETED
+import threading
+import time
+
+import requests
+
+from .http_client import comfy_http
+
+HEALTH_PROBE_INTERVAL = 2.0 # 探测间隔 (秒)
+HEALTH_PROBE_TIMEOUT = 3.0 # 单次探测请求的超时 (秒)
+
+class BackendHealth:
+    """单个后端最近一次探测的结果。"""
+    def __init__(self):
+        self.ready = False
+        self.checked_at = None
+        self.ready_since = None
+        self.latency_ms = None
+        self.queue_running = 0
+        self.queue_pending = 0
+        self.vram_free = None
+        self.vram_total = None
+        self.consecutive_failures = 0
+        self.last_error = None
+
+    def summary(self):
+        if self.checked_at is None:
+            return "⚪ 检测中"
+        if not self.ready:
+            return f"🔴 未就绪 (连续失败 {self.consecutive_failures} 次: {self.last_error or '无响应'})"
+        text = f"🟢 就绪 {self.latency_ms:.0f}ms | ComfyUI 队列 {self.queue_running} 执行 + {self.queue_pending} 等待"
+        if self.vram_total:
+            text += f" | 显存空闲 {self.vram_free / 2**30:.1f}/{self.vram_total / 2**30:.1f} GB"
+        return text
+
+class BackendHealthMonitor:
+    """
+    后台线程按固定间隔探测每个后端的 /system_stats 和 /queue，记录就绪状态、延迟、队列深度和显存 (backend.health)。
+    两个请求都成功才视为就绪。就绪状态变化时调用监听器 (backend, ready)。
+    ready_future() 在任一后端就绪时完成，派发线程可以与取消令牌一起 wait，无需轮询或消耗重试次数。
+    """
+    def __init__(self, backends, interval=HEALTH_PROBE_INTERVAL, timeout=HEALTH_PROBE_TIMEOUT):
+        self.backends = backends
+        self.interval = interval
+        self.timeout = timeout
+        self._listeners = []
+        self._ready_future = Future()
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def add_listener(self, callback):
+        self._listeners.append(callback)
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="backend_health_monitor", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        # 正在进行的探测最多还需要两个请求的超时，等它结束，之后不会再通知监听器
+        if self._thread is not None and self._thread.is_alive() and self._thread is not threading.current_thread():
+            self._thread.join(timeout=self.timeout * 2 + 1)
+
+    def any_ready(self):
+        return any(backend.health.ready for backend in self.backends)
+
+    def ready_future(self):
+        """任一后端就绪时完成的 Future (所有后端都未就绪时会换成新的 Future)。"""
+        with self._lock:
+            return self._ready_future
+
+    def wait_until_ready(self, timeout=None, cancel_future=None):
+        """等待任一后端就绪，返回是否就绪。cancel_future 完成 (任务被取消) 时提前返回。"""
+        futures = [self.ready_future()] + ([cancel_future] if cancel_future is not None else [])
+        wait_futures(futures, timeout=timeout, return_when=FIRST_COMPLETED)
+        return self.any_ready()
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            for backend in self.backends:
+                if self._stop_event.is_set():
+                    return
+                self.probe(backend)
+            self._stop_event.wait(self.interval)
+
+    def probe(self, backend):
+        health = backend.health
+        was_ready = health.ready
+        try:
+            started = time.time()
+            response = comfy_http.get(f"{backend.base_url}/system_stats", timeout=self.timeout)
+            response.raise_for_status()
+            latency_ms = (time.time() - started) * 1000
+            devices = response.json().get("devices") or []
+            response = comfy_http.get(f"{backend.base_url}/queue", timeout=self.timeout)
+            response.raise_for_status()
+            queue = response.json()
+        except (requests.exceptions.RequestException, ValueError) as e:
+            health.ready = False
+            health.ready_since = None
+            health.consecutive_failures += 1
+            health.last_error = type(e).__name__
+        else:
+            health.ready = True
+            health.ready_since = health.ready_since or time.time()
+            health.latency_ms = latency_ms
+            health.queue_running = len(queue.get("queue_running") or [])
+            health.queue_pending = len(queue.get("queue_pending") or [])
+            health.vram_free = sum(device.get("vram_free") or 0 for device in devices) or None
+            health.vram_total = sum(device.get("vram_total") or 0 for device in devices) or None
+            health.consecutive_failures = 0
+            health.last_error = None
+        health.checked_at = time.time()
+
+        if health.ready != was_ready:
+            print(f"[HealthMonitor] 后端 {backend.name} {'已就绪' if health.ready else '不可用'}")
+            self._update_ready_future()
+            if self._stop_event.is_set():
+                return # 已停止: 不再通知监听器 (调度器等可能已在关闭)
+            for callback in list(self._listeners):
+                try:
+                    callback(backend, health.ready)
+                except Exception as e:
+                    print(f"[HealthMonitor] 监听器出错: {e}")
+
+    def _update_ready_future(self):
+        with self._lock:
+            if self.any_ready():
+                if not self._ready_future.done():
+                    self._ready_future.set_result(True)
+            elif self._ready_future.done():
+                self._ready_future = Future()
@@ -0,0 +1,100 @@
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+POOL_MAXSIZE = 32 # 每个后端 (host:port) 保持的最大 keep-alive 连接数
+DEFAULT_TIMEOUT = (5, 30) # (连接, 读取) 秒
+# 各端点的 (连接, 读取) 超时。按路径前缀匹配，/history/<prompt_id> 之类的路径归入 /history
+ENDPOINT_TIMEOUTS = {
+    "/prompt": (5, 30),
+    "/queue": (3, 5),
+    "/interrupt": (3, 5),
+    "/history": (3, 10),
+    "/system_stats": (3, 3),
+    "/internal/logs": (2, 5),
+    "/settings": (3, 5),
+    "/api/manager/reboot": (3, 10),
+    "/upload/image": (5, 120),
+    "/view": (5, 120),
+}
+
+def endpoint_of(url):
+    """URL -> 统计和超时使用的端点名 (路径前缀)。"""
+    path = urlsplit(url).path or "/"
+    for prefix in ENDPOINT_TIMEOUTS:
+        if path == prefix or path.startswith(prefix + "/"):
+            return prefix
+    return path
+
+class EndpointStats:
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+class ComfyHTTPClient:
+    """
+    所有 ComfyUI HTTP 调用共用的客户端: 连接池 + keep-alive (不再为每个请求新建 TCP 连接，避免大量 TIME_WAIT)，
+    按端点设置超时，并统计每个端点的请求数、错误数和延迟。基于 requests.Session (线程间共享)。
+    请求失败时抛出 requests.exceptions.RequestException，与原来直接调用 requests 时相同。
+    协程中不直接发请求: 需要时用 asyncio.to_thread 调用这里的同步接口。
+    """
+    def __init__(self, pool_maxsize=POOL_MAXSIZE):
+        self.session = requests.Session()
+        self.session.trust_env = False # 只访问 ComfyUI 后端，不读取代理环境变量 (启动时已清除)
+        adapter = HTTPAdapter(pool_connections=8, pool_maxsize=pool_maxsize)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.pool_maxsize = pool_maxsize
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def request(self, method, url, timeout=None, **kwargs):
+        endpoint = endpoint_of(url)
+        started = time.time()
+        failed = True
+        try:
+            response = self.session.request(method, url, timeout=timeout or ENDPOINT_TIMEOUTS.get(endpoint, DEFAULT_TIMEOUT), **kwargs)
+            failed = response.status_code >= 500
+            return response
+        finally:
+            self._record(endpoint, started, failed)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    # --- 统计 ---
+    def _record(self, endpoint, started, failed):
+        elapsed_ms = (time.time() - started) * 1000
+        with self._lock:
+            stats = self._stats.setdefault(endpoint, EndpointStats())
+            stats.count += 1
+            stats.errors += int(failed)
+            stats.total_ms += elapsed_ms
+            stats.max_ms = max(stats.max_ms, elapsed_ms)
+
+    def stats(self):
+        """{端点: {"count", "errors", "avg_ms", "max_ms"}}"""
+        with self._lock:
+            return {endpoint: {"count": s.count, "errors": s.errors, "avg_ms": s.total_ms / s.count if s.count else 0.0,
+                               "max_ms": s.max_ms} for endpoint, s in self._stats.items()}
+
+    def describe(self):
+        """返回 Markdown 表格，用于设置页展示各端点的请求统计。"""
+        lines = ["| 端点 | 请求数 | 错误 | 平均延迟 | 最大延迟 |", "| --- | --- | --- | --- | --- |"]
+        for endpoint, s in sorted(self.stats().items(), key=lambda item: -item[1]["count"]):
+            lines.append(f"| {endpoint} | {s['count']} | {s['errors']} | {s['avg_ms']:.0f} ms | {s['max_ms']:.0f} ms |")
+        return "\n".join(lines)
+
+    def close(self):
+        self.session.close()
+
+# 模块级单例: 所有子系统共用同一个连接池
+comfy_http = ComfyHTTPClient()
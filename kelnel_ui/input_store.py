@@ -0,0 +1,79 @@
+import hashlib
+import io
+import os
+import shutil
+import threading
+
+import numpy as np
+from PIL import Image
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+class InputStore:
+    """
+    按内容寻址保存 Gradio 上传的输入文件 (图像/视频) 到 ComfyUI 的 input 目录。
+
+    文件名为 <prefix>_<sha256 前 16 位><扩展名>，同一内容始终得到同一文件名，
+    因此 GradioInputImage 及其下游节点 (VAE 编码、ControlNet 预处理等) 可以命中 ComfyUI 的执行缓存。
+    put() 返回的文件名即任务元组中保存的句柄，同一次点击排队的多个任务共享同一个文件。
+    """
+    def __init__(self, input_dir, prefix="gradio_input"):
+        self.input_dir = input_dir
+        self.prefix = prefix
+        self._known_sources = {} # (源路径, mtime_ns, size) -> 文件名，避免重复计算同一上传文件的哈希
+        self._lock = threading.Lock()
+
+    def path_of(self, filename):
+        return os.path.join(self.input_dir, filename)
+
+    def put(self, value):
+        """保存输入并返回句柄 (input 目录下的文件名)。value 可以是文件路径、PIL 图像或 numpy 数组；None 返回 None。"""
+        if value is None:
+            return None
+        if isinstance(value, str):
+            return self.put_file(value)
+        if isinstance(value, np.ndarray):
+            value = Image.fromarray(value)
+        if isinstance(value, Image.Image):
+            buffer = io.BytesIO()
+            value.save(buffer, format="PNG")
+            return self.put_bytes(buffer.getvalue(), ".png")
+        raise TypeError(f"未知的输入类型: {type(value)}")
+
+    def put_file(self, src_path):
+        """按源文件的原始字节计算哈希并复制到 input 目录 (已存在则不复制)，不做解码/重新编码。"""
+        stat = os.stat(src_path)
+        source_key = (os.path.abspath(src_path), stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            filename = self._known_sources.get(source_key)
+        if filename and os.path.exists(self.path_of(filename)):
+            return filename
+
+        digest = hashlib.sha256()
+        with open(src_path, "rb") as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+                digest.update(chunk)
+        filename = self._filename_for(digest.hexdigest(), os.path.splitext(src_path)[1])
+        dest_path = self.path_of(filename)
+        if not os.path.exists(dest_path):
+            temp_path = f"{dest_path}.{threading.get_ident()}.tmp"
+            shutil.copyfile(src_path, temp_path)
+            os.replace(temp_path, dest_path)
+            print(f"[InputStore] 新输入文件已保存: {dest_path}")
+        with self._lock:
+            self._known_sources[source_key] = filename
+        return filename
+
+    def put_bytes(self, data, extension):
+        filename = self._filename_for(hashlib.sha256(data).hexdigest(), extension)
+        dest_path = self.path_of(filename)
+        if not os.path.exists(dest_path):
+            temp_path = f"{dest_path}.{threading.get_ident()}.tmp"
+            with open(temp_path, "wb") as f:
+                f.write(data)
+            os.replace(temp_path, dest_path)
+            print(f"[InputStore] 新输入文件已保存: {dest_path}")
+        return filename
+
+    def _filename_for(self, content_hash, extension):
+        return f"{self.prefix}_{content_hash[:16]}{(extension or '').lower()}"
@@ -0,0 +1,134 @@
+from concurrent.futures import ThreadPoolExecutor
+import itertools
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# 任务状态机: queued -> submitted (已进入流水线并提交到 ComfyUI) -> running (流水线队首) -> done / failed
+# 另有 cancelled (用户取消) 和 rejected (后端拒绝工作流)。queued / submitted / running 为未完成状态，进程重启后恢复。
+JOB_STATES = ("queued", "submitted", "running", "done", "failed", "cancelled", "rejected")
+UNFINISHED_JOB_STATES = ("queued", "submitted", "running")
+DEFAULT_KEEP_FINISHED = 2000 # 启动时最多保留的已结束任务记录数
+
+# 任务元组 (submit_generation 的位置参数) 中各字段的名称，数据库中按名称保存为 JSON 对象
+TASK_FIELDS = ("input_image", "input_video", "positive_prompts", "negative_prompt", "workflow", "width", "height",
+               "loras", "checkpoint", "unet", "float_values", "int_values", "seed_mode", "fixed_seed")
+INPUT_FIELDS = ("input_image", "input_video") # 输入文件的内容哈希句柄 (input 目录下的文件名)
+
+def task_to_record(task):
+    """任务元组 -> {字段名: 值}。输入文件在入队前已换成 input_store 句柄，所有值都可以 JSON 序列化。"""
+    return dict(zip(TASK_FIELDS, task))
+
+def record_to_task(record):
+    return tuple(record.get(field) for field in TASK_FIELDS)
+
+class JobStore:
+    """
+    SQLite 持久化的任务记录，使排队中的任务在 ComfyUI 重启 (包括 "重启ComfyUI" 按钮) 或崩溃后仍能恢复。
+    内存中的 FairTaskQueue 仍是调度的依据，这里只记录每个任务的参数和状态变化。
+    写操作按提交顺序在单个后台线程中执行，调用方 (包括持有 queue_lock 的事件循环) 不等待磁盘 I/O。
+    """
+    def __init__(self, db_path):
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                job_id TEXT PRIMARY KEY,
+                seq INTEGER NOT NULL,
+                owner TEXT NOT NULL,
+                session TEXT NOT NULL,
+                user_label TEXT,
+                job_class TEXT NOT NULL,
+                batch INTEGER NOT NULL DEFAULT 0,
+                workflow TEXT,
+                params TEXT NOT NULL,
+                input_hashes TEXT NOT NULL,
+                state TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                prompt_id TEXT,
+                backend TEXT,
+                outputs TEXT,
+                error TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )""")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, seq)")
+        self._conn.commit()
+        self._lock = threading.Lock()
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="job_store")
+        self._seq = itertools.count(self._conn.execute("SELECT COALESCE(MAX(seq), 0) FROM jobs").fetchone()[0] + 1)
+
+    def _execute(self, sql, rows):
+        with self._lock:
+            try:
+                with self._conn:
+                    self._conn.executemany(sql, rows)
+            except sqlite3.Error as e:
+                print(f"[JobStore] 写入任务记录失败: {e}")
+
+    def add_jobs(self, jobs):
+        """记录新入队的任务 (state=queued)。jobs 为 FairTaskQueue 的任务字典。"""
+        now = time.time()
+        rows = []
+        for job in jobs:
+            params = task_to_record(job["task"])
+            rows.append((job["job_id"], next(self._seq), job["owner"], job["session"], job.get("user_label"), job["job_class"],
+                         int(bool(job.get("batch"))), params.get("workflow"), json.dumps(params, ensure_ascii=False),
+                         json.dumps([params.get(field) for field in INPUT_FIELDS]), "queued", now, now))
+        return self._writer.submit(self._execute, """
+            INSERT OR REPLACE INTO jobs (job_id, seq, owner, session, user_label, job_class, batch, workflow, params,
+                                         input_hashes, state, created_at, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""", rows)
+
+    def set_state(self, job_ids, state, **fields):
+        """
+        更新一个或多个任务的状态，fields 可包含 prompt_id / backend / outputs / error / attempts。
+        state 为 None 时只更新 fields (例如提交线程记录 prompt_id，不覆盖同时发生的状态变化)。
+        """
+        if isinstance(job_ids, str):
+            job_ids = [job_ids]
+        columns = [name for name in ("state", "prompt_id", "backend", "outputs", "error", "attempts")
+                   if (name == "state" and state is not None) or name in fields]
+        values = [state if name == "state" else json.dumps(fields[name], ensure_ascii=False) if name == "outputs" else fields[name]
+                  for name in columns]
+        assignments = "".join(f", {name} = ?" for name in columns)
+        now = time.time()
+        rows = [(now, *values, job_id) for job_id in job_ids]
+        if not rows:
+            return None
+        return self._writer.submit(self._execute, f"UPDATE jobs SET updated_at = ?{assignments} WHERE job_id = ?", rows)
+
+    def load_unfinished(self):
+        """按入队顺序返回未完成的任务记录 (dict，params / input_hashes 已解析)。启动时同步调用。"""
+        self.flush()
+        placeholders = ", ".join("?" for _ in UNFINISHED_JOB_STATES)
+        with self._lock:
+            cursor = self._conn.execute(f"SELECT * FROM jobs WHERE state IN ({placeholders}) ORDER BY seq", UNFINISHED_JOB_STATES)
+            columns = [description[0] for description in cursor.description]
+            records = [dict(zip(columns, row)) for row in cursor.fetchall()]
+        for record in records:
+            record["params"] = json.loads(record["params"])
+            record["input_hashes"] = json.loads(record["input_hashes"])
+        return records
+
+    def prune_finished(self, keep=DEFAULT_KEEP_FINISHED):
+        """只保留最近 keep 条已结束的任务记录。"""
+        placeholders = ", ".join("?" for _ in UNFINISHED_JOB_STATES)
+        return self._writer.submit(self._execute, f"""
+            DELETE FROM jobs WHERE state NOT IN ({placeholders}) AND job_id NOT IN (
+                SELECT job_id FROM jobs WHERE state NOT IN ({placeholders}) ORDER BY seq DESC LIMIT ?)""",
+            [(*UNFINISHED_JOB_STATES, *UNFINISHED_JOB_STATES, keep)])
+
+    def flush(self):
+        """等待已提交的写操作完成。"""
+        self._writer.submit(lambda: None).result()
+
+    def close(self):
+        self._writer.shutdown(wait=True)
+        with self._lock:
+            self._conn.close()
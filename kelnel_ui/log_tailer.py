@@ -0,0 +1,117 @@
+from collections import deque
+import threading
+import time
+
+import requests
+
+from .http_client import comfy_http
+
+LOG_POLL_INTERVAL = 0.5 # 服务端拉取日志的间隔 (秒)
+MAX_LOG_LINES = 2000 # 环形缓冲区保留的日志条数
+LOG_IDLE_PAUSE = 10 # 超过这么久没有标签页取日志时暂停拉取 (秒)，有标签页再来取时恢复
+
+class LogTailer:
+    """
+    服务端唯一的日志拉取线程: 按固定间隔读取当前后端 (backend_pool.active_backend) 的 /internal/logs/raw，
+    只把上次之后的新条目追加到有界环形缓冲区。每条日志有递增序号，各浏览器标签页用自己的游标调用
+    lines_since() 只取新增部分，不再每个标签页每 0.1 秒各自下载并推送整份日志。
+    ComfyUI 只提供整份日志，因此没有标签页在取日志时暂停拉取。
+    """
+    def __init__(self, backend_pool, log_path="/internal/logs/raw", interval=LOG_POLL_INTERVAL, max_lines=MAX_LOG_LINES):
+        self.backend_pool = backend_pool
+        self.log_path = log_path
+        self.interval = interval
+        self._lines = deque(maxlen=max_lines)
+        self._next_seq = 0 # 下一条日志的序号，即最新的游标
+        self._last_entry = None # 最后一条已收录日志的 (时间, 内容)，用于在新拉取的整份日志中定位新增部分
+        self._last_backend = None
+        self._status_noted = None # 已写入缓冲区的连接状态提示，避免重复
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._demand = threading.Event() # lines_since() 被调用时置位，唤醒暂停中的拉取线程
+        self._last_demand = 0.0
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="comfyui_log_tailer", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        self._demand.set()
+
+    def lines_since(self, cursor):
+        """
+        返回 (新游标, 新增日志列表, 是否重置)。cursor 为 None 或已被环形缓冲区淘汰时返回缓冲区中的全部日志，
+        reset 为 True 表示客户端应替换而不是追加。
+        """
+        self._last_demand = time.time()
+        self._demand.set()
+        with self._lock:
+            first_seq = self._next_seq - len(self._lines)
+            if cursor is None or cursor < first_seq or cursor > self._next_seq:
+                return self._next_seq, list(self._lines), True
+            return self._next_seq, list(self._lines)[cursor - first_seq:], False
+
+    def _append(self, lines):
+        with self._lock:
+            self._lines.extend(lines)
+            self._next_seq += len(lines)
+
+    def _note_status(self, status):
+        if status != self._status_noted:
+            self._status_noted = status
+            if status:
+                self._append([status])
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            if time.time() - self._last_demand > LOG_IDLE_PAUSE:
+                self._demand.clear()
+                if time.time() - self._last_demand > LOG_IDLE_PAUSE:
+                    self._demand.wait()
+                continue
+            try:
+                self._poll_once()
+            except Exception as e:
+                print(f"[LogTailer] 读取日志出错: {e}")
+            self._stop_event.wait(self.interval)
+
+    def _poll_once(self):
+        backend = self.backend_pool.active_backend
+        if backend is not self._last_backend:
+            if self._last_backend is not None:
+                self._append([f"--- 日志切换到后端 {backend.name} ---"])
+            self._last_backend = backend
+            self._last_entry = None
+        if not backend.health.ready:
+            # 后端未就绪 (重启中等) 时不发请求
+            self._note_status(f"[等待 ComfyUI 后端就绪: {backend.health.summary()}]")
+            return
+        try:
+            response = comfy_http.get(f"{backend.base_url}{self.log_path}")
+            response.raise_for_status()
+            entries = response.json().get("entries", [])
+        except (requests.exceptions.RequestException, ValueError) as e:
+            self._note_status(f"[无法读取 ComfyUI 日志: {type(e).__name__}]")
+            return
+        self._note_status(None)
+
+        keys = [(entry.get("t"), entry.get("m", "")) for entry in entries]
+        if self._last_entry is None:
+            new_keys = keys
+        elif self._last_entry in keys:
+            new_keys = keys[len(keys) - keys[::-1].index(self._last_entry):] # 最后一次出现之后的条目为新增
+        else:
+            # 上次的最后一条已被 ComfyUI 的环形缓冲区淘汰: 按时间戳 (ISO 格式字符串) 取更新的条目，而不是重新追加整份日志
+            last_time = self._last_entry[0]
+            new_keys = [key for key in keys if last_time is not None and key[0] is not None and key[0] > last_time]
+        if keys:
+            self._last_entry = keys[-1]
+        # 移除多余空行
+        new_lines = [message.strip() for _, message in new_keys if message and message.strip()]
+        if new_lines:
+            self._append(new_lines)
@@ -0,0 +1,158 @@
+import io
+import json
+import math
+import threading
+import time
+
+from PIL import Image
+from PIL.PngImagePlugin import PngInfo
+
+OUTPUT_FORMATS = ["png", "png_fast", "webp_lossless", "webp", "jpeg"]
+OUTPUT_PRESETS = ["custom", "preview", "final"]
+FORMAT_EXTENSIONS = {"png": ".png", "png_fast": ".png", "webp_lossless": ".webp", "webp": ".webp", "jpeg": ".jpg"}
+# 预设覆盖节点上的对应参数: preview 追求速度和体积，final 为归档用的无损 PNG + 元数据
+PRESET_SETTINGS = {
+    "preview": {"output_format": "webp", "quality": 80, "embed_metadata": False},
+    "final": {"output_format": "png", "png_compress_level": 6, "embed_metadata": True},
+}
+# 超出时间预算时的降级路线
+FASTER_FORMAT = {"png": "png_fast", "webp_lossless": "webp"}
+FAST_PNG_COMPRESS_LEVEL = 1
+BUDGET_QUALITY_STEP = 10
+MIN_BUDGET_QUALITY = 40
+JPEG_MAX_EXIF_BYTES = 65533 # JPEG 的 APP1 段上限
+
+class EncodeStats:
+    """按格式累计编码耗时与输出大小 (每百万像素)，用于时间预算估算和调参。"""
+    def __init__(self):
+        self._totals = {} # format -> [图片数, 百万像素, 秒, 字节]
+        self._lock = threading.Lock()
+
+    def record(self, output_format, megapixels, seconds, num_bytes):
+        with self._lock:
+            totals = self._totals.setdefault(output_format, [0, 0.0, 0.0, 0])
+            totals[0] += 1
+            totals[1] += megapixels
+            totals[2] += seconds
+            totals[3] += num_bytes
+
+    def estimate_seconds(self, output_format, megapixels):
+        """按历史平均估算编码一张图的耗时，没有历史数据时返回 None。"""
+        with self._lock:
+            totals = self._totals.get(output_format)
+        if not totals or totals[1] <= 0:
+            return None
+        return totals[2] / totals[1] * megapixels
+
+    def summary(self):
+        """{format: {"images", "ms_per_mp", "kb_per_mp"}}"""
+        with self._lock:
+            return {fmt: {"images": t[0],
+                          "ms_per_mp": round(t[2] * 1000 / t[1], 1) if t[1] else None,
+                          "kb_per_mp": round(t[3] / 1024 / t[1], 1) if t[1] else None}
+                    for fmt, t in self._totals.items()}
+
+class OutputPolicy:
+    """
+    Hua_Output 的输出格式与压缩策略。
+
+    - output_format: png (png_compress_level) / png_fast (level 1) / webp_lossless / webp / jpeg (quality)
+    - embed_metadata: PNG 写入文本块；WebP/JPEG 写入 EXIF (与 ComfyUI 的 WebP 保存节点相同的标签约定)
+    - max_kb_per_image: 有损格式超出时逐步降低质量重新编码；无损格式只在统计中标记 over_budget
+    - max_encode_seconds: 按 encode_stats 的历史数据估算整批耗时，超出时改用更快的格式
+    """
+    def __init__(self, output_format="png", png_compress_level=4, quality=90, embed_metadata=False,
+                 max_kb_per_image=0, max_encode_seconds=0.0):
+        if output_format not in FORMAT_EXTENSIONS:
+            print(f"[OutputPolicy] 未知的输出格式 {output_format}，使用 png")
+            output_format = "png"
+        self.output_format = output_format
+        self.png_compress_level = int(png_compress_level)
+        self.quality = int(quality)
+        self.embed_metadata = bool(embed_metadata)
+        self.max_kb_per_image = int(max_kb_per_image or 0)
+        self.max_encode_seconds = float(max_encode_seconds or 0)
+
+    @classmethod
+    def from_node_inputs(cls, preset="custom", **settings):
+        settings.update(PRESET_SETTINGS.get(preset, {}))
+        return cls(**settings)
+
+    @property
+    def extension(self):
+        return FORMAT_EXTENSIONS[self.output_format]
+
+    def plan_for_batch(self, batch_size, width, height, workers):
+        """按时间预算调整本批次的格式: 估算耗时超出 max_encode_seconds 时沿 FASTER_FORMAT 降级。"""
+        if self.max_encode_seconds <= 0:
+            return
+        megapixels = width * height / 1e6
+        rounds = math.ceil(batch_size / max(1, workers))
+        while self.output_format in FASTER_FORMAT:
+            per_image = encode_stats.estimate_seconds(self.output_format, megapixels)
+            if per_image is None or per_image * rounds <= self.max_encode_seconds:
+                return
+            faster = FASTER_FORMAT[self.output_format]
+            print(f"[OutputPolicy] 预计编码耗时 {per_image * rounds:.2f}s 超出预算 {self.max_encode_seconds}s，{self.output_format} -> {faster}")
+            self.output_format = faster
+
+    def build_metadata(self, prompt=None, extra_pnginfo=None):
+        """整批共用的元数据对象 (PngInfo 或 Exif)，不需要嵌入时返回 None。"""
+        if not self.embed_metadata or (prompt is None and not extra_pnginfo):
+            return None
+        if self.output_format in ("png", "png_fast"):
+            metadata = PngInfo()
+            if prompt is not None:
+                metadata.add_text("prompt", json.dumps(prompt))
+            for key, value in (extra_pnginfo or {}).items():
+                metadata.add_text(key, json.dumps(value))
+            return metadata
+        exif = Image.Exif()
+        if prompt is not None:
+            exif[0x0110] = "prompt:{}".format(json.dumps(prompt))
+        tag = 0x010F
+        for key, value in (extra_pnginfo or {}).items():
+            exif[tag] = "{}:{}".format(key, json.dumps(value))
+            tag -= 1
+        if self.output_format == "jpeg" and len(exif.tobytes()) > JPEG_MAX_EXIF_BYTES:
+            print("[OutputPolicy] 元数据超出 JPEG EXIF 上限 (64KB)，本批次不嵌入元数据")
+            return None
+        return exif
+
+    def encode(self, pixels, image_path, metadata=None):
+        """把 HWC uint8 数组编码写入 image_path，返回该图的编码统计。"""
+        img = Image.fromarray(pixels)
+        start_time = time.perf_counter()
+        quality = self.quality
+        data = self._encode_bytes(img, quality, metadata)
+        budget_bytes = self.max_kb_per_image * 1024
+        while budget_bytes and len(data) > budget_bytes and self.output_format in ("webp", "jpeg") and quality > MIN_BUDGET_QUALITY:
+            quality = max(MIN_BUDGET_QUALITY, quality - BUDGET_QUALITY_STEP)
+            data = self._encode_bytes(img, quality, metadata)
+        encode_seconds = time.perf_counter() - start_time
+        with open(image_path, "wb") as f:
+            f.write(data)
+        stat = {"format": self.output_format, "bytes": len(data), "encode_ms": round(encode_seconds * 1000, 1)}
+        if self.output_format in ("webp", "jpeg"):
+            stat["quality"] = quality
+        if budget_bytes and len(data) > budget_bytes:
+            stat["over_budget"] = True
+        encode_stats.record(self.output_format, img.width * img.height / 1e6, encode_seconds, len(data))
+        return stat
+
+    def _encode_bytes(self, img, quality, metadata):
+        buffer = io.BytesIO()
+        if self.output_format == "png":
+            img.save(buffer, format="PNG", compress_level=self.png_compress_level, pnginfo=metadata)
+        elif self.output_format == "png_fast":
+            img.save(buffer, format="PNG", compress_level=FAST_PNG_COMPRESS_LEVEL, pnginfo=metadata)
+        elif self.output_format == "webp_lossless":
+            img.save(buffer, format="WEBP", lossless=True, exif=metadata or b"")
+        elif self.output_format == "webp":
+            img.save(buffer, format="WEBP", quality=quality, exif=metadata or b"")
+        else:
+            img.save(buffer, format="JPEG", quality=quality, exif=metadata or b"")
+        return buffer.getvalue()
+
+# 模块级单例: 所有 Hua_Output 共享编码统计
+encode_stats = EncodeStats()
@@ -0,0 +1,158 @@
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import os
+import re
+import threading
+
+from .http_client import comfy_http
+
+TRANSPORT_LOCAL = "local"   # 与 Gradio 共享文件系统: 输入直接写入 input 目录，输出按本地路径读取
+TRANSPORT_REMOTE = "remote" # 无共享文件系统: 输入经 /upload/image 上传，输出经 /history + /view 下载
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+OUTPUT_MEDIA_KEYS = ("images", "videos", "gifs") # /history 中节点输出的文件列表字段
+
+def _safe_dir_name(text):
+    return re.sub(r"[^0-9A-Za-z._-]+", "_", text)
+
+class StaleInputError(Exception):
+    """后端拒绝了 prompt，因为之前上传的输入文件已不存在 (后端重启、input 目录被清理)。重新上传后可以再提交。"""
+
+class RemoteTransport:
+    """
+    远程 ComfyUI 后端的文件传输。
+
+    - upload_input(): 通过 /upload/image 上传输入文件，文件名取内容哈希，同一后端相同内容只上传一次。
+      后端重启后 (forget_backend) 或后端报告文件不存在时 (forget_missing_inputs) 清除该后端的上传记录。
+    - fetch_outputs(): 读取 /history/{prompt_id} 中输出节点记录的文件，经 /view 并发流式下载到本地缓存目录。
+      缓存按 后端/类型/子目录/文件名 存放，已下载的文件不会重复下载。
+    """
+    def __init__(self, cache_dir, max_workers=4, request_timeout=None): # None: 使用 http_client 的端点超时
+        self.cache_dir = cache_dir
+        self.request_timeout = request_timeout
+        self.transfer_executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="remote_transport") # 并发上传和下载
+        self.uploaded = {} # (address, content_hash) -> ComfyUI 中的文件名
+        self.lock = threading.Lock()
+
+    # --- 上传 ---
+    def upload_input(self, backend, data, extension, prefix="gradio_input"):
+        """上传输入文件 (bytes 或本地文件路径)，返回可直接写入节点 inputs 的文件名。"""
+        if isinstance(data, (bytes, bytearray)):
+            content_hash = hashlib.sha256(data).hexdigest()
+        else:
+            content_hash = self._hash_file(data)
+        key = (backend.address, content_hash)
+        with self.lock:
+            cached_name = self.uploaded.get(key)
+        if cached_name:
+            print(f"[RemoteTransport] 输入内容已存在于 {backend.name}，跳过上传: {cached_name}")
+            return cached_name
+
+        filename = f"{prefix}_{content_hash[:16]}{extension}"
+        upload_url = f"{backend.base_url}/upload/image"
+        form = {"type": "input", "overwrite": "true"}
+        if isinstance(data, (bytes, bytearray)):
+            response = comfy_http.post(upload_url, files={"image": (filename, data)}, data=form, timeout=self.request_timeout)
+        else:
+            with open(data, "rb") as f: # 以文件对象传入，避免先整体读入内存
+                response = comfy_http.post(upload_url, files={"image": (filename, f)}, data=form, timeout=self.request_timeout)
+        response.raise_for_status()
+        result = response.json()
+        name = result.get("name", filename)
+        if result.get("subfolder"):
+            name = f"{result['subfolder']}/{name}"
+        with self.lock:
+            self.uploaded[key] = name
+        print(f"[RemoteTransport] 已上传输入文件到 {backend.name}: {name}")
+        return name
+
+    def upload_input_async(self, backend, data, extension, prefix="gradio_input"):
+        """在传输线程池中上传，返回结果为文件名的 Future，图像和视频等多个输入可以同时上传。"""
+        return self.transfer_executor.submit(self.upload_input, backend, data, extension, prefix)
+
+    def forget_backend(self, backend):
+        """清除某个后端的上传记录 (后端重启后 input 目录可能已不同)，下次使用时重新上传。"""
+        with self.lock:
+            for key in [key for key in self.uploaded if key[0] == backend.address]:
+                del self.uploaded[key]
+
+    def forget_missing_inputs(self, backend, error_text):
+        """后端的错误信息 (/prompt 的 400 响应) 中提到了已上传的文件名时清除这些记录，返回被清除的文件名列表。"""
+        with self.lock:
+            stale = [(key, name) for key, name in self.uploaded.items() if key[0] == backend.address and name in error_text]
+            for key, _ in stale:
+                del self.uploaded[key]
+        return [name for _, name in stale]
+
+    @staticmethod
+    def _hash_file(path):
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    # --- 下载 ---
+    def get_history(self, backend, prompt_id):
+        """返回 /history/{prompt_id} 中该 prompt 的记录，尚未完成时返回 None。"""
+        response = comfy_http.get(f"{backend.base_url}/history/{prompt_id}", timeout=self.request_timeout)
+        response.raise_for_status()
+        return response.json().get(prompt_id)
+
+    def fetch_outputs(self, backend, prompt_id, node_id=None, history_item=None):
+        """
+        下载 prompt 的输出文件到本地缓存，返回与输出节点交付格式一致的数据:
+        {"generated_files": [本地路径...]} 或 {"error": str, "generated_files": [...]}。
+        node_id 指定时只取该节点的输出。prompt 尚未出现在 /history 中时返回 None。
+        """
+        if history_item is None:
+            history_item = self.get_history(backend, prompt_id)
+        if not history_item:
+            return None
+        outputs = history_item.get("outputs") or {}
+        node_outputs = [outputs.get(node_id) or {}] if node_id is not None else list(outputs.values())
+
+        file_refs = []
+        errors = []
+        for node_output in node_outputs:
+            errors.extend(node_output.get("error") or [])
+            for media_key in OUTPUT_MEDIA_KEYS:
+                file_refs.extend(ref for ref in node_output.get(media_key) or [] if ref.get("filename"))
+
+        download_futures = [self.transfer_executor.submit(self._download, backend, ref) for ref in file_refs]
+        local_paths = []
+        for future in download_futures:
+            try:
+                local_paths.append(future.result())
+            except Exception as e:
+                errors.append(f"下载输出文件失败: {e}")
+
+        result = {"generated_files": local_paths}
+        if errors:
+            result["error"] = "; ".join(str(e) for e in errors)
+        return result
+
+    def _download(self, backend, file_ref):
+        filename = os.path.basename(file_ref["filename"])
+        subfolder = file_ref.get("subfolder") or ""
+        file_type = file_ref.get("type") or "output"
+        local_dir = os.path.join(self.cache_dir, _safe_dir_name(backend.address), file_type,
+                                 *[_safe_dir_name(part) for part in subfolder.replace("\\", "/").split("/") if part])
+        local_path = os.path.join(local_dir, filename)
+        if os.path.exists(local_path) and os.path.getsize(local_path) > 0:
+            return local_path # ComfyUI 的输出文件名不会复用，已缓存即为同一内容
+
+        os.makedirs(local_dir, exist_ok=True)
+        partial_path = f"{local_path}.part"
+        params = {"filename": file_ref["filename"], "subfolder": subfolder, "type": file_type}
+        with comfy_http.get(f"{backend.base_url}/view", params=params, stream=True, timeout=self.request_timeout) as response:
+            response.raise_for_status()
+            with open(partial_path, "wb") as f:
+                for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    if chunk:
+                        f.write(chunk)
+        os.replace(partial_path, local_path)
+        print(f"[RemoteTransport] 已从 {backend.name} 下载输出文件: {local_path}")
+        return local_path
+
+    def shutdown(self):
+        self.transfer_executor.shutdown(wait=False)
@@ -0,0 +1,86 @@
+import json
+import os
+import threading
+
+MANIFEST_VERSION = 2
+SEED_INPUT_NAMES = ("seed", "noise_seed")
+
+def manifest_path(temp_dir, unique_id):
+    return os.path.join(temp_dir, f"{unique_id}.json")
+
+def write_json_atomic(path, data):
+    """先写同目录下的临时文件再 os.replace，读取方只会看到完整的旧版本或新版本。"""
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(temp_path, path)
+
+def find_seed(prompt):
+    """从工作流中取第一个整数种子 (seed / noise_seed 输入)，没有则返回 None。"""
+    for node_data in (prompt or {}).values():
+        inputs = node_data.get("inputs") if isinstance(node_data, dict) else None
+        for name in SEED_INPUT_NAMES:
+            value = (inputs or {}).get(name)
+            if isinstance(value, int) and not isinstance(value, bool):
+                return value
+    return None
+
+def write_result_manifest(temp_dir, unique_id, generated_files, error=None, **fields):
+    """一次性写入完整的 manifest (视频节点、错误结果等不逐张交付的场景)。"""
+    data = {"version": MANIFEST_VERSION, "unique_id": unique_id, "complete": True,
+            "generated_files": list(generated_files or []),
+            "items": [{"index": i, "file": path} for i, path in enumerate(generated_files or [])]}
+    data.update(fields)
+    if error:
+        data["error"] = error
+    os.makedirs(temp_dir, exist_ok=True)
+    path = manifest_path(temp_dir, unique_id)
+    write_json_atomic(path, data)
+    return path
+
+def read_result_manifest(path):
+    """
+    读取 manifest，返回 dict (v1 的路径列表 / {"generated_files"} 视为已完成的 v2)；文件不存在时返回 None。
+    写入是原子的，读到的内容总是完整的 JSON，不需要重试。
+    """
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return None
+    if isinstance(data, list):
+        return {"version": 1, "complete": True, "generated_files": data}
+    if isinstance(data, dict) and data.get("version") != MANIFEST_VERSION:
+        data.setdefault("complete", True)
+    return data
+
+class ResultManifestWriter:
+    """
+    manifest v2 (TEMP_DIR/<unique_id>.json): 输出节点每保存一张图追加一条记录并原子地重写整个文件，
+    进程外的 Gradio 可以在批次完成前逐张显示。最后 finish() 标记 complete。
+
+    {"version": 2, "unique_id", "node_id", "seed", "complete": bool, "error"?,
+     "generated_files": [按批次顺序的已完成文件],
+     "items": [{"index", "file", "width", "height", "format", "bytes", "encode_ms"}, ...]}
+    """
+    def __init__(self, temp_dir, unique_id, node_id=None, seed=None):
+        os.makedirs(temp_dir, exist_ok=True)
+        self.path = manifest_path(temp_dir, unique_id)
+        self.data = {"version": MANIFEST_VERSION, "unique_id": unique_id, "node_id": node_id, "seed": seed,
+                     "complete": False, "generated_files": [], "items": []}
+        self._lock = threading.Lock()
+
+    def add_item(self, index, file_path, **metadata):
+        with self._lock:
+            self.data["items"].append(dict(metadata, index=index, file=file_path))
+            self.data["items"].sort(key=lambda item: item["index"])
+            self.data["generated_files"] = [item["file"] for item in self.data["items"]]
+            write_json_atomic(self.path, self.data)
+
+    def finish(self, error=None):
+        with self._lock:
+            self.data["complete"] = True
+            if error:
+                self.data["error"] = error
+            write_json_atomic(self.path, self.data)
+        return self.path
@@ -0,0 +1,83 @@
+from concurrent.futures import Future
+import threading
+
+class ResultRegistry:
+    """
+    进程内结果登记表，按 unique_id 在输出节点 (Hua_Output / Hua_Video_Output) 与 Gradio 队列之间传递结果。
+
+    Gradio 与 ComfyUI 运行在同一进程时，submit_generation 在提交前调用 expect(unique_id)，
+    输出节点执行结束后调用 publish()，等待方直接拿到 Future 结果，无需经过 TEMP_DIR 文件中转。
+    publish() 返回 False 表示本进程内没有人在等待 (例如 Gradio 在其他进程)，此时节点应回退为写临时文件。
+    结果结构与临时文件 JSON 保持一致: {"generated_files": [...]} 或 {"error": str, "generated_files": [...]}
+    批量输出时，节点每写完一个文件调用 publish_partial()，Gradio 在最终结果到达前即可展示已完成的图片。
+    "先显示后落盘" 模式下，节点先以 uint8 数组交付预览 (publish_partial 同一 index)，文件写完后替换为路径，
+    全部写完后再 publish() 最终路径列表。
+    """
+    def __init__(self):
+        self._entries = {} # unique_id -> Future
+        self._partials = {} # unique_id -> {批次序号: 文件路径或 uint8 数组}
+        self._listeners = [] # callback(unique_id)，结果或单张结果交付后调用 (例如唤醒等待中的 Gradio 协程)
+        self._lock = threading.Lock()
+
+    def add_listener(self, callback):
+        self._listeners.append(callback)
+
+    def _notify(self, unique_id):
+        for callback in self._listeners:
+            try:
+                callback(unique_id)
+            except Exception as e:
+                print(f"[ResultRegistry] 通知回调出错: {e}")
+
+    def expect(self, unique_id):
+        """登记一个等待中的结果，返回对应的 Future。"""
+        with self._lock:
+            future = self._entries.get(unique_id)
+            if future is None:
+                future = Future()
+                self._entries[unique_id] = future
+            return future
+
+    def publish(self, unique_id, generated_files, error=None):
+        """输出节点发布结果。返回 True 表示已交付给进程内的等待方。"""
+        with self._lock:
+            future = self._entries.get(unique_id)
+        if future is None or future.done():
+            return False
+        payload = {"generated_files": list(generated_files or [])}
+        if error:
+            payload["error"] = error
+        future.set_result(payload)
+        self._notify(unique_id)
+        return True
+
+    def is_waiting(self, unique_id):
+        """本进程内是否有人在等待该结果 (输出节点据此决定能否只交付内存中的图像)。"""
+        with self._lock:
+            future = self._entries.get(unique_id)
+            return future is not None and not future.done()
+
+    def publish_partial(self, unique_id, item, index=None):
+        """输出节点交付单张结果 (文件路径或 uint8 数组)，相同 index 的后一次交付替换前一次。没有进程内等待方时返回 False。"""
+        with self._lock:
+            if unique_id not in self._entries:
+                return False
+            partials = self._partials.setdefault(unique_id, {})
+            partials[len(partials) if index is None else index] = item
+        self._notify(unique_id)
+        return True
+
+    def partial_files(self, unique_id):
+        """返回已交付的单张结果 (按批次序号)，最终结果以 publish() 为准。"""
+        with self._lock:
+            partials = self._partials.get(unique_id) or {}
+            return [partials[index] for index in sorted(partials)]
+
+    def discard(self, unique_id):
+        """等待方结束 (成功、失败或超时) 后移除登记。"""
+        with self._lock:
+            self._entries.pop(unique_id, None)
+            self._partials.pop(unique_id, None)
+
+# 模块级单例: 节点与 Gradio 队列共享同一个实例
+result_registry = ResultRegistry()
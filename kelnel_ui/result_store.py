@@ -0,0 +1,97 @@
+from collections import namedtuple, OrderedDict
+import threading
+
+DEFAULT_RESULT_HISTORY_LIMIT = 200 # 图库最多保留的图片数，更早的结果移出内存 (文件仍在输出目录)
+
+ResultSnapshot = namedtuple("ResultSnapshot", ["version", "images", "video", "paged_out"])
+
+class ResultStore:
+    """
+    单个会话的 Gradio 结果区 (图库 + 视频)，取代 accumulated_image_results / last_video_result 两个全局变量。
+
+    每次修改 version 加一，队列循环记住自己上次发送的版本，版本未变化时不重复推送图库和视频。
+    图片历史上限为 history_limit，超出的最早结果被移出 (paged_out 计数)，避免长批量时每次推送的列表无限增长。
+    """
+    def __init__(self, history_limit=DEFAULT_RESULT_HISTORY_LIMIT):
+        self.history_limit = history_limit
+        self.version = 0
+        self._images = []
+        self._video = None
+        self._paged_out = 0
+        self._lock = threading.Lock()
+
+    def snapshot(self):
+        with self._lock:
+            return ResultSnapshot(self.version, list(self._images), self._video, self._paged_out)
+
+    def start_batch(self):
+        """批量任务开始: 清除旧图片和视频。"""
+        self.clear()
+
+    def replace_images(self, paths):
+        """单任务模式: 新结果替换图库，并清除视频。"""
+        with self._lock:
+            self._images = []
+            self._paged_out = 0
+            self._video = None
+            self._append_locked(paths)
+            self.version += 1
+
+    def extend_images(self, paths):
+        """批量模式: 新结果追加到图库末尾，并清除视频。"""
+        with self._lock:
+            self._video = None
+            self._append_locked(paths)
+            self.version += 1
+
+    def set_video(self, path):
+        """视频只显示最新的一个，同时清除图片。"""
+        with self._lock:
+            self._images = []
+            self._paged_out = 0
+            self._video = path
+            self.version += 1
+
+    def clear_video(self):
+        with self._lock:
+            if self._video is not None:
+                self._video = None
+                self.version += 1
+
+    def clear(self):
+        with self._lock:
+            self._images = []
+            self._paged_out = 0
+            self._video = None
+            self.version += 1
+
+    def _append_locked(self, paths):
+        self._images.extend(paths or [])
+        overflow = len(self._images) - self.history_limit
+        if overflow > 0:
+            del self._images[:overflow]
+            self._paged_out += overflow
+
+DEFAULT_MAX_SESSIONS = 64 # 最多保留结果区的会话数，最久未访问的会话被移除 (关闭的浏览器标签页不会通知后端)
+
+class SessionResultStores:
+    """每个 Gradio 会话 (浏览器标签页) 一个 ResultStore，各标签页只看到自己任务的结果。"""
+    def __init__(self, max_sessions=DEFAULT_MAX_SESSIONS, history_limit=DEFAULT_RESULT_HISTORY_LIMIT):
+        self.max_sessions = max_sessions
+        self.history_limit = history_limit
+        self._stores = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, session_id):
+        with self._lock:
+            store = self._stores.get(session_id)
+            if store is None:
+                store = self._stores[session_id] = ResultStore(self.history_limit)
+                while len(self._stores) > self.max_sessions:
+                    self._stores.popitem(last=False)
+            else:
+                self._stores.move_to_end(session_id)
+            return store
+
+# 模块级单例: 按会话划分的结果区
+session_results = SessionResultStores()
@@ -0,0 +1,109 @@
+import random
+import threading
+import time
+
+TRIAL_TIMEOUT = 60.0 # half_open 试探请求超过这么久仍未记录结果时视为丢失，允许新的试探 (大于 /prompt 的超时)
+
+def backoff_delay(attempt, base=0.5, cap=15.0):
+    """全抖动 (full jitter) 指数退避: 在 [0, min(cap, base * 2^attempt)] 中均匀取值，避免多个任务同时重试。"""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+class BackendUnavailableError(Exception):
+    """
+    后端暂时不能接收 prompt (断路器打开、退避中或请求失败)。调度器把任务放回队列，再分配给就绪的后端。
+    maybe_sent 为 True 表示请求可能已到达后端 (超时、连接中断、5xx)，重试前应先查询该 prompt_id 是否已被接收。
+    """
+    def __init__(self, message, maybe_sent=False):
+        super().__init__(message)
+        self.maybe_sent = maybe_sent
+
+class CircuitBreaker:
+    """
+    单个后端的断路器。
+    closed: 正常提交，每次失败后按抖动指数退避暂停一小段时间，连续失败 failure_threshold 次后打开；
+    open: 暂停向该后端提交，reset_timeout 秒后进入 half_open；
+    half_open: 允许一次试探，成功则关闭，失败则重新打开并把等待时间翻倍 (最多 max_reset_timeout)。
+    提交方在发请求前调用 begin_request()，half_open 状态下只有第一个调用者得到试探名额，其他提交方在结果记录前不向该后端提交。
+    """
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, failure_threshold=3, reset_timeout=2.0, max_reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.base_reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self._reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._retry_at = 0.0 # closed 状态下失败后的退避: 此前不向该后端提交
+        self._trial_in_flight = False # half_open 下已放行试探请求，等待 record_success/record_failure
+        self._trial_started = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state_locked()
+
+    def _state_locked(self):
+        if self._opened_at is None:
+            return self.CLOSED
+        if time.time() - self._opened_at >= self._reset_timeout:
+            return self.HALF_OPEN
+        return self.OPEN
+
+    def is_open(self):
+        return self.state == self.OPEN
+
+    def _trial_pending_locked(self):
+        return self._trial_in_flight and time.time() - self._trial_started < TRIAL_TIMEOUT
+
+    def allows_request(self):
+        """是否可以向该后端提交: 断路器未打开，不在上次失败后的退避时间内，half_open 时没有进行中的试探。只查询，不占用试探名额。"""
+        return self.seconds_until_retry() == 0
+
+    def begin_request(self):
+        """提交前调用，可以提交时返回 True。half_open 状态下只放行一个试探请求，结果由 record_success/record_failure 记录。"""
+        with self._lock:
+            state = self._state_locked()
+            if state == self.OPEN:
+                return False
+            if state == self.CLOSED:
+                return time.time() >= self._retry_at
+            if self._trial_pending_locked():
+                return False
+            self._trial_in_flight = True
+            self._trial_started = time.time()
+            return True
+
+    def seconds_until_retry(self):
+        """距离允许再次提交的秒数 (断路器打开时为允许试探的时间，closed 状态下为退避的剩余时间)，可以提交时为 0。"""
+        with self._lock:
+            state = self._state_locked()
+            if state == self.OPEN:
+                return max(0.0, self._opened_at + self._reset_timeout - time.time())
+            if state == self.CLOSED:
+                return max(0.0, self._retry_at - time.time())
+            if self._trial_pending_locked():
+                return max(0.0, self._trial_started + TRIAL_TIMEOUT - time.time())
+            return 0.0
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._retry_at = 0.0
+            self._trial_in_flight = False
+            self._reset_timeout = self.base_reset_timeout
+
+    def record_failure(self):
+        with self._lock:
+            state = self._state_locked()
+            self._failures += 1
+            self._trial_in_flight = False
+            if state == self.HALF_OPEN:
+                self._reset_timeout = min(self.max_reset_timeout, self._reset_timeout * 2) # 试探失败: 等待更久
+                self._opened_at = time.time()
+            elif state == self.CLOSED and self._failures >= self.failure_threshold:
+                self._opened_at = time.time()
+            elif state == self.CLOSED:
+                self._retry_at = time.time() + backoff_delay(self._failures - 1)
@@ -0,0 +1,41 @@
+import asyncio
+import threading
+
+class StateNotifier:
+    """
+    跨线程的状态变化通知，供 asyncio 协程等待。
+    任意线程调用 notify() 递增版本号并唤醒所有等待中的协程；协程用 wait_for_change(上次看到的版本) 等待，
+    版本已变化时立即返回，因此两次等待之间发生的通知不会丢失。
+    """
+    def __init__(self):
+        self.version = 0
+        self._waiters = set() # (loop, asyncio.Future)
+        self._lock = threading.Lock()
+
+    def notify(self, *_):
+        with self._lock:
+            self.version += 1
+            waiters = list(self._waiters)
+        for loop, waiter in waiters:
+            loop.call_soon_threadsafe(self._wake, waiter)
+
+    @staticmethod
+    def _wake(waiter):
+        if not waiter.done():
+            waiter.set_result(None)
+
+    async def wait_for_change(self, seen_version, timeout=None, other_awaitables=()):
+        """等待版本号超过 seen_version、other_awaitables 中任一完成或超时，返回当前版本号。"""
+        loop = asyncio.get_running_loop()
+        waiter = loop.create_future()
+        entry = (loop, waiter)
+        with self._lock:
+            if self.version != seen_version:
+                return self.version
+            self._waiters.add(entry)
+        try:
+            await asyncio.wait([waiter, *other_awaitables], timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            with self._lock:
+                self._waiters.discard(entry)
+        return self.version
@@ -1,7 +1,11 @@
 import gradio as gr
+import threading
 import time
 import os
-import uuid
+
+MONITOR_SAMPLE_INTERVAL = 1.0 # 采样间隔 (秒)
+DISK_REFRESH_INTERVAL = 300.0 # 重新枚举磁盘分区的间隔 (秒)，分区很少变化
+MONITOR_IDLE_PAUSE = 5.0 # 超过该时间没有会话读取快照时暂停采样 (秒)
 
 # --- 依赖库导入和初始化 ---
 try:
@@ -34,9 +38,10 @@ except Exception as e:
     print(f"pynvml 初始化或导入失败: {e}。NVIDIA GPU 监控将不可用。")
 
 # --- 数据获取函数 ---
-def get_real_cpu_info():
+def get_real_cpu_info(interval=0.1):
+    # interval=None 时不阻塞，返回距上次调用以来的平均占用 (由采样线程按固定间隔调用)
     if not PSUTIL_AVAILABLE: return {"usage": 0, "error": "psutil not available"}
-    try: return {"usage": psutil.cpu_percent(interval=0.1)}
+    try: return {"usage": psutil.cpu_percent(interval=interval)}
     except Exception as e: return {"usage": 0, "error": str(e)}
 
 def get_real_ram_info():
@@ -76,9 +81,10 @@ def get_real_gpu_info():
     except Exception as e:
         return {"gpus": [], "error": str(e)}
 
-def get_real_hdd_info():
-    if not PSUTIL_AVAILABLE: return {"disks": [], "error": "psutil not available"}
-    disks_info = []
+def list_disk_mountpoints():
+    """枚举并过滤要显示的磁盘分区 (最多 2 个)，返回挂载点列表。开销较大，由采样线程缓存结果。"""
+    if not PSUTIL_AVAILABLE: return []
+    mountpoints = []
     # Define common Linux/macOS filesystems to ignore
     # macOS specific: 'apfs' (often has multiple utility partitions), 'devfs'
     # Linux specific: 'tmpfs', 'squashfs', 'devtmpfs', 'overlay', 'autofs', 'fuse.gvfsd-fuse'
@@ -120,39 +126,125 @@ def get_real_hdd_info():
                 usage = psutil.disk_usage(p.mountpoint)
                 # Ensure we only add partitions with a reported total size > 0 to avoid clutter
                 if usage.total > 0:
-                    disks_info.append({
-                        "mountpoint": p.mountpoint,
-                        "total_gb": round(usage.total / (1024**3), 1),
-                        "used_gb": round(usage.used / (1024**3), 1),
-                        "percent": usage.percent
-                    })
-                if len(disks_info) >= 2:  # Limit to 2 disks for display
+                    mountpoints.append(p.mountpoint)
+                if len(mountpoints) >= 2:  # Limit to 2 disks for display
                     break
             except Exception: # Catch errors during disk_usage or appending
                 continue 
+    except Exception as e:
+        print(f"枚举磁盘分区失败: {e}")
+    return mountpoints
+
+def get_real_hdd_info(mountpoints=None):
+    if not PSUTIL_AVAILABLE: return {"disks": [], "error": "psutil not available"}
+    if mountpoints is None:
+        mountpoints = list_disk_mountpoints()
+    disks_info = []
+    try:
+        for mountpoint in mountpoints:
+            try:
+                usage = psutil.disk_usage(mountpoint)
+            except Exception: # 分区已卸载等，等下次重新枚举
+                continue
+            disks_info.append({
+                "mountpoint": mountpoint,
+                "total_gb": round(usage.total / (1024**3), 1),
+                "used_gb": round(usage.used / (1024**3), 1),
+                "percent": usage.percent
+            })
         return {"disks": disks_info}
     except Exception as e:
         return {"disks": [], "error": str(e)}
 
-# --- HTML 生成函数 ---
-def create_compact_progress_display_html(unique_id_prefix, label_text, current_value, unit, max_value=100, bar_color="dodgerblue", label_color="black", error_msg=None):
-    bar_id = f"{unique_id_prefix}-bar-{uuid.uuid4().hex[:8]}"
-    text_id = f"{unique_id_prefix}-text-{uuid.uuid4().hex[:8]}"
-
-    base_style = "margin-bottom: 4px; padding: 2px; border-radius: 3px; display: flex; align-items: center;"
-    # 调整 label_style: 增加固定宽度 width: 80px (可根据实际最长标签调整) 使标签右对齐
-    label_style = f"font-size: 0.75em; color: #FFFFFF; background-color: transparent; padding: 2px 4px; border-radius: 2px; margin-right: 8px; white-space: nowrap; text-align: right; box-sizing: border-box; width: 80px;"
-    bar_outer_style = "background-color: #202020; border-radius: 2px; overflow: hidden; height: 20px; flex-grow: 1;"
-    bar_inner_style_template = "width: {0}%; background-color: {1}; height: 100%; text-align: center; color: white; line-height: 20px; font-size: 0.7em; transition: width 0.5s ease-in-out;"
-
-    if error_msg:
-        # 错误信息显示也需要调整标签位置
-        # 注意: 如果 label_style 增加了 width, 错误信息的标签也会有固定宽度
-        return f"""<div style="{base_style} background-color: #404040;">
-            <span style="{label_style}">{label_text}:</span> 
-            <p style="flex-grow: 1; color: #ffdddd; text-align: center;"><strong>Error</strong> <span style="font-size:0.8em; color: #ff8888;">({error_msg})</span></p>
-        </div>""", None, None, 0, "Error"
+# --- 共享采样线程 ---
+class MonitorSampler:
+    """
+    所有会话共用的采样线程: 按固定间隔读取 CPU / 内存 / GPU / 磁盘，写入共享快照，会话只读取快照，
+    不再每个标签页各自采样 (cpu_percent 阻塞 100ms、每秒重新枚举分区、逐个查询 NVML)。
+    会话每次读取都会续期；超过 MONITOR_IDLE_PAUSE 秒没有会话读取时暂停采样，有会话读取时恢复。
+    """
+    def __init__(self, interval=MONITOR_SAMPLE_INTERVAL, disk_refresh_interval=DISK_REFRESH_INTERVAL, idle_pause=MONITOR_IDLE_PAUSE):
+        self.interval = interval
+        self.disk_refresh_interval = disk_refresh_interval
+        self.idle_pause = idle_pause
+        self._cond = threading.Condition()
+        self._seq = 0 # 快照序号，每次采样加 1
+        self._snapshot = None
+        self._last_demand = 0.0 # 最近一次会话读取的时间
+        self._mountpoints = None
+        self._mountpoints_at = 0.0
+        self._stopped = False
+        self._thread = None
+
+    def wait_for_update(self, seq, timeout=None):
+        """等待序号不等于 seq 的快照，返回 (序号, 快照)；超时或停止时返回当前快照。"""
+        with self._cond:
+            self._last_demand = time.time()
+            if self._thread is None or not self._thread.is_alive():
+                if not self._stopped:
+                    self._thread = threading.Thread(target=self._run, name="system_monitor_sampler", daemon=True)
+                    self._thread.start()
+            else:
+                self._cond.notify_all() # 唤醒已暂停的采样线程
+            self._cond.wait_for(lambda: (self._snapshot is not None and self._seq != seq) or self._stopped, timeout)
+            return self._seq, self._snapshot
+
+    @property
+    def stopped(self):
+        """stop() 之后为 True，wait_for_update 不再阻塞，等待方应据此退出。"""
+        return self._stopped
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+
+    def _idle_locked(self):
+        return time.time() - self._last_demand > self.idle_pause
+
+    def _run(self):
+        get_real_cpu_info(interval=None) # 第一次调用只建立基准
+        while True:
+            with self._cond:
+                if self._idle_locked() and not self._stopped:
+                    self._cond.wait_for(lambda: not self._idle_locked() or self._stopped)
+                    get_real_cpu_info(interval=None) # 暂停后重新建立基准，避免下一个值是整个暂停期间的平均
+                    self._cond.wait(self.interval)
+                if self._stopped:
+                    return
+            try:
+                snapshot = self.sample()
+            except Exception as e:
+                print(f"系统监控采样出错: {e}")
+                snapshot = self._snapshot
+            with self._cond:
+                self._seq += 1
+                self._snapshot = snapshot
+                self._cond.notify_all()
+                self._cond.wait_for(lambda: self._stopped, self.interval)
+                if self._stopped:
+                    return
+
+    def sample(self):
+        now = time.time()
+        if self._mountpoints is None or now - self._mountpoints_at > self.disk_refresh_interval:
+            self._mountpoints = list_disk_mountpoints()
+            self._mountpoints_at = now
+        return {
+            "cpu": get_real_cpu_info(interval=None),
+            "ram": get_real_ram_info(),
+            "gpu": get_real_gpu_info() if NVML_AVAILABLE else None,
+            "hdd": get_real_hdd_info(self._mountpoints),
+        }
+
+monitor_sampler = MonitorSampler()
 
+# --- 监控条数据 ---
+# 浏览器端只渲染一次监控条 (元素 id 固定)，之后每秒只发送变化的数值，由 MONITOR_RENDER_JS 原地更新宽度和文字。
+# 布局 (监控条和提示的列表) 变化时 (例如磁盘分区变化) 才发送完整布局。
+
+def bar_value(current_value, unit, max_value=100):
+    """返回监控条的 (百分比, 条内文字)。百分比保留 1 位小数，数值不变时不会重复发送。"""
     percentage_value = 0
     display_text = f"{current_value}{unit}"
     if unit == "%":
@@ -162,147 +254,145 @@ def create_compact_progress_display_html(unique_id_prefix, label_text, current_v
     elif isinstance(current_value, (int, float)) and isinstance(max_value, (int, float)) and max_value > 0:
         try: percentage_value = (float(current_value) / max_value) * 100
         except (ValueError, TypeError): percentage_value = 0
-    
-    percentage_value = max(0, min(100, percentage_value))
-    bar_inner_style = bar_inner_style_template.format(percentage_value, bar_color)
-
-    # Prepare text for inside the bar
-    # 'display_text' already contains the primary value string (e.g., "X.XG/Y.YG" or "N/A°C")
-    # 'percentage_value' is the numeric percentage for the bar width
-    
-    text_inside_bar = f"{display_text} ({percentage_value:.1f}%)"
-    if unit == "%": # If the original unit was '%', display_text is already "XX.X%"
-        text_inside_bar = display_text # display_text is already formatted as "XX.X%"
-    elif current_value == "N/A" and unit == "°C": # Special case for temperature N/A
-         text_inside_bar = "N/A"
-    elif current_value == "N/A": # General case for N/A value
-         text_inside_bar = "N/A"
-    elif unit == "°C": # For temperature with actual value
-        text_inside_bar = f"{current_value}{unit} ({percentage_value:.1f}%)"
-
-
-    html_structure = f"""
-    <div style="{base_style}">
-        <span style="{label_style}">{label_text}</span>
-        <div style="{bar_outer_style}">
-            <div id="{bar_id}" style="{bar_inner_style}">
-                {text_inside_bar}
-            </div>
-        </div>
-    </div>"""
-    # The 'text_id' was for the strong tag next to the label, which is now removed.
-    # We need to decide if 'text_id' is still needed or how to update the inner bar text via JS.
-    # For now, 'text_id' will be returned as None or an adapted role.
-    # The JS update logic will need to target bar_id's innerText.
-    return html_structure, bar_id, text_id, percentage_value, text_inside_bar # Returning text_inside_bar for JS updates
+    percentage_value = round(max(0, min(100, percentage_value)), 1)
+
+    if unit == "%": # display_text 已经是 "XX.X%"
+        text_inside_bar = display_text
+    elif current_value == "N/A": # 温度等不可用
+        text_inside_bar = "N/A"
+    else:
+        text_inside_bar = f"{display_text} ({percentage_value:.1f}%)"
+    return percentage_value, text_inside_bar
+
+def build_monitor_state(snapshot):
+    """
+    快照 -> (布局, 数值)。
+    布局为列表，元素是 ["bar", key, 标签, 颜色] 或 ["note", 文字, 颜色]；数值为 {key: [百分比, 条内文字]}。
+    """
+    layout = []
+    values = {}
+
+    def add_bar(key, label, bar_color, value, error_msg=None):
+        layout.append(["bar", key, label, "#777777" if error_msg else bar_color])
+        values[key] = [0, f"Error ({error_msg})"] if error_msg else list(value)
+
+    cpu_data = snapshot["cpu"]
+    add_bar("cpu", "CPU", "dodgerblue", bar_value(cpu_data.get("usage", 0), "%"), cpu_data.get("error"))
+
+    ram_data = snapshot["ram"]
+    ram_used_gb = ram_data.get('used_gb', 0)
+    ram_total_gb = ram_data.get('total_gb', 0)
+    ram_unit_detail = f"G / {ram_total_gb}G" if ram_total_gb > 0 else "G"
+    add_bar("ram", "RAM", "mediumseagreen", bar_value(ram_used_gb, ram_unit_detail, ram_total_gb if ram_total_gb > 0 else 1), ram_data.get("error"))
+
+    if not NVML_AVAILABLE:
+        # GPU 不可用: 显示一条灰色的 "N/A"
+        add_bar("gpu-na", "GPU", "#777777", bar_value("N/A", "", 1))
+    else:
+        gpu_data = snapshot["gpu"] or {"gpus": []}
+        if gpu_data.get("error") and not gpu_data.get("gpus"):
+            layout.append(["note", f"GPU Error: {gpu_data.get('error')}", "red"])
+        if not gpu_data.get("gpus") and not gpu_data.get("error"):
+            layout.append(["note", "No NVIDIA GPUs detected.", "#555"])
+        for i, gpu in enumerate(gpu_data.get("gpus", [])):
+            add_bar(f"gpu{i}-util", f"GPU {i} Util", "tomato", bar_value(gpu.get("utilization", 0), "%"))
+            vram_used = gpu.get('vram_used_gb', 0); vram_total = gpu.get('vram_total_gb', 0)
+            vram_unit_detail = f"G / {vram_total}G" if vram_total > 0 else "G"
+            add_bar(f"gpu{i}-vram", f"GPU {i} VRAM", "orange", bar_value(vram_used, vram_unit_detail, vram_total if vram_total > 0 else 1))
+            add_bar(f"gpu{i}-temp", f"GPU {i} Temp", "lightcoral", bar_value(gpu.get("temperature", "N/A"), "°C", 100))
+
+    hdd_data = snapshot["hdd"]
+    if hdd_data.get("error"):
+        layout.append(["note", f"Disk Error: {hdd_data.get('error')}", "red"])
+    if not hdd_data.get("disks") and not hdd_data.get("error"):
+        layout.append(["note", "No disk information available.", "#555"])
+    for i, disk in enumerate(hdd_data.get("disks", [])):
+        disk_total_gb = disk.get('total_gb', 0)
+        disk_unit_detail = f"G / {disk_total_gb}G" if disk_total_gb > 0 else "G"
+        add_bar(f"hdd{i}", f"Disk {disk.get('mountpoint', '?')[0]}", "mediumpurple",
+                bar_value(disk.get('used_gb', 0), disk_unit_detail, disk_total_gb if disk_total_gb > 0 else 1))
+    return layout, values
 
 # --- Gradio 更新生成器函数 ---
-def update_floating_monitors_stream():
-    # global NVML_INITIALIZED, NVML_AVAILABLE, gpu_handles, nvml # No longer needed for re-init
-    # The NVML initialization is now expected to be done at the module level (on import)
-    # and cleanup via atexit. This stream function should not attempt re-initialization.
+_state_lock = threading.Lock()
+_state_cache = (None, None) # (快照序号, (布局, 数值))，同一快照只计算一次，所有会话共用
 
-    initial_html = "<div id='floating-monitors-content' class='floating-monitor-style-inner'>Loading system monitors...</div><script></script>"
-    yield initial_html
+def monitor_state(seq, snapshot):
+    global _state_cache
+    with _state_lock:
+        if _state_cache[0] != seq:
+            _state_cache = (seq, build_monitor_state(snapshot))
+        return _state_cache[1]
 
+def update_floating_monitors_stream():
+    """
+    每个会话一个生成器，输出到隐藏的 gr.JSON，由 MONITOR_RENDER_JS 渲染。
+    第一次 (以及布局变化时) 输出 {"layout": 布局, "v": 全部数值}，之后只输出 {"v": 变化的数值}，没有变化时不输出。
+    采样由共享的 monitor_sampler 完成，这里只等待新快照；采样器停止后生成器结束。
+    """
+    seq = None
+    sent_layout = None
+    sent_values = {}
     while True:
-        all_html_parts = ["<div id='floating-monitors-content' class='floating-monitor-style-inner'>"]
-        script_parts = ["<script> try { "]
-        light_gray_label_color = "#aaaaaa"
-
-        cpu_data = get_real_cpu_info()
-        # For CPU, current_value is usage %, unit is "%". text_inside_bar will be "usage%".
-        html, bid, tid, perc, dtxt = create_compact_progress_display_html("cpu", "CPU", cpu_data.get("usage",0), "%", bar_color="dodgerblue", label_color=light_gray_label_color, error_msg=cpu_data.get("error"))
-        all_html_parts.append(html)
-        if bid: script_parts.append(f"var barEl = document.getElementById('{bid}'); if(barEl) {{ barEl.style.width='{perc}%'; barEl.innerText='{dtxt}'; }} try {{var textEl = document.getElementById('{tid}'); if(textEl) textEl.innerText='';}}catch(e){{}}")
-
-        ram_data = get_real_ram_info()
-        # For RAM, current_value is used_gb, unit is "G / total_gbG", max_value is total_gb.
-        # text_inside_bar will be "used_gbG / total_gbG (percent%)".
-        ram_used_gb = ram_data.get('used_gb',0)
-        ram_total_gb = ram_data.get('total_gb',0)
-        ram_unit_detail = f"G / {ram_total_gb}G" if ram_total_gb > 0 else "G"
-        html, bid, tid, perc, dtxt = create_compact_progress_display_html(
-            "ram", "RAM", ram_used_gb, ram_unit_detail, 
-            max_value=ram_total_gb if ram_total_gb > 0 else 1, # Avoid division by zero if total_gb is 0
-            bar_color="mediumseagreen", label_color=light_gray_label_color, error_msg=ram_data.get("error")
-        )
-        all_html_parts.append(html)
-        if bid: script_parts.append(f"var barEl = document.getElementById('{bid}'); if(barEl) {{ barEl.style.width='{perc}%'; barEl.innerText='{dtxt}'; }} try {{var textEl = document.getElementById('{tid}'); if(textEl) textEl.innerText='';}}catch(e){{}}")
-
-        if not NVML_AVAILABLE:
-            # GPU N/A: Display a bar with "GPU" label and "N/A" as its value.
-            html, bid, tid, perc, dtxt = create_compact_progress_display_html(
-                "gpu-na", "GPU", "N/A", "",  # current_value="N/A", unit=""
-                max_value=1,  # Placeholder, as percentage will be 0
-                bar_color="#777777",  # Grey color for N/A bar
-                label_color=light_gray_label_color,
-                error_msg=None # Ensure no error styling is applied
-            )
-            all_html_parts.append(html)
-            if bid: script_parts.append(f"var barEl = document.getElementById('{bid}'); if(barEl) {{ barEl.style.width='{perc}%'; barEl.innerText='{dtxt}'; }} try {{var textEl = document.getElementById('{tid}'); if(textEl) textEl.innerText='';}}catch(e){{}}")
-
-        else:
-            gpu_data = get_real_gpu_info()
-            if gpu_data.get("error") and not gpu_data.get("gpus"):
-                 all_html_parts.append(f"<p style='font-size:0.75em; color:red;'>GPU Error: {gpu_data.get('error')}</p>")
-            if not gpu_data.get("gpus") and not gpu_data.get("error"):
-                 all_html_parts.append("<p style='font-size:0.75em; color:#555; margin-bottom:2px;'>No NVIDIA GPUs detected.</p>")
-
-            for i, gpu in enumerate(gpu_data.get("gpus", [])):
-                name_short = gpu.get('name','GPU').split(' ')[-1][:10] # This line is kept for potential future use or logging, but name_short is not used in label
-                
-                # GPU Util: current_value is utilization %, unit is "%". Bar shows "utilization%".
-                html, bid, tid, perc, dtxt = create_compact_progress_display_html(f"gpu{i}-util", f"GPU {i} Util", gpu.get("utilization",0), "%", bar_color="tomato", label_color=light_gray_label_color)
-                all_html_parts.append(html); 
-                if bid: script_parts.append(f"var barEl = document.getElementById('{bid}'); if(barEl) {{ barEl.style.width='{perc}%'; barEl.innerText='{dtxt}'; }} try {{var textEl = document.getElementById('{tid}'); if(textEl) textEl.innerText='';}}catch(e){{}}")
-                
-                # GPU VRAM: current_value is vram_used_gb, unit is "G / vram_total_gbG", max_value is vram_total_gb.
-                # Bar shows "vram_usedG / vram_totalG (percent%)".
-                vram_used = gpu.get('vram_used_gb',0); vram_total = gpu.get('vram_total_gb',0)
-                vram_unit_detail = f"G / {vram_total}G" if vram_total > 0 else "G"
-                html, bid, tid, perc, dtxt = create_compact_progress_display_html(
-                    f"gpu{i}-vram", f"GPU {i} VRAM", vram_used, vram_unit_detail,
-                    max_value=vram_total if vram_total > 0 else 1,
-                    bar_color="orange", label_color=light_gray_label_color
-                )
-                all_html_parts.append(html)
-                if bid: script_parts.append(f"var barEl = document.getElementById('{bid}'); if(barEl) {{ barEl.style.width='{perc}%'; barEl.innerText='{dtxt}'; }} try {{var textEl = document.getElementById('{tid}'); if(textEl) textEl.innerText='';}}catch(e){{}}")
-
-                # GPU Temp: current_value is temp_val, unit is "°C". Bar shows "temp°C (percent%)" or "N/A".
-                temp_val = gpu.get("temperature","N/A"); temp_unit = "°C" # unit is always °C for logic in create_compact
-                html, bid, tid, perc, dtxt = create_compact_progress_display_html(
-                    f"gpu{i}-temp", f"GPU {i} Temp", temp_val, temp_unit, 
-                    max_value=100, bar_color="lightcoral", label_color=light_gray_label_color
-                )
-                all_html_parts.append(html)
-                if bid: script_parts.append(f"var barEl = document.getElementById('{bid}'); if(barEl) {{ barEl.style.width='{perc}%'; barEl.innerText='{dtxt}'; }} try {{var textEl = document.getElementById('{tid}'); if(textEl) textEl.innerText='';}}catch(e){{}}")
-        
-        hdd_data = get_real_hdd_info()
-        if hdd_data.get("error"):
-            all_html_parts.append(f"<p style='font-size:0.75em; color:red;'>Disk Error: {hdd_data.get('error')}</p>")
-        if not hdd_data.get("disks") and not hdd_data.get("error"):
-            all_html_parts.append("<p style='font-size:0.75em; color:#555; margin-bottom:2px;'>No disk information available.</p>")
-        for i, disk in enumerate(hdd_data.get("disks", [])):
-            # HDD: current_value is used_gb, unit is "G / total_gbG", max_value is total_gb.
-            # Bar shows "used_gbG / total_gbG (percent%)".
-            disk_label_short = f"Disk {disk.get('mountpoint','?')[0]}"
-            disk_used_gb = disk.get('used_gb',0)
-            disk_total_gb = disk.get('total_gb',0)
-            disk_unit_detail = f"G / {disk_total_gb}G" if disk_total_gb > 0 else "G"
-            html, bid, tid, perc, dtxt = create_compact_progress_display_html(
-                f"hdd{i}", disk_label_short, disk_used_gb, disk_unit_detail,
-                max_value=disk_total_gb if disk_total_gb > 0 else 1,
-                bar_color="mediumpurple", label_color=light_gray_label_color
-            )
-            all_html_parts.append(html)
-            if bid: script_parts.append(f"var barEl = document.getElementById('{bid}'); if(barEl) {{ barEl.style.width='{perc}%'; barEl.innerText='{dtxt}'; }} try {{var textEl = document.getElementById('{tid}'); if(textEl) textEl.innerText='';}}catch(e){{}}")
-
-        all_html_parts.append("</div>")
-        script_parts.append(" } catch(e) { console.error('Error updating monitor UI:', e); } </script>")
-        final_html_payload = "".join(all_html_parts) + "".join(script_parts)
-        yield final_html_payload
-        time.sleep(1)
+        new_seq, snapshot = monitor_sampler.wait_for_update(seq, timeout=MONITOR_SAMPLE_INTERVAL * 5)
+        if monitor_sampler.stopped:
+            return
+        if snapshot is None or new_seq == seq:
+            continue
+        seq = new_seq
+        layout, values = monitor_state(seq, snapshot)
+        if layout != sent_layout:
+            sent_layout, sent_values = layout, dict(values)
+            yield {"layout": layout, "v": values}
+            continue
+        changed = {key: value for key, value in values.items() if sent_values.get(key) != value}
+        if changed:
+            sent_values.update(changed)
+            yield {"v": changed}
+
+# 浏览器端渲染器: 收到布局时重建监控条 (固定 id: mon-bar-<key>)，之后只修改变化的监控条的宽度和文字
+MONITOR_RENDER_JS = f"""
+(delta) => {{
+    if (!delta) return;
+    const root = document.getElementById('floating-monitors-content');
+    if (!root) return;
+    if (delta.layout) {{
+        root.innerHTML = '';
+        for (const item of delta.layout) {{
+            if (item[0] === 'note') {{
+                const note = document.createElement('p');
+                note.style.cssText = 'font-size: 0.75em; margin-bottom: 2px; color: ' + item[2] + ';';
+                note.textContent = item[1];
+                root.appendChild(note);
+                continue;
+            }}
+            const row = document.createElement('div');
+            row.style.cssText = 'margin-bottom: 4px; padding: 2px; border-radius: 3px; display: flex; align-items: center;';
+            const label = document.createElement('span');
+            label.style.cssText = 'font-size: 0.75em; color: #FFFFFF; padding: 2px 4px; border-radius: 2px; margin-right: 8px; white-space: nowrap; text-align: right; box-sizing: border-box; width: 80px;';
+            label.textContent = item[2];
+            const outer = document.createElement('div');
+            outer.style.cssText = 'background-color: #202020; border-radius: 2px; overflow: hidden; height: 20px; flex-grow: 1;';
+            const bar = document.createElement('div');
+            bar.id = 'mon-bar-' + item[1];
+            bar.style.cssText = 'width: 0%; height: 100%; text-align: center; color: white; line-height: 20px; font-size: 0.7em; transition: width 0.5s ease-in-out; white-space: nowrap;';
+            bar.style.backgroundColor = item[3];
+            outer.appendChild(bar);
+            row.appendChild(label);
+            row.appendChild(outer);
+            root.appendChild(row);
+        }}
+    }}
+    for (const [key, value] of Object.entries(delta.v || {{}})) {{
+        const bar = document.getElementById('mon-bar-' + key);
+        if (!bar) continue;
+        bar.style.width = value[0] + '%';
+        bar.textContent = value[1];
+    }}
+}}
+"""
+# 监控 HTML 组件的固定内容，监控条由 MONITOR_RENDER_JS 填充
+MONITOR_CONTAINER_HTML = "<div id='floating-monitors-content' class='floating-monitor-style-inner'>Loading system monitors...</div>"
 
 custom_css = """
 /* .monitor-relative-container {
@@ -339,6 +429,7 @@ custom_css = """
 
 def cleanup_nvml():
     global NVML_INITIALIZED, nvml
+    monitor_sampler.stop() # 先停止采样线程，再关闭 NVML
     if NVML_INITIALIZED and nvml:
         try:
             nvml.nvmlShutdown()
@@ -353,7 +444,9 @@ if __name__ == "__main__":
         gr.Markdown("# 💻 系统资源实时监控 (模块测试)")
         with gr.Group(elem_id="log_area_relative_wrapper"):
             gr.Textbox(label="模拟日志输出", lines=20, value="模拟日志...\n" * 10, elem_classes="log-display-container")
-            floating_monitor_html_output = gr.HTML(elem_classes="floating-monitor-outer-wrapper")
-        test_demo.load(fn=update_floating_monitors_stream,inputs=None,outputs=[floating_monitor_html_output])
+            floating_monitor_html_output = gr.HTML(MONITOR_CONTAINER_HTML, elem_classes="floating-monitor-outer-wrapper")
+            monitor_delta = gr.JSON(visible=False)
+        test_demo.load(fn=update_floating_monitors_stream,inputs=None,outputs=[monitor_delta])
+        monitor_delta.change(fn=None, inputs=[monitor_delta], outputs=None, js=MONITOR_RENDER_JS)
     try: test_demo.launch()
     finally: cleanup_nvml()
@@ -0,0 +1,114 @@
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+import threading
+
+import numpy as np
+import torch
+from PIL import Image, ImageOps, ImageSequence
+import node_helpers
+
+def decode_image_file(image_path):
+    """
+    把图像文件解码为 ComfyUI 的 (IMAGE, MASK) 张量: IMAGE 为 NHWC float32 [0, 1]，MASK 为反转后的 alpha。
+    多帧图像 (GIF 等，MPO 除外) 按批次拼接，尺寸与第一帧不同的帧被跳过。
+    GradioInputImage 的文件回退路径与 Gradio 侧的预解码共用此函数，保证两边结果一致。
+    """
+    img = node_helpers.pillow(Image.open, image_path)
+
+    output_images = []
+    output_masks = []
+    w, h = None, None
+    excluded_formats = ['MPO']
+
+    for i in ImageSequence.Iterator(img):
+        i = node_helpers.pillow(ImageOps.exif_transpose, i) # 根据 EXIF 数据纠正图像方向
+        if i.mode == 'I': # 32 位整数像素缩放到 [0, 1]
+            i = i.point(lambda i: i * (1 / 255))
+        image = i.convert("RGB")
+
+        if len(output_images) == 0:
+            w = image.size[0]
+            h = image.size[1]
+        if image.size[0] != w or image.size[1] != h:
+            continue
+
+        image = torch.from_numpy(np.asarray(image, dtype=np.float32) / 255.0)[None,]
+        if 'A' in i.getbands():
+            mask = np.asarray(i.getchannel('A'), dtype=np.float32) / 255.0
+            mask = 1. - torch.from_numpy(mask) # alpha 表示不透明度，掩码取反
+        else:
+            mask = torch.zeros((64, 64), dtype=torch.float32, device="cpu")
+        output_images.append(image)
+        output_masks.append(mask.unsqueeze(0))
+
+    if len(output_images) > 1 and img.format not in excluded_formats:
+        return torch.cat(output_images, dim=0), torch.cat(output_masks, dim=0)
+    return output_images[0], output_masks[0]
+
+class InputTensorStore:
+    """
+    进程内输入张量缓存，按 InputStore 的内容哈希文件名 (句柄) 存放已解码的 (IMAGE, MASK)。
+
+    Gradio 与 ComfyUI 在同一进程时，Gradio 在排队时调用 prefetch() 在后台线程解码一次，
+    GradioInputImage 执行时用 get() 直接取张量，省去在 ComfyUI 执行线程上的 PNG/JPEG 解码与归一化。
+    文件仍保存在 input 目录，找不到句柄 (其他进程、已被淘汰) 时节点回退为读取文件。
+    返回的张量被多个任务共享，下游节点不得原地修改 (与 ComfyUI 自身的输出缓存约定相同)。
+    """
+    def __init__(self, max_entries=4):
+        self.max_entries = max_entries
+        self._entries = OrderedDict() # 文件名 -> Future[(image, mask)]，按最近使用排序
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="input_tensor_store")
+
+    def prefetch(self, filename, image_path):
+        """在后台解码 image_path 并以 filename 登记，已登记则直接返回已有的 Future。"""
+        with self._lock:
+            future = self._entries.get(filename)
+            if future is not None:
+                self._entries.move_to_end(filename)
+                return future
+            future = Future()
+            self._entries[filename] = future
+            self._evict_locked()
+        self._executor.submit(self._decode_into, future, filename, image_path)
+        return future
+
+    def put(self, filename, image, mask):
+        future = Future()
+        future.set_result((image, mask))
+        with self._lock:
+            self._entries[filename] = future
+            self._entries.move_to_end(filename)
+            self._evict_locked()
+
+    def get(self, filename, timeout=None):
+        """返回 (image, mask)；未登记或解码失败时返回 None。后台解码尚未完成时等待其结果。"""
+        with self._lock:
+            future = self._entries.get(filename)
+            if future is not None:
+                self._entries.move_to_end(filename)
+        if future is None:
+            return None
+        try:
+            return future.result(timeout=timeout)
+        except Exception as e:
+            print(f"[InputTensorStore] 预解码结果不可用 ({filename}): {e}")
+            return None
+
+    def discard(self, filename):
+        with self._lock:
+            self._entries.pop(filename, None)
+
+    def _decode_into(self, future, filename, image_path):
+        try:
+            future.set_result(decode_image_file(image_path))
+        except Exception as e:
+            future.set_exception(e)
+            self.discard(filename)
+
+    def _evict_locked(self):
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+# 模块级单例: GradioInputImage 与 Gradio 队列共享同一个实例
+input_tensor_store = InputTensorStore()
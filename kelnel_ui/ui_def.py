@@ -1,6 +1,7 @@
 import os
 import json
 import glob
+import threading
 from math import gcd
 import gradio as gr
 
@@ -161,9 +162,8 @@ def find_all_nodes_by_class_type(prompt_workflow, class_type):
 # Deprecated: The 'fuck' function's logic is being integrated into get_workflow_defaults_and_visibility
 # def fuck(json_file, output_dir_path): ...
 
-def get_workflow_defaults_and_visibility(json_file, output_dir_path, current_resolution_prefixes, current_resolution_presets, max_dynamic_components=5):
-    # max_dynamic_components is not used yet, but planned for future user setting
-    defaults = {
+def _empty_workflow_defaults():
+    return {
         "visible_image_input": False, 
         "visible_video_input": False,
         "visible_neg_prompt": False, 
@@ -186,9 +186,11 @@ def get_workflow_defaults_and_visibility(json_file, output_dir_path, current_res
         }
     }
 
+def get_workflow_defaults_and_visibility(json_file, output_dir_path, current_resolution_prefixes, current_resolution_presets, max_dynamic_components=5):
+    # max_dynamic_components is not used yet, but planned for future user setting
     if not json_file or not os.path.exists(os.path.join(output_dir_path, json_file)):
         print(f"JSON 文件无效或不存在: {json_file}")
-        return defaults
+        return _empty_workflow_defaults()
 
     json_path = os.path.join(output_dir_path, json_file)
     try:
@@ -196,7 +198,15 @@ def get_workflow_defaults_and_visibility(json_file, output_dir_path, current_res
             prompt = json.load(file_json)
     except (FileNotFoundError, json.JSONDecodeError) as e:
         print(f"读取或解析 JSON 文件时出错 ({json_file}): {e}")
-        return defaults
+        return _empty_workflow_defaults()
+
+    defaults = build_workflow_defaults(prompt)
+    print(f"Workflow defaults and visibility for {json_file}: {json.dumps(defaults, indent=2, ensure_ascii=False)}")
+    return defaults
+
+def build_workflow_defaults(prompt):
+    """从已解析的工作流 (API JSON) 计算 UI 可见性与默认值。workflow_cache 编译工作流时调用，不重复读文件。"""
+    defaults = _empty_workflow_defaults()
 
     # --- Handle Single Instance Components ---
     defaults["visible_image_input"] = find_key_by_class_type_internal(prompt, "GradioInputImage") is not None
@@ -282,7 +292,6 @@ def get_workflow_defaults_and_visibility(json_file, output_dir_path, current_res
     # for comp_type in defaults["dynamic_components"]:
     #     defaults["dynamic_components"][comp_type] = defaults["dynamic_components"][comp_type][:max_dynamic_components]
 
-    print(f"Workflow defaults and visibility for {json_file}: {json.dumps(defaults, indent=2, ensure_ascii=False)}")
     return defaults
 
 # --- Plugin Settings Management ---
@@ -290,6 +299,11 @@ def get_workflow_defaults_and_visibility(json_file, output_dir_path, current_res
 
 PLUGIN_SETTINGS_FILE = "plugin_settings.json" 
 DEFAULT_MAX_DYNAMIC_COMPONENTS = 5
+DEFAULT_PIPELINE_DEPTH = 2 # 同时提交到 ComfyUI 队列中的任务数 (1 = 不预提交)
+MAX_PIPELINE_DEPTH = 8
+DEFAULT_COMFYUI_BACKENDS = ["127.0.0.1:8188"] # 后端池中的 ComfyUI 实例地址 (host:port)，第一个为主后端
+COMFYUI_TRANSPORT_MODES = ("auto", "local", "remote") # auto: 本机地址用共享文件系统，其余走 HTTP 上传/下载
+DEFAULT_PRUNE_WORKFLOW = True # 提交前剪除不是输出节点祖先的节点
 
 def _get_settings_file_path():
     """Internal helper to get the absolute path to the settings file."""
@@ -320,9 +334,30 @@ def load_plugin_settings():
         print(f"错误: 加载插件设置 '{settings_file_path}' 时发生错误: {e}. 将使用默认设置。")
         return {"max_dynamic_components": DEFAULT_MAX_DYNAMIC_COMPONENTS}
 
+# 按文件 mtime 缓存的设置，供频繁调用的路径 (入队、补足流水线) 使用
+_settings_cache = {"mtime": None, "settings": None}
+_settings_cache_lock = threading.RLock() # load_plugin_settings 可能在持锁时调用 save_plugin_settings
+
+def _settings_mtime():
+    try:
+        return os.stat(_get_settings_file_path()).st_mtime_ns
+    except OSError:
+        return None
+
+def get_cached_plugin_settings():
+    """与 load_plugin_settings 相同，但只在文件 mtime 变化或保存设置后重新读取和解析。返回的字典不应修改。"""
+    mtime = _settings_mtime()
+    with _settings_cache_lock:
+        if _settings_cache["settings"] is None or _settings_cache["mtime"] != mtime:
+            _settings_cache["settings"] = load_plugin_settings()
+            _settings_cache["mtime"] = _settings_mtime() # 文件不存在时 load_plugin_settings 会创建它
+        return _settings_cache["settings"]
+
 def save_plugin_settings(settings_dict):
     """Saves plugin settings to the main plugin directory."""
     settings_file_path = _get_settings_file_path()
+    with _settings_cache_lock:
+        _settings_cache["settings"] = None # 下次读取时重新加载
     try:
         with open(settings_file_path, "w", encoding="utf-8") as f:
             json.dump(settings_dict, f, indent=4, ensure_ascii=False)
@@ -331,4 +366,66 @@ def save_plugin_settings(settings_dict):
     except Exception as e:
         print(f"错误: 保存插件设置到 '{settings_file_path}' 时发生错误: {e}")
         return f"保存设置失败: {e}"
+
+def get_pipeline_depth(settings=None):
+    """返回配置的流水线深度 (1..MAX_PIPELINE_DEPTH)。每次入队和补位都会调用，默认读取按 mtime 缓存的设置。"""
+    if settings is None:
+        settings = get_cached_plugin_settings()
+    try:
+        depth = int(settings.get("pipeline_depth", DEFAULT_PIPELINE_DEPTH))
+    except (ValueError, TypeError):
+        depth = DEFAULT_PIPELINE_DEPTH
+    return max(1, min(MAX_PIPELINE_DEPTH, depth))
+
+def get_scheduler_user_weights(settings=None):
+    """返回多用户调度的权重 {用户名: 每轮可连续执行的任务数}。未列出的用户权重为 1。"""
+    if settings is None:
+        settings = load_plugin_settings()
+    configured = settings.get("scheduler_user_weights") or {}
+    weights = {}
+    if isinstance(configured, dict):
+        for user, weight in configured.items():
+            try:
+                weights[str(user)] = max(1, int(weight))
+            except (ValueError, TypeError):
+                continue
+    return weights
+
+def get_comfyui_backend_addresses(settings=None):
+    """返回配置的 ComfyUI 后端地址列表 (host:port)。允许填写带 http:// 前缀的 URL，去重后保持顺序。"""
+    if settings is None:
+        settings = load_plugin_settings()
+    configured = settings.get("comfyui_backends") or DEFAULT_COMFYUI_BACKENDS
+    if isinstance(configured, str):
+        configured = configured.replace(",", "\n").splitlines()
+    addresses = []
+    for entry in configured:
+        if not isinstance(entry, str):
+            continue
+        address = entry.strip()
+        for prefix in ("http://", "https://", "ws://"):
+            if address.startswith(prefix):
+                address = address[len(prefix):]
+        address = address.rstrip("/")
+        if address and address not in addresses:
+            addresses.append(address)
+    return addresses or list(DEFAULT_COMFYUI_BACKENDS)
+
+def get_workflow_prune_settings(settings=None):
+    """返回 (是否剪枝, 需要保留的 class_type 列表)。保留列表用于必须执行的旁路副作用节点。"""
+    if settings is None:
+        settings = load_plugin_settings()
+    enabled = bool(settings.get("prune_workflow", DEFAULT_PRUNE_WORKFLOW))
+    keep_class_types = settings.get("prune_keep_class_types") or []
+    if isinstance(keep_class_types, str):
+        keep_class_types = keep_class_types.replace(",", "\n").splitlines()
+    keep_class_types = [c.strip() for c in keep_class_types if isinstance(c, str) and c.strip()]
+    return enabled, keep_class_types
+
+def get_comfyui_transport_mode(settings=None):
+    """返回配置的文件传输模式 (auto / local / remote)。"""
+    if settings is None:
+        settings = load_plugin_settings()
+    mode = str(settings.get("comfyui_transport", "auto")).strip().lower()
+    return mode if mode in COMFYUI_TRANSPORT_MODES else "auto"
 # --- End Plugin Settings Management ---
@@ -0,0 +1,168 @@
+import json
+import os
+import threading
+import time
+
+from .ui_def import build_workflow_defaults
+
+# UI 参数 -> 节点输入的映射: (class_type, input_key, UI 参数名, 是否按节点顺序对应列表中的第 i 个值, 类型转换, 跳过的值)
+# UI 参数名与 submit_generation 的参数名一致
+PATCH_RULES = [
+    ("GradioTextOk", "string", "dynamic_positive_prompts_values", True, None, ()),
+    ("GradioTextBad", "string", "prompt_text_negative", False, None, ()),
+    ("Hua_gradio_resolution", "custom_width", "hua_width", False, int, ()),
+    ("Hua_gradio_resolution", "custom_height", "hua_height", False, int, ()),
+    ("Hua_LoraLoaderModelOnly", "lora_name", "dynamic_loras_values", True, None, ("None",)),
+    ("Hua_CheckpointLoaderSimple", "ckpt_name", "hua_checkpoint", False, None, ("None",)),
+    ("Hua_UNETLoader", "unet_name", "hua_unet", False, None, ("None",)),
+    ("HuaIntNode", "int_value", "dynamic_int_nodes_values", True, int, (None,)),
+    ("HuaFloatNode", "float_value", "dynamic_float_nodes_values", True, float, (None,)),
+]
+
+class CompiledWorkflow:
+    """
+    解析一次后可重复使用的工作流:
+    - prompt: 解析后的 API JSON (只读，任务通过 copy_prompt() 获得自己的副本)
+    - class_index: class_type -> [node_id, ...] (按 JSON 中的顺序)
+    - defaults: build_workflow_defaults() 的结果 (UI 可见性与默认值)
+    - setters: [(node_id, input_key, UI 参数名, 列表下标或 None, 类型转换, 跳过的值), ...]
+    - output_node_id: Gradio 取结果的输出节点 (Hua_Output 优先，其次 Hua_Video_Output)
+    """
+    def __init__(self, json_file, prompt, mtime_ns):
+        self.json_file = json_file
+        self.prompt = prompt
+        self.mtime_ns = mtime_ns
+        self.class_index = {}
+        for node_id, node_data in prompt.items():
+            if isinstance(node_data, dict) and node_data.get("class_type"):
+                self.class_index.setdefault(node_data["class_type"], []).append(node_id)
+        self.defaults = build_workflow_defaults(prompt)
+        self.output_node_id = self.first("Hua_Output") or self.first("Hua_Video_Output")
+        self._kept_node_ids = {} # frozenset(保留的 class_type) -> 剪枝后保留的节点 ID 集合
+        self.setters = []
+        for class_type, input_key, slot, per_node, cast, skip_values in PATCH_RULES:
+            for i, node_id in enumerate(self.class_index.get(class_type, [])):
+                if not per_node and i > 0:
+                    break # 单例节点只取第一个，与原来的 find_key_by_class_type 一致
+                self.setters.append((node_id, input_key, slot, i if per_node else None, cast, skip_values))
+
+    def first(self, class_type, within=None):
+        """第一个该类型节点的 ID，不存在时返回 None。within 给出时只在该节点集合中查找 (例如剪枝后保留的节点)。"""
+        for node_id in self.class_index.get(class_type, []):
+            if within is None or node_id in within:
+                return node_id
+        return None
+
+    def kept_node_ids(self, keep_class_types=()):
+        """
+        剪枝: 从输出节点以及 keep_class_types 中的节点沿输入连线向上回溯，返回所有祖先节点 (含自身)。
+        不在集合中的节点 (另存 JSON、PreviewImage/SaveImage 旁路输出、思维导图等) 不会提交给 ComfyUI。
+        没有输出节点时不剪枝。
+        """
+        key = frozenset(keep_class_types)
+        kept = self._kept_node_ids.get(key)
+        if kept is not None:
+            return kept
+        if not self.output_node_id:
+            kept = set(self.prompt)
+        else:
+            roots = [self.output_node_id]
+            for class_type in key:
+                roots.extend(self.class_index.get(class_type, []))
+            kept = set()
+            while roots:
+                node_id = roots.pop()
+                if node_id in kept or not isinstance(self.prompt.get(node_id), dict):
+                    continue
+                kept.add(node_id)
+                for value in (self.prompt[node_id].get("inputs") or {}).values():
+                    # 连线的格式为 [上游节点 ID, 输出序号]
+                    if isinstance(value, list) and len(value) == 2 and str(value[0]) in self.prompt:
+                        roots.append(str(value[0]))
+        self._kept_node_ids[key] = kept
+        return kept
+
+    def has_any(self, class_types):
+        return any(class_type in self.class_index for class_type in class_types)
+
+    def copy_prompt(self, keep_node_ids=None):
+        """结构性复制: 每个节点及其 inputs 字典是新的，其余 (连线列表等) 与缓存共享且不会被修改。
+        keep_node_ids 给出时只复制这些节点 (剪枝)。"""
+        prompt_copy = {}
+        for node_id, node_data in self.prompt.items():
+            if keep_node_ids is not None and node_id not in keep_node_ids:
+                continue
+            if isinstance(node_data, dict):
+                node_copy = dict(node_data)
+                node_copy["inputs"] = dict(node_data.get("inputs") or {})
+                prompt_copy[node_id] = node_copy
+            else:
+                prompt_copy[node_id] = node_data
+        return prompt_copy
+
+    def apply_ui_values(self, prompt, ui_values, log_prefix=""):
+        """按预先计算的 setters 把 UI 参数写入 prompt 副本，返回写入的输入数量。"""
+        applied = 0
+        for node_id, input_key, slot, index, cast, skip_values in self.setters:
+            if node_id not in prompt:
+                continue # 已被剪枝
+            value = ui_values.get(slot)
+            if index is not None:
+                if value is None or index >= len(value):
+                    continue
+                value = value[index]
+            if value in skip_values:
+                continue
+            try:
+                prompt[node_id]["inputs"][input_key] = cast(value) if cast else value
+                applied += 1
+            except (ValueError, TypeError, KeyError) as e:
+                print(f"{log_prefix} 更新节点 {node_id} 的 {input_key} 时出错: {e}. 使用默认值或跳过。")
+        return applied
+
+class WorkflowCache:
+    """按 (路径, mtime, 文件大小) 缓存编译后的工作流，文件被修改后自动重新编译。"""
+    def __init__(self):
+        self._entries = {} # json_path -> (mtime_ns, size, CompiledWorkflow)
+        self._lock = threading.Lock()
+
+    def get(self, json_file, output_dir_path):
+        """返回 CompiledWorkflow；文件不存在或无法解析时返回 None。"""
+        if not json_file:
+            return None
+        json_path = os.path.join(output_dir_path, json_file)
+        try:
+            stat = os.stat(json_path)
+        except OSError:
+            print(f"JSON 文件无效或不存在: {json_file}")
+            return None
+        with self._lock:
+            entry = self._entries.get(json_path)
+            if entry and entry[0] == stat.st_mtime_ns and entry[1] == stat.st_size:
+                return entry[2]
+
+        start_time = time.time()
+        try:
+            with open(json_path, "r", encoding="utf-8") as file_json:
+                prompt = json.load(file_json)
+        except (OSError, json.JSONDecodeError) as e:
+            print(f"读取或解析 JSON 文件时出错 ({json_file}): {e}")
+            return None
+        if not isinstance(prompt, dict):
+            print(f"JSON 文件不是 API 格式的工作流: {json_file}")
+            return None
+        compiled = CompiledWorkflow(json_file, prompt, stat.st_mtime_ns)
+        with self._lock:
+            self._entries[json_path] = (stat.st_mtime_ns, stat.st_size, compiled)
+        print(f"已编译工作流 {json_file}: {len(prompt)} 个节点, {len(compiled.setters)} 个 UI 参数映射 ({(time.time() - start_time) * 1000:.1f} ms)")
+        return compiled
+
+    def invalidate(self, json_file=None, output_dir_path=None):
+        with self._lock:
+            if json_file is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(os.path.join(output_dir_path, json_file), None)
+
+# 模块级单例
+workflow_cache = WorkflowCache()
@@ -15,6 +15,7 @@ from comfy.cli_args import args
 import comfy.utils # Need this import for Hua_LoraLoader
 import node_helpers # Need this import for GradioInputImage
 import torch # Need this import for GradioInputImage
+from ..kelnel_ui.tensor_store import input_tensor_store, decode_image_file # 进程内输入张量缓存
 from datetime import datetime # Need this import for Hua_Output
 import barcode
 from barcode.writer import ImageWriter
@@ -101,50 +102,14 @@ class GradioInputImage:
 
 
     def load_image(self, image, name):
+        # Gradio 在同一进程时，排队阶段已按文件名 (内容哈希) 预解码为张量，直接取用
+        cached = input_tensor_store.get(image)
+        if cached is not None:
+            return cached
+
         image_path = folder_paths.get_annotated_filepath(image)
         print("laodimage函数读取图像路径为：", image_path)
-
-        img = node_helpers.pillow(Image.open, image_path)
-
-        output_images = [] #用于存储处理后的图像的列表。
-        output_masks = [] #用于存储对应掩码的列表。
-        w, h = None, None # 用于存储图像的宽度和高度，初始值为 None。
-
-        excluded_formats = ['MPO']  #这里只排除了 'MPO' 格式
-
-        for i in ImageSequence.Iterator(img):
-            i = node_helpers.pillow(ImageOps.exif_transpose, i)#根据 EXIF 数据纠正图像方向
-
-            if i.mode == 'I': #如果图像模式为 'I'（32 位有符号整数像素），则将像素值缩放到 [0, 1] 范围。
-                i = i.point(lambda i: i * (1 / 255))
-            image = i.convert("RGB")#将图像转换为 RGB 模式
-
-            if len(output_images) == 0: #如果是第一帧，则设置图像的宽度和高度。
-                w = image.size[0]
-                h = image.size[1]
-
-            if image.size[0] != w or image.size[1] != h: #如果不等于那么跳过不匹配初始宽度和高度的帧。
-                continue
-
-            image = np.array(image).astype(np.float32) / 255.0 #将图像转换为 NumPy 数组，并将像素值归一化到 [0, 1] 范围。
-            image = torch.from_numpy(image)[None,] #将 NumPy 数组转换为 PyTorch 张量。
-            if 'A' in i.getbands(): #检查图像是否有 alpha 通道。
-                mask = np.array(i.getchannel('A')).astype(np.float32) / 255.0 #提取 alpha 通道并将其归一化。
-                mask = 1. - torch.from_numpy(mask)#反转掩码（假设 alpha 通道表示透明度）
-            else:
-                mask = torch.zeros((64,64), dtype=torch.float32, device="cpu") #如果没有 alpha 通道，则创建一个大小为 (64, 64) 的零掩码。
-            output_images.append(image) #将处理后的图像添加到列表中。
-            output_masks.append(mask.unsqueeze(0)) #将掩码添加到列表中。
-
-        if len(output_images) > 1 and img.format not in excluded_formats:#检查处理后的图像帧数量是否大于 1。如果大于 1，说明图像包含多个帧（例如 GIF 或多帧图像）。 检查图像格式是否不在排除的格式列表中。
-            output_image = torch.cat(output_images, dim=0)# 将所有处理后的图像沿批次维度（dim=0）连接起来。假设 output_images 是一个包含多个图像张量的列表，torch.cat 会将这些张量在批次维度上拼接成一个大的张量。
-            output_mask = torch.cat(output_masks, dim=0)#将所有掩码沿批次维度（dim=0）连接起来。假设 output_masks 是一个包含多个掩码张量的列表，torch.cat 会将这些张量在批次维度上拼接成一个大的张量。
-        else:
-            # 单帧情况：
-            output_image = output_images[0] #如果图像只有一个帧或格式在排除列表中，则直接使用第一个帧作为输出图像。
-            output_mask = output_masks[0]#同样，使用第一个帧的掩码作为输出掩码。
-
-        return (output_image, output_mask) #返回一个包含处理后的图像及其对应掩码的元组。
+        return decode_image_file(image_path) #返回一个包含处理后的图像及其对应掩码的元组。
 
 
 
@@ -1,13 +1,25 @@
+from concurrent.futures import as_completed
 from datetime import datetime
 import os
+import threading
 import numpy as np
+import torch
 from PIL import Image
 import folder_paths
+from comfy.cli_args import args
 from .hua_icons import icons
-import json # 导入 json 库
+from ..kelnel_ui.result_registry import result_registry # 进程内结果登记表
+from ..kelnel_ui.output_policy import OutputPolicy, OUTPUT_FORMATS, OUTPUT_PRESETS, encode_stats # 输出格式与压缩策略
+from ..kelnel_ui.background_writer import BoundedWriter # 有界后台写入 (背压)
+from ..kelnel_ui.result_manifest import ResultManifestWriter, write_result_manifest, find_seed # 原子写入的结果 manifest v2
 
 OUTPUT_DIR = folder_paths.get_output_directory()
 TEMP_DIR = folder_paths.get_temp_directory() # 获取临时目录
+# PNG 编码 (zlib) 会释放 GIL，批量图片在有界线程池中并行编码
+ENCODE_WORKERS = max(1, min(4, os.cpu_count() or 1))
+# 未写完的图片超过 ENCODE_MAX_PENDING 张时，提交方 (ComfyUI 执行线程) 阻塞等待，限制内存中待编码的图像数量
+ENCODE_MAX_PENDING = ENCODE_WORKERS * 4
+encode_writer = BoundedWriter(ENCODE_WORKERS, ENCODE_MAX_PENDING, thread_name_prefix="hua_output_encode")
 
 #传递到gradio前端的导出节点
 class Hua_Output:
@@ -15,7 +27,7 @@ class Hua_Output:
         self.output_dir = folder_paths.get_output_directory() # 获取输出目录
         self.type = "output"  # 设置输出类型为 "output"
         self.prefix_append = "" # 前缀附加字符串，默认为空
-        self.compress_level = 4 # 设置 PNG 压缩级别，默认为 4
+        self.compress_level = 4 # 设置 PNG 压缩级别，默认为 4 (节点的 png_compress_level 参数默认值)
 
     @classmethod
     def INPUT_TYPES(s):
@@ -24,7 +36,20 @@ class Hua_Output:
                 "images": ("IMAGE", {"tooltip": "The images to save."}),  # 需要输入的图像
                 "unique_id": ("STRING", {"default": "default_id", "multiline": False, "tooltip": "Unique ID for this execution provided by Gradio."}), # 添加 unique_id 输入
                 "name": ("STRING", {"multiline": False, "default": "Hua_Output", "tooltip": "节点名称"}),
-            }
+            },
+            "optional": {
+                "preset": (OUTPUT_PRESETS, {"default": "custom", "tooltip": "custom: 使用下面的参数; preview: 有损 WebP，快且小; final: PNG level 6 + 元数据，用于归档"}),
+                "output_format": (OUTPUT_FORMATS, {"default": "png", "tooltip": "png_fast 为 PNG 压缩级别 1"}),
+                "png_compress_level": ("INT", {"default": 4, "min": 0, "max": 9, "step": 1, "tooltip": "PNG 压缩级别 (仅 png)"}),
+                "quality": ("INT", {"default": 90, "min": 1, "max": 100, "step": 1, "tooltip": "有损 WebP / JPEG 的质量"}),
+                "embed_metadata": ("BOOLEAN", {"default": False, "tooltip": "嵌入工作流元数据: PNG 为文本块，WebP/JPEG 为 EXIF"}),
+                "max_kb_per_image": ("INT", {"default": 0, "min": 0, "max": 1048576, "step": 64, "tooltip": "单张大小预算 (KB)，0 为不限。有损格式超出时逐步降低质量"}),
+                "max_encode_seconds": ("FLOAT", {"default": 0.0, "min": 0.0, "max": 600.0, "step": 0.5, "tooltip": "整批编码时间预算 (秒)，0 为不限。按历史编码速度估算，超出时改用更快的格式"}),
+                "display_first": ("BOOLEAN", {"default": False, "tooltip": "先显示后落盘: 同进程的 Gradio 立即从内存显示结果，文件在后台写入，写完后图库切换为文件"}),
+            },
+            "hidden": {
+                "prompt": "PROMPT", "extra_pnginfo": "EXTRA_PNGINFO", "node_id": "UNIQUE_ID"
+            },
         }
 
     # RETURN_TYPES = () # 不再需要通过 ComfyUI 返回路径，返回空元组
@@ -33,8 +58,11 @@ class Hua_Output:
     OUTPUT_NODE = True
     CATEGORY = icons.get("hua_boy_one")
 
-    def output_gradio(self, images, unique_id, name): # 添加 unique_id 参数
+    def output_gradio(self, images, unique_id, name, preset="custom", output_format="png", png_compress_level=None,
+                      quality=90, embed_metadata=False, max_kb_per_image=0, max_encode_seconds=0.0,
+                      display_first=False, prompt=None, extra_pnginfo=None, node_id=None): # 添加 unique_id 参数
         image_paths = [] # 初始化一个空列表来存储图片路径
+        ui_images = [] # 返回给 ComfyUI 的文件信息，远程 Gradio 通过 /history + /view 取图
         filename_prefix = "ComfyUI" + self.prefix_append # 使用固定前缀 "ComfyUI"
 
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")  # 获取当前时间戳，用于生成唯一的文件名
@@ -42,37 +70,124 @@ class Hua_Output:
             filename_prefix, self.output_dir, images[0].shape[1], images[0].shape[0]
         )
 
-        for (batch_number, image) in enumerate(images):# 遍历所有图像
-            i = 255. * image.cpu().numpy() # 将图像数据从 PyTorch 张量转换为 NumPy 数组，并缩放到 0-255 范围
-            img = Image.fromarray(np.clip(i, 0, 255).astype(np.uint8)) # 将 NumPy 数组转换为 PIL 图像对象
-            file = f"output_{timestamp}_{batch_number:05}.png" # 固定文件名，使用时间戳生成唯一的文件名
+        policy = OutputPolicy.from_node_inputs(
+            preset, output_format=output_format,
+            png_compress_level=self.compress_level if png_compress_level is None else png_compress_level,
+            quality=quality, embed_metadata=embed_metadata and not args.disable_metadata,
+            max_kb_per_image=max_kb_per_image, max_encode_seconds=max_encode_seconds)
+        policy.plan_for_batch(len(images), images[0].shape[1], images[0].shape[0], ENCODE_WORKERS)
+        metadata = policy.build_metadata(prompt, extra_pnginfo) # 整批共用，只序列化一次
+
+        # 整批一次转换: 在张量所在设备上缩放、裁剪并量化为 uint8，再一次性拷贝到 CPU (数据量为 float32 的 1/4)
+        batch_uint8 = (images * 255.).clamp(0, 255).to(torch.uint8).cpu().numpy()
+
+        # 先显示后落盘: 仅当本进程内有 Gradio 在等待时，先交付内存中的图像
+        display_first = display_first and result_registry.is_waiting(unique_id)
+        if display_first:
+            for (batch_number, pixels) in enumerate(batch_uint8):
+                result_registry.publish_partial(unique_id, pixels, index=batch_number)
+            print(f"已从内存交付 {len(batch_uint8)} 张预览给 Gradio 队列 (unique_id: {unique_id})，文件在后台写入")
+
+        encode_futures = {}
+        for (batch_number, pixels) in enumerate(batch_uint8):# 遍历所有图像
+            file = f"output_{timestamp}_{batch_number:05}{policy.extension}" # 固定文件名，使用时间戳生成唯一的文件名
             image_path_gradio = os.path.join(full_output_folder, file)  # 生成图像路径
-            img.save(os.path.join(full_output_folder, file), compress_level=self.compress_level) # 保存图像到指定路径，并设置压缩级别
-            print(f"打印 output_gradio节点路径及文件名: {image_path_gradio}")  # 打印路径和文件名到终端
-            image_paths.append(image_path_gradio) # 将当前图片路径添加到列表中
-
-        # 确保临时目录存在
-        os.makedirs(TEMP_DIR, exist_ok=True)
-        
-        # 将图片路径列表写入临时文件
-        temp_file_path = os.path.join(TEMP_DIR, f"{unique_id}.json")
+            image_paths.append(image_path_gradio) # 将当前图片路径添加到列表中 (保持批次顺序)
+            ui_images.append({"filename": file, "subfolder": subfolder, "type": self.type})
+            encode_futures[encode_writer.submit(policy.encode, pixels, image_path_gradio, metadata)] = batch_number
+
+        if display_first:
+            # 不等待写入，节点立即返回；全部写完后由最后一个完成的写入交付最终路径列表
+            self._deliver_when_written(unique_id, policy, image_paths, encode_futures)
+            # 只把已经写完的文件登记进 history，避免远程 Gradio 经 /view 请求尚未落盘的文件
+            written = {encode_futures[future] for future in encode_futures if future.done() and future.exception() is None}
+            return {"ui": {"images": [entry for batch_number, entry in enumerate(ui_images) if batch_number in written]}}
+
+        # 每写完一个文件立即交付给 Gradio，不必等整批编码结束:
+        # 同进程时经 result_registry，否则逐张追加到原子写入的 manifest v2 (进程外的 Gradio 读取)
+        manifest_fields = {"node_id": node_id, "seed": find_seed(prompt)}
+        manifest = None if result_registry.is_waiting(unique_id) else ResultManifestWriter(TEMP_DIR, unique_id, **manifest_fields)
+        height, width = batch_uint8.shape[1:3]
+        image_stats = [None] * len(image_paths)
+        errors = []
         try:
-            with open(temp_file_path, 'w', encoding='utf-8') as f:
-                json.dump(image_paths, f)
+            for future in as_completed(encode_futures):
+                batch_number = encode_futures[future]
+                image_path_gradio = image_paths[batch_number]
+                try:
+                    image_stats[batch_number] = future.result()
+                except Exception as e:
+                    errors.append(f"写入 {image_path_gradio} 失败: {e}")
+                    print(f"Hua_Output 写入失败 (unique_id: {unique_id}): {errors[-1]}")
+                    continue
+                print(f"打印 output_gradio节点路径及文件名: {image_path_gradio} ({image_stats[batch_number]})")  # 打印路径和文件名到终端
+                if manifest is not None:
+                    manifest.add_item(batch_number, image_path_gradio, width=width, height=height, **image_stats[batch_number])
+                else:
+                    result_registry.publish_partial(unique_id, image_path_gradio, index=batch_number)
+            self._log_encode_stats(policy, [stat for stat in image_stats if stat is not None])
+        finally:
+            # 无论是否有图片写入失败都要结束本批次，否则进程外的 Gradio 会一直等待 manifest 的 complete
+            # 与先显示后落盘模式一致: 已写完的文件照常交付，全部失败时才交付错误
+            written_paths = [path for path, stat in zip(image_paths, image_stats) if stat is not None]
+            error = None if written_paths else ("; ".join(errors) or "Hua_Output 未写入任何文件")
+            # 优先直接交付给同进程内等待的 Gradio 队列，省去临时文件往返
+            if manifest is not None:
+                print(f"manifest 已完成: {manifest.finish(error=error)}")
+            elif result_registry.publish(unique_id, written_paths, error=error):
+                print(f"图片路径列表已直接交付给 Gradio 队列 (unique_id: {unique_id}): {written_paths}")
+            else:
+                self._write_result_file(unique_id, written_paths, error=error, **manifest_fields)
+        if error:
+            raise RuntimeError(error) # 整批写入失败时让 ComfyUI 把本次执行标记为失败
+
+        # 文件信息写入 ComfyUI 的 history，供不共享文件系统的 Gradio 前端下载；编码统计只进日志和 encode_stats 汇总
+        return {"ui": {"images": [entry for entry, stat in zip(ui_images, image_stats) if stat is not None]}}
+
+    def _deliver_when_written(self, unique_id, policy, image_paths, encode_futures):
+        """后台写入的完成回调: 每写完一张用文件路径替换内存预览，全部完成后 publish() 最终结果。"""
+        image_stats = [None] * len(image_paths)
+        errors = []
+        remaining = [len(encode_futures)]
+        lock = threading.Lock()
+
+        def on_written(future):
+            batch_number = encode_futures[future]
+            try:
+                image_stats[batch_number] = future.result()
+                result_registry.publish_partial(unique_id, image_paths[batch_number], index=batch_number)
+            except Exception as e:
+                errors.append(f"写入 {image_paths[batch_number]} 失败: {e}")
+            with lock:
+                remaining[0] -= 1
+                if remaining[0] > 0:
+                    return
+            # 单张写入失败只记录日志，已写完的文件照常交付；全部失败时才把错误交给 Gradio
+            written_paths = [path for path, stat in zip(image_paths, image_stats) if stat is not None]
+            try:
+                for message in errors:
+                    print(f"Hua_Output 后台写入失败 (unique_id: {unique_id}): {message}")
+                self._log_encode_stats(policy, [stat for stat in image_stats if stat is not None])
+            finally:
+                error = None if written_paths else ("; ".join(errors) or None)
+                if not result_registry.publish(unique_id, written_paths, error=error):
+                    print(f"Gradio 队列已不再等待 unique_id {unique_id}，后台写入的文件保留在输出目录")
+
+        for future in encode_futures:
+            future.add_done_callback(on_written)
+
+    @staticmethod
+    def _log_encode_stats(policy, image_stats):
+        total_kb = sum(stat["bytes"] for stat in image_stats) / 1024
+        total_ms = sum(stat["encode_ms"] for stat in image_stats)
+        print(f"Hua_Output 编码统计: {len(image_stats)} 张 {policy.output_format}, 共 {total_kb:.0f} KB, 编码 {total_ms:.0f} ms (累计: {encode_stats.summary()})")
+
+    def _write_result_file(self, unique_id, image_paths, **fields):
+        """回退路径: Gradio 不在本进程且未逐张写 manifest 时，一次性原子写入 TEMP_DIR/<unique_id>.json。"""
+        try:
+            temp_file_path = write_result_manifest(TEMP_DIR, unique_id, image_paths, **fields)
             print(f"图片路径列表已写入临时文件: {temp_file_path}")
-            print(f"临时目录: {TEMP_DIR}")
             print(f"图片路径列表: {image_paths}")
-            
-            # 验证图片文件是否存在
-            for path in image_paths:
-                if not os.path.exists(path):
-                    print(f"错误: 图片文件不存在: {path}")
-                else:
-                    print(f"验证: 图片文件存在: {path}")
-                    
         except Exception as e:
-            print(f"写入临时文件失败 ({temp_file_path}): {e}")
+            print(f"写入临时文件失败 ({TEMP_DIR}): {e}")
             print(f"临时目录权限: {os.access(TEMP_DIR, os.W_OK)}")
-
-        # 不再需要通过 ComfyUI 返回路径
-        return ()
@@ -11,6 +11,8 @@ import datetime
 import re
 import torch
 import itertools
+from ..kelnel_ui.result_registry import result_registry # 进程内结果登记表
+from ..kelnel_ui.result_manifest import write_result_manifest # 原子写入的结果 manifest v2
 # 尝试导入 LoraLoader 以便处理潜在的 VAE 输入，如果不存在则忽略
 try:
     from nodes import LoraLoader
@@ -623,13 +625,6 @@ class Hua_Video_Output:
             # --- 恢复写入 JSON 的逻辑 ---
             temp_json_path = os.path.join(self.temp_dir, f"{unique_id}.json")
             try:
-                # 写入包含成功生成的文件列表的 JSON
-                success_data = {"generated_files": final_paths_for_json}
-                with open(temp_json_path, 'w', encoding='utf-8') as f:
-                    json.dump(success_data, f, indent=4)
-                print(f"最终文件路径列表已写入临时文件 (供 Gradio 使用): {temp_json_path}")
-                print(f"路径列表: {final_paths_for_json}")
-
                 # 验证文件是否存在 (可选，但建议保留)
                 all_exist = True
                 for path in final_paths_for_json:
@@ -637,10 +632,18 @@ class Hua_Video_Output:
                         print(f"错误: 最终文件不存在: {path}")
                         all_exist = False
                 if not all_exist:
-                     # 即使 JSON 写入成功，如果文件丢失也报告错误
+                     # 如果文件丢失则报告错误
                      self._write_error_to_json(unique_id, "One or more output files missing after generation.", final_paths_for_json) # 写入错误 JSON
                      return self._create_error_result("One or more output files missing after generation.", final_paths_for_json) # 返回 UI 错误
 
+                # 优先直接交付给同进程内等待的 Gradio 队列；否则写入包含成功生成的文件列表的 JSON
+                if result_registry.publish(unique_id, final_paths_for_json):
+                    print(f"最终文件路径列表已直接交付给 Gradio 队列 (unique_id: {unique_id})")
+                else:
+                    temp_json_path = write_result_manifest(self.temp_dir, unique_id, final_paths_for_json)
+                    print(f"最终文件路径列表已写入临时文件 (供 Gradio 使用): {temp_json_path}")
+                print(f"路径列表: {final_paths_for_json}")
+
             except Exception as e:
                 print(f"错误: 写入临时 JSON 文件失败 ({temp_json_path}): {e}")
                 self._write_error_to_json(unique_id, f"Failed to write result JSON: {e}", final_paths_for_json) # 写入错误 JSON
@@ -683,14 +686,13 @@ class Hua_Video_Output:
         """Helper to write an error structure to the JSON file for Gradio."""
         if existing_paths is None:
             existing_paths = []
+        if result_registry.publish(unique_id, existing_paths, error=error_message):
+            print(f"错误信息已直接交付给 Gradio 队列 (unique_id: {unique_id})")
+            return
         temp_json_path = os.path.join(self.temp_dir, f"{unique_id}.json")
-        error_data = {
-            "error": error_message,
-            "generated_files": existing_paths # 包含任何已成功生成的文件
-        }
         try:
-            with open(temp_json_path, 'w', encoding='utf-8') as f:
-                json.dump(error_data, f, indent=4)
+            # generated_files 包含任何已成功生成的文件
+            write_result_manifest(self.temp_dir, unique_id, existing_paths, error=error_message)
             print(f"错误信息已写入临时文件 (供 Gradio 使用): {temp_json_path}")
         except Exception as e:
             print(f"严重错误: 连错误信息都无法写入 JSON 文件 ({temp_json_path}): {e}")
@@ -0,0 +1,89 @@
+"""
+LogTailer 对本地替身 /internal/logs/raw 的测试: 增量追加、锚点条目被 ComfyUI 环形缓冲区淘汰后按时间戳续接、无人取日志时暂停拉取。
+运行: python -m unittest discover -s tests (需要 requests)
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+import importlib.util
+import json
+import os
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+HAS_REQUESTS = importlib.util.find_spec("requests") is not None
+if HAS_REQUESTS:
+    from kelnel_ui.log_tailer import LogTailer
+
+def log_entry(second, message):
+    return {"t": f"2026-10-18T12:00:{second:02}.000000", "m": message}
+
+class StubLogs(BaseHTTPRequestHandler):
+    """只实现 /internal/logs/raw，返回 server.entries 并统计请求次数。"""
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.server.requests += 1
+        body = json.dumps({"entries": self.server.entries, "size": {"cols": 80, "rows": 24}}).encode()
+        self.send_response(200 if self.path == "/internal/logs/raw" else 404)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+@unittest.skipUnless(HAS_REQUESTS, "requests 未安装")
+class LogTailerTest(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), StubLogs)
+        self.server.entries = []
+        self.server.requests = 0
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        address = f"127.0.0.1:{self.server.server_address[1]}"
+        health = SimpleNamespace(ready=True, summary=lambda: "ready")
+        backend = SimpleNamespace(name=f"#1 {address}", base_url=f"http://{address}", health=health)
+        self.tailer = LogTailer(SimpleNamespace(active_backend=backend), interval=0.05)
+
+    def tearDown(self):
+        self.tailer.stop()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_only_new_entries_are_appended(self):
+        self.server.entries = [log_entry(1, "a\n"), log_entry(2, "\n"), log_entry(3, "b\n")]
+        self.tailer._poll_once()
+        cursor, lines, reset = self.tailer.lines_since(None)
+        self.assertEqual((lines, reset), (["a", "b"], True))
+
+        self.server.entries.append(log_entry(4, "c\n"))
+        self.tailer._poll_once()
+        self.tailer._poll_once()
+        self.assertEqual(self.tailer.lines_since(cursor)[1:], (["c"], False))
+
+    def test_rotated_anchor_falls_back_to_timestamps(self):
+        self.server.entries = [log_entry(second, f"old {second}") for second in range(1, 4)]
+        self.tailer._poll_once()
+        cursor = self.tailer.lines_since(None)[0]
+
+        # ComfyUI 的环形缓冲区已淘汰上次的最后一条 (old 3)，只剩更早的一条和新增的条目
+        self.server.entries = [log_entry(2, "old 2")] + [log_entry(second, f"new {second}") for second in range(4, 7)]
+        self.tailer._poll_once()
+        self.assertEqual(self.tailer.lines_since(cursor)[1:], (["new 4", "new 5", "new 6"], False))
+        self.assertEqual(len(self.tailer.lines_since(None)[1]), 6)
+
+    def test_polling_pauses_without_readers(self):
+        self.server.entries = [log_entry(1, "a")]
+        self.tailer.start()
+        time.sleep(0.3)
+        self.assertEqual(self.server.requests, 0)
+
+        self.tailer.lines_since(None)
+        deadline = time.time() + 5
+        while self.server.requests == 0 and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertGreater(self.server.requests, 0)
+
+if __name__ == "__main__":
+    unittest.main()
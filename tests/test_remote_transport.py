@@ -0,0 +1,132 @@
+"""
+RemoteTransport 对本地替身 HTTP 服务器的测试: /upload/image 上传与缓存、/history + /view 下载与缓存、下载失败。
+运行: python -m unittest discover -s tests (需要 requests)
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from urllib.parse import urlsplit, parse_qs
+import importlib.util
+import json
+import os
+import re
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+HAS_REQUESTS = importlib.util.find_spec("requests") is not None
+if HAS_REQUESTS:
+    from kelnel_ui.remote_transport import RemoteTransport
+
+PROMPT_ID = "prompt-1"
+OUTPUT_FILES = {"result_00001_.png": b"\x89PNG fake image bytes"}
+
+class StubComfyUI(BaseHTTPRequestHandler):
+    """只实现 RemoteTransport 用到的三个端点，并记录每个端点收到的请求。"""
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, body=b"", content_type="application/json"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        if self.path != "/upload/image":
+            return self._send(404)
+        filename = re.search(rb'filename="([^"]+)"', body).group(1).decode()
+        self.server.calls.append(("upload", filename))
+        self._send(200, json.dumps({"name": filename, "subfolder": "", "type": "input"}).encode())
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path == f"/history/{PROMPT_ID}":
+            self.server.calls.append(("history", PROMPT_ID))
+            refs = [{"filename": name, "subfolder": "", "type": "output"} for name in self.server.history_files]
+            return self._send(200, json.dumps({PROMPT_ID: {"outputs": {"9": {"images": refs}}}}).encode())
+        if url.path.startswith("/history/"):
+            return self._send(200, b"{}")
+        if url.path == "/view":
+            filename = parse_qs(url.query)["filename"][0]
+            self.server.calls.append(("view", filename))
+            if filename not in OUTPUT_FILES:
+                return self._send(404, b"not found", "text/plain")
+            return self._send(200, OUTPUT_FILES[filename], "image/png")
+        self._send(404)
+
+@unittest.skipUnless(HAS_REQUESTS, "requests 未安装")
+class RemoteTransportTest(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), StubComfyUI)
+        self.server.calls = []
+        self.server.history_files = list(OUTPUT_FILES)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        address = f"127.0.0.1:{self.server.server_address[1]}"
+        self.backend = SimpleNamespace(address=address, name=f"#1 {address}", base_url=f"http://{address}")
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.transport = RemoteTransport(os.path.join(self.tmp_dir.name, "cache"))
+
+    def tearDown(self):
+        self.transport.shutdown()
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmp_dir.cleanup()
+
+    def calls(self, kind):
+        return [name for call_kind, name in self.server.calls if call_kind == kind]
+
+    def test_upload_is_cached_per_backend_and_content(self):
+        source = os.path.join(self.tmp_dir.name, "input.png")
+        with open(source, "wb") as f:
+            f.write(b"input image bytes")
+
+        name = self.transport.upload_input(self.backend, source, ".png")
+        self.assertTrue(name.startswith("gradio_input_") and name.endswith(".png"))
+        self.assertEqual(self.transport.upload_input(self.backend, source, ".png"), name)
+        self.assertEqual(self.transport.upload_input(self.backend, b"input image bytes", ".png"), name) # 相同内容的 bytes 同样命中缓存
+        self.assertEqual(self.calls("upload"), [name])
+
+    def test_upload_cache_is_dropped_after_backend_restart_or_missing_input(self):
+        name = self.transport.upload_input(self.backend, b"video bytes", ".mp4")
+
+        self.transport.forget_backend(self.backend)
+        self.assertEqual(self.transport.upload_input(self.backend, b"video bytes", ".mp4"), name)
+        self.assertEqual(self.transport.forget_missing_inputs(self.backend, f"Invalid video file: {name}"), [name])
+        self.assertEqual(self.transport.forget_missing_inputs(self.backend, "unrelated error"), [])
+        self.assertEqual(self.transport.upload_input(self.backend, b"video bytes", ".mp4"), name)
+        self.assertEqual(self.calls("upload"), [name, name, name])
+
+    def test_concurrent_uploads(self):
+        image_upload = self.transport.upload_input_async(self.backend, b"image", ".png")
+        video_upload = self.transport.upload_input_async(self.backend, b"video", ".mp4")
+        names = {image_upload.result(timeout=10), video_upload.result(timeout=10)}
+        self.assertEqual(len(names), 2)
+        self.assertEqual(set(self.calls("upload")), names)
+
+    def test_fetch_outputs_downloads_and_reuses_cache(self):
+        self.assertIsNone(self.transport.fetch_outputs(self.backend, "unknown-prompt"))
+
+        result = self.transport.fetch_outputs(self.backend, PROMPT_ID, node_id="9")
+        self.assertNotIn("error", result)
+        [local_path] = result["generated_files"]
+        with open(local_path, "rb") as f:
+            self.assertEqual(f.read(), OUTPUT_FILES["result_00001_.png"])
+
+        again = self.transport.fetch_outputs(self.backend, PROMPT_ID, node_id="9")
+        self.assertEqual(again["generated_files"], [local_path])
+        self.assertEqual(self.calls("view"), ["result_00001_.png"]) # 第二次命中本地缓存，不再请求 /view
+
+    def test_failed_download_is_reported_in_error(self):
+        self.server.history_files = ["result_00001_.png", "missing_00002_.png"]
+
+        result = self.transport.fetch_outputs(self.backend, PROMPT_ID)
+        self.assertEqual(len(result["generated_files"]), 1)
+        self.assertIn("下载输出文件失败", result["error"])
+        self.assertIn("404", result["error"])
+
+if __name__ == "__main__":
+    unittest.main()
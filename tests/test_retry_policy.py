@@ -0,0 +1,55 @@
+"""
+CircuitBreaker 的测试: closed 状态的退避、连续失败后打开、half_open 只放行一个试探请求。
+运行: python -m unittest discover -s tests
+"""
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from kelnel_ui.retry_policy import CircuitBreaker
+
+class CircuitBreakerTest(unittest.TestCase):
+    def open_breaker(self):
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.05)
+        breaker.record_failure()
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(breaker.begin_request())
+        time.sleep(0.06)
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        return breaker
+
+    def test_half_open_allows_a_single_trial(self):
+        breaker = self.open_breaker()
+        self.assertTrue(breaker.allows_request())
+        self.assertTrue(breaker.begin_request())
+        # 试探进行中: 其他提交方不得向该后端提交
+        self.assertFalse(breaker.allows_request())
+        self.assertFalse(breaker.begin_request())
+        self.assertGreater(breaker.seconds_until_retry(), 0)
+
+        breaker.record_success()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        self.assertTrue(breaker.begin_request())
+        self.assertTrue(breaker.begin_request())
+
+    def test_failed_trial_reopens_with_longer_timeout(self):
+        breaker = self.open_breaker()
+        self.assertTrue(breaker.begin_request())
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertGreater(breaker.seconds_until_retry(), 0.05)
+        self.assertFalse(breaker.begin_request())
+
+    def test_closed_failure_backs_off_before_opening(self):
+        breaker = CircuitBreaker(failure_threshold=3)
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        self.assertLessEqual(breaker.seconds_until_retry(), 0.5)
+        breaker.record_success()
+        self.assertTrue(breaker.begin_request())
+
+if __name__ == "__main__":
+    unittest.main()